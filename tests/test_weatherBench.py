@@ -0,0 +1,43 @@
+################################################################
+#
+#   Tests for weatherBench's measuring, the parts that don't need a whole benchmark run
+#
+################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import weatherBench
+
+
+#----------------------------------------------------------------
+class PeakMemoryTest(unittest.TestCase):
+
+    def testPeakIsTheChildsOwn(self):
+        #   Two workloads with different appetites read differently, and neither is floored at our own peak
+        #       (a big parent used to make every child report at least its size)
+        ballast = b'x' * (300 * 1024 * 1024)
+
+        small = weatherBench.runProcess([sys.executable, '-c', 'pass'], memory=True)
+        large = weatherBench.runProcess([sys.executable, '-c', "held = b'x' * (150 * 1024 * 1024)"], memory=True)
+
+        self.assertEqual(small[2], 0, small[3])
+        self.assertEqual(large[2], 0, large[3])
+        self.assertIsNotNone(small[1])
+        self.assertLess(small[1], 100 * 1024)
+        self.assertGreater(large[1] - small[1], 140 * 1024)
+        self.assertEqual(len(ballast), 300 * 1024 * 1024)
+
+    def testWrapperPassesArgumentsAndStatus(self):
+        #   The wrapped command sees its own argv and its exit status comes through
+        checked = weatherBench.runProcess([sys.executable, '-c', 'import sys; print(sys.argv[1:]); sys.exit(3)', 'a', 'b'], memory=True)
+
+        self.assertEqual(checked[2], 3)
+        self.assertEqual(checked[3].strip(), "['a', 'b']")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,765 @@
+################################################################
+#
+#   Tests for weatherCheck, run against the wuReplay stand-in (started in this process) so no API quota is spent
+#
+#   ie;  python -m pytest tests
+#        python -m unittest discover tests
+#
+################################################################
+
+import importlib.util
+import io
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from   collections import OrderedDict
+from   datetime import date, timedelta
+from   urllib.error import HTTPError
+from   urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wuReplay
+import weatherCheck
+
+
+WEATHER_CHECK = os.path.abspath(weatherCheck.__file__)
+
+
+#----------------------------------------------------------------
+class ReplayTestCase(unittest.TestCase):
+    #   Starts a wuReplay stand-in per test and hands each one an empty cache dir
+
+    def setUp(self):
+        self.payload_for = wuReplay.payloadFor
+        self.latency = wuReplay.REPLAY_LATENCY
+        wuReplay.REPLAY_STATS.clear()
+        self.server, self.wu_url = wuReplay.startServer()
+        self.cache_dir = tempfile.mkdtemp(prefix='weatherCheck_test_')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        wuReplay.payloadFor = self.payload_for
+        wuReplay.REPLAY_LATENCY = self.latency
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def runCheck(self, *args, timeout=60):
+        #   Runs weatherCheck against the stand-in, returns the finished process
+        return subprocess.run(self.checkArgs(*args), capture_output=True, text=True, timeout=timeout)
+
+    def checkArgs(self, *args):
+        #   A weatherCheck command line pointed at the stand-in, with limits the stand-in never holds us to
+        return [sys.executable, WEATHER_CHECK, '--wuurl', self.wu_url, '--cachedir', self.cache_dir,
+                '--callspermin', '100000', '--callsperday', '100000'] + list(args)
+
+
+#----------------------------------------------------------------
+class StationResolutionTest(ReplayTestCase):
+
+    def testFailedGeolookupIsSpentOnce(self):
+        #   A location WU can't place costs one geolookup, quietly, and the next run doesn't ask again
+        payload_for = wuReplay.payloadFor
+
+        def noGeolookup(features, location):
+            if 'geolookup' in features:
+                return wuReplay.errorBody('querynotfound', 'No cities match your search query'), 0
+            return payload_for(features, location)
+
+        wuReplay.payloadFor = noGeolookup
+
+        logged = []
+        for run in range(2):
+            checked = self.runCheck('--pastweekavg')
+            self.assertEqual(checked.returncode, 0, checked.stdout + checked.stderr)
+            self.assertNotIn('Error retrieving weather', checked.stdout)
+            self.assertEqual(wuReplay.REPLAY_STATS['feature:geolookup'], 1)
+            logged.append(checked.stderr)
+
+        #   The warning names what WU actually said, not an exit status
+        self.assertIn('No cities match your search query', logged[0])
+        self.assertNotIn('Station lookup failed', logged[1])
+
+
+
+#----------------------------------------------------------------
+class PlanTest(ReplayTestCase):
+
+    def testLocationActionsShareOneChainedCall(self):
+        #   Current temp, a good day and the 3-day forecast all come out of a single conditions/forecast request
+        checked = self.runCheck('--noresolve', '--zipcode', '94541', '--currenttemp', '--agoodday', '--threedayforecast')
+
+        self.assertEqual(checked.returncode, 0, checked.stderr)
+        self.assertIn('The current temperature is', checked.stdout)
+        self.assertIn('Three Day forecast for 94541', checked.stdout)
+        self.assertEqual(wuReplay.REPLAY_STATS['requests'], 1)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:conditions'], 1)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:forecast'], 1)
+
+
+#----------------------------------------------------------------
+class BatchTest(ReplayTestCase):
+
+    def batchFile(self, *lines):
+        path = os.path.join(self.cache_dir, 'batch.txt')
+        with open(path, 'w') as batch:
+            batch.write('\n'.join(lines) + '\n')
+        return path
+
+    def testFailingLocationReportsOnItsOwnLine(self):
+        #   WU refusing one location only shows up in that location's section, with what WU said
+        checked = self.runCheck('--batch', self.batchFile('94541,currenttemp', '00000,currenttemp'))
+
+        self.assertEqual(checked.returncode, 1)
+        self.assertNotIn('Error retrieving weather', checked.stdout)
+        sections = checked.stdout.split('==== 00000 ====')
+        self.assertIn('The current temperature is', sections[0])
+        self.assertEqual(sections[1].strip(), 'Error: 00000 failed: Weather Underground error: No cities match your search query')
+
+    def testRepeatedLocationsAreFetchedOnce(self):
+        #   Every line for a location shares one chained request, however its actions are spread over the file
+        checked = self.runCheck('--noresolve', '--batch', self.batchFile('94541,currenttemp', '95014,currenttemp',
+                                                                         '94541,agoodday', '94541,currenttemp'))
+
+        self.assertEqual(checked.returncode, 0, checked.stderr)
+        self.assertEqual(checked.stdout.count('The current temperature is'), 3)
+        self.assertEqual(wuReplay.REPLAY_STATS['requests'], 2)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:conditions'], 2)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:forecast'], 1)
+
+
+#----------------------------------------------------------------
+class PrefetchTest(ReplayTestCase):
+
+    def watchFile(self, *lines):
+        path = os.path.join(self.cache_dir, 'watch.txt')
+        with open(path, 'w') as watch:
+            watch.write('\n'.join(lines) + '\n')
+        return path
+
+    def testHistoryFanOutIsSpaced(self):
+        #   A history backfill's parallel fetches each wait their own slot, not one slot for the whole task
+        arrivals = []
+        payload_for = wuReplay.payloadFor
+
+        def timedPayload(features, location):
+            arrivals.append(time.time())
+            return payload_for(features, location)
+        wuReplay.payloadFor = timedPayload
+
+        #   600 calls a minute at a 0.5 share is one call every 0.2s
+        checked = self.runCheck('--prefetch', self.watchFile('94541,currenttemp,pastweekavg'), '--once', '--callspermin', '600')
+
+        self.assertEqual(checked.returncode, 0, checked.stderr)
+        self.assertGreater(len(arrivals), 7)
+        gaps = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+        self.assertGreater(min(gaps), 0.15)
+
+    def testFailingLocationKeepsWUsDescription(self):
+        #   A location WU refuses is logged with what WU said and the rest of the watch-list still gets warmed
+        checked = self.runCheck('--prefetch', self.watchFile('00000,pastweekavg', '94541,currenttemp'), '--once')
+
+        self.assertEqual(checked.returncode, 0, checked.stderr)
+        self.assertIn('Prefetch of history for 00000 failed: Weather Underground error: No cities match your search query',
+                      checked.stderr)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:conditions'], 1)
+
+
+#----------------------------------------------------------------
+class JsonOutputTest(ReplayTestCase):
+
+    def testFailedFetchKeepsStdoutJson(self):
+        #   Nothing listening upstream: every stdout line is still a json record, the failure being one of them
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        refused = 'http://127.0.0.1:%s/api/' % probe.getsockname()[1]
+        probe.close()
+
+        for actions in (['--currenttemp', '--threedayforecast'], ['--pastweekavg']):
+            checked = self.runCheck(*['--json', '--wuurl', refused, '--connecttimeout', '0.5', '--zipcode', '94541'] + actions)
+
+            self.assertEqual(checked.returncode, 1)
+            records = [json.loads(line) for line in checked.stdout.splitlines() if line.strip()]
+            self.assertEqual([record['location'] for record in records], ['94541'])
+            self.assertIn('error', records[0])
+            self.assertNotIn('%s', records[0]['error'])
+
+
+#----------------------------------------------------------------
+class ArchiveTest(ReplayTestCase):
+
+    def testExportSeedsAnotherHost(self):
+        #   An export imported into an empty cache dir answers the same history without going back to WU
+        archived = self.runCheck('--archive', '--pastweekavg')
+        self.assertEqual(archived.returncode, 0, archived.stderr)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], weatherCheck.DAYS_2_GET_HISTORICALS)
+
+        export_path = os.path.join(self.cache_dir, 'export.wca')
+        exported = self.runCheck('--archiveexport', export_path)
+        self.assertIn('Exported %s payloads' % weatherCheck.DAYS_2_GET_HISTORICALS, exported.stdout)
+
+        other_host = tempfile.mkdtemp(prefix='weatherCheck_test_')
+        self.addCleanup(shutil.rmtree, other_host, ignore_errors=True)
+        seeded = subprocess.run(self.checkArgs('--cachedir', other_host, '--archiveimport', export_path),
+                                capture_output=True, text=True, timeout=60)
+        self.assertIn('(%s history days into the store)' % weatherCheck.DAYS_2_GET_HISTORICALS, seeded.stdout)
+
+        answered = subprocess.run(self.checkArgs('--cachedir', other_host, '--pastweekavg'), capture_output=True, text=True, timeout=60)
+        self.assertEqual(answered.stdout, archived.stdout)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], weatherCheck.DAYS_2_GET_HISTORICALS)
+
+
+#----------------------------------------------------------------
+class ServeTest(ReplayTestCase):
+
+    def testUpstreamErrorReachesTheClient(self):
+        #   WU refusing a location comes back as a 502 carrying WU's own words, and the daemon keeps quiet about it
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        daemon = subprocess.Popen(self.checkArgs('--serve', str(port)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            for attempt in range(100):
+                try:
+                    urlopen('http://127.0.0.1:%s/health' % port).read()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+
+            answers = dict()
+            for path in ('currenttemp?location=00000', 'pastweekavg?location=00000', 'currenttemp?location=94541', 'nosuchaction'):
+                try:
+                    with urlopen('http://127.0.0.1:%s/%s' % (port, path)) as response:
+                        answers[path] = (response.status, json.loads(response.read().decode('utf-8')))
+                except HTTPError as e:
+                    answers[path] = (e.code, json.loads(e.read().decode('utf-8')))
+
+        finally:
+            daemon.terminate()
+            output = daemon.communicate()[0]
+
+        for path in ('currenttemp?location=00000', 'pastweekavg?location=00000'):
+            self.assertEqual(answers[path][0], 502)
+            self.assertIn('No cities match your search query', answers[path][1]['error'])
+        self.assertEqual(answers['currenttemp?location=94541'][0], 200)
+        self.assertEqual(answers['nosuchaction'][0], 400)
+        self.assertNotIn('Error retrieving weather', output)
+
+
+#----------------------------------------------------------------
+class StaleServingTest(ReplayTestCase):
+
+    def testStaleAnswerDoesNotWaitOnUpstream(self):
+        #   A stale cached answer comes back (and the process exits) without waiting on a slow upstream,
+        #       the refresh still lands in the cache afterwards
+        checked = self.runCheck('--zipcode', '94541', '--currenttemp')
+        self.assertEqual(checked.returncode, 0, checked.stdout + checked.stderr)
+
+        #   Aging the cached conditions payload past its TTL, though not past CACHE_MAX_STALE
+        db_path = os.path.join(self.cache_dir, weatherCheck.CACHE_DB_NAME)
+        aged = time.time() - 12 * 60
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("UPDATE responses SET fetched = ?, expires = ? WHERE key LIKE '%conditions%'", (aged, aged + 60))
+
+        wuReplay.REPLAY_LATENCY = 3.0
+        started = time.perf_counter()
+        checked = self.runCheck('--zipcode', '94541', '--currenttemp')
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(checked.returncode, 0, checked.stdout + checked.stderr)
+        self.assertIn('refreshing', checked.stdout)
+        self.assertLess(elapsed, 2.0)
+
+        #   The detached refresh gets there on its own
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            with sqlite3.connect(db_path) as conn:
+                fetched = conn.execute("SELECT max(fetched) FROM responses WHERE key LIKE '%conditions%'").fetchone()[0]
+            if fetched > aged + 1:
+                break
+            time.sleep(0.2)
+        self.assertGreater(fetched, aged + 1)
+
+
+#----------------------------------------------------------------
+class InProcessTestCase(ReplayTestCase):
+    #   Points this process's weatherCheck at the stand-in, for calling its functions directly
+
+    def setUp(self):
+        ReplayTestCase.setUp(self)
+        self.saved = dict((name, getattr(weatherCheck, name)) for name in
+                          ['WU_URL', 'API_KEY', 'CACHE_DIR', 'CACHE_CONN', 'MEMORY_CACHE', 'STATION_INDEX',
+                           'STORE_STATIONS', 'API_CALLS_PER_MIN', 'API_CALLS_PER_DAY', 'THIS_DAY',
+                           'QUOTA_MAX_WAIT', 'QUOTA_PRIORITY'])
+        weatherCheck.WU_URL = self.wu_url
+        weatherCheck.API_KEY = 'test/'
+        weatherCheck.CACHE_DIR = self.cache_dir
+        weatherCheck.CACHE_CONN = None
+        weatherCheck.MEMORY_CACHE = OrderedDict()
+        weatherCheck.STATION_INDEX = None
+        weatherCheck.STORE_STATIONS = dict()
+        weatherCheck.API_CALLS_PER_MIN = 100000
+        weatherCheck.API_CALLS_PER_DAY = 100000
+
+    def tearDown(self):
+        for entry in list(weatherCheck.STORE_STATIONS.values()):
+            weatherCheck.storeRelease(entry)
+        if weatherCheck.CACHE_CONN is not None:
+            weatherCheck.CACHE_CONN.close()
+        for name, value in self.saved.items():
+            setattr(weatherCheck, name, value)
+        ReplayTestCase.tearDown(self)
+
+
+#----------------------------------------------------------------
+class CacheTest(InProcessTestCase):
+
+    def setUp(self):
+        InProcessTestCase.setUp(self)
+        for name in ['MEMORY_CACHE_ENTRIES', 'CACHE_MAX_BYTES']:
+            self.addCleanup(setattr, weatherCheck, name, getattr(weatherCheck, name))
+
+    def cachedKeys(self):
+        return set(key for key, in weatherCheck.cacheOpen().execute("SELECT key FROM responses"))
+
+    def testTTLs(self):
+        #   Past history never expires, a chained query lives as long as its shortest lived feature
+        query = 'http://wu/api/key/%s/q/94541.json'
+        self.assertIsNone(weatherCheck.cacheTTL(query % 'history_20170301'))
+        self.assertEqual(weatherCheck.cacheTTL(query % 'history_%s' % date.today().strftime('%Y%m%d')), weatherCheck.CACHE_TTL_HISTORY_TODAY)
+        self.assertEqual(weatherCheck.cacheTTL(query % 'forecast'), weatherCheck.CACHE_TTL_FORECAST)
+        self.assertEqual(weatherCheck.cacheTTL(query % 'conditions/forecast'), weatherCheck.CACHE_TTL_CONDITIONS)
+
+    def testExpiredEntryOnlyServedWhileStaleIsAllowed(self):
+        weatherCheck.cachePut('fresh', '{"a": 1}', 60)
+        weatherCheck.cachePut('expired', '{"b": 2}', -5)
+
+        self.assertEqual(weatherCheck.cacheGet('fresh'), ('{"a": 1}', None))
+        self.assertEqual(weatherCheck.cacheGet('expired'), (None, None))
+        body, age = weatherCheck.cacheGet('expired', max_stale=60)
+        self.assertEqual(body, '{"b": 2}')
+        self.assertGreaterEqual(age, 0)
+        self.assertEqual(weatherCheck.cacheGet('expired', max_stale=1), (None, None))
+
+    def testMemoryCacheDropsLeastRecentlyUsed(self):
+        #   Reading an entry keeps it in memory, the one nobody read goes, sqlite still has it
+        weatherCheck.MEMORY_CACHE_ENTRIES = 2
+        weatherCheck.cachePut('a', '"a"', None)
+        weatherCheck.cachePut('b', '"b"', None)
+        weatherCheck.cacheGet('a')
+        weatherCheck.cachePut('c', '"c"', None)
+
+        self.assertEqual(list(weatherCheck.MEMORY_CACHE), ['a', 'c'])
+        self.assertEqual(weatherCheck.cacheGet('b'), ('"b"', None))
+        self.assertEqual(list(weatherCheck.MEMORY_CACHE), ['c', 'b'])
+
+    def testEvictionPastTheSizeCap(self):
+        #   Over the cap expired entries go first, then the least recently used
+        weatherCheck.CACHE_MAX_BYTES = 250
+        body = '"%s"' % ('x' * 98)
+
+        weatherCheck.cachePut('old', body, None)
+        weatherCheck.cachePut('used', body, None)
+        weatherCheck.cacheOpen().execute("UPDATE responses SET accessed = accessed - 100 WHERE key = 'old'")
+        weatherCheck.cachePut('new', body, None)
+        self.assertEqual(self.cachedKeys(), {'used', 'new'})
+
+        weatherCheck.cachePut('expired', body, -5)
+        weatherCheck.cacheOpen().execute("UPDATE responses SET accessed = accessed + 100 WHERE key = 'expired'")
+        weatherCheck.cachePut('newer', body, None)
+        self.assertEqual(self.cachedKeys(), {'new', 'newer'})
+
+
+#----------------------------------------------------------------
+class SingleFlightTest(InProcessTestCase):
+
+    def testConcurrentCallersShareOneRequest(self):
+        #   Everyone asking for the same query while it's in flight waits on the one request
+        wuReplay.REPLAY_LATENCY = 0.3
+        query = '%s%sconditions/q/94541%s' % (self.wu_url, weatherCheck.API_KEY, weatherCheck.URL_EXTENSION)
+        started = threading.Barrier(5)
+        answers = []
+
+        def ask():
+            started.wait()
+            answers.append(weatherCheck.apiPoll(query, weatherCheck.ACTION_FIELDS['currenttemp']))
+
+        askers = [threading.Thread(target=ask) for i in range(5)]
+        for asker in askers:
+            asker.start()
+        for asker in askers:
+            asker.join()
+
+        self.assertEqual(wuReplay.REPLAY_STATS['requests'], 1)
+        self.assertEqual(len(answers), 5)
+        self.assertTrue(all(answer == answers[0] for answer in answers))
+
+    def testWaitersGetTheLeadersError(self):
+        #   A failed fetch fails everyone who was waiting on it, and the next caller tries again
+        release = threading.Event()
+        calls = []
+
+        def failing():
+            calls.append(1)
+            release.wait(5)
+            raise ValueError('upstream went away')
+
+        errors = []
+
+        def ask():
+            try:
+                weatherCheck.singleFlight('key', failing)
+            except ValueError as e:
+                errors.append(str(e))
+
+        leader = threading.Thread(target=ask)
+        leader.start()
+        while not calls:
+            time.sleep(0.01)
+        waiters = [threading.Thread(target=ask) for i in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        time.sleep(0.1)
+        release.set()
+        for asker in [leader] + waiters:
+            asker.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(errors, ['upstream went away'] * 4)
+        self.assertEqual(weatherCheck.singleFlight('key', lambda: 'again'), 'again')
+
+
+#----------------------------------------------------------------
+class ServeDateTest(InProcessTestCase):
+
+    def testRequestsKeepTheirOwnDate(self):
+        #   Two requests answered at once for different dates each get the window ending the day before their own
+        answers = dict()
+        days = [date(2017, 3, 1), date(2017, 3, 2)]
+        started = threading.Barrier(len(days))
+
+        def ask(today):
+            started.wait()
+            answers[today] = weatherCheck.serveAction('pastweekdailyavg', '94541', today)
+
+        askers = [threading.Thread(target=ask, args=(today,)) for today in days]
+        for asker in askers:
+            asker.start()
+        for asker in askers:
+            asker.join()
+
+        for today in days:
+            self.assertEqual(max(answers[today]['days']), (today - timedelta(days=1)).strftime('%Y%m%d'))
+            self.assertEqual(len(answers[today]['days']), weatherCheck.DAYS_2_GET_HISTORICALS)
+        self.assertEqual(weatherCheck.THIS_DAY, self.saved['THIS_DAY'])
+
+
+
+#----------------------------------------------------------------
+class HistoryStoreTest(InProcessTestCase):
+
+    def testDayWithoutAMeanReadsBack(self):
+        #   WU's -999 for a mean it doesn't have is stored (so it isn't fetched again) and then left out, not averaged in
+        payload_for = wuReplay.payloadFor
+        missing = (date.today() - timedelta(days=3)).strftime('%Y%m%d')
+
+        def noMean(features, location):
+            payload, recorded = payload_for(features, location)
+            if 'history_%s' % missing in features:
+                payload['history']['dailysummary'][0]['meantempi'] = '-999'
+            return payload, recorded
+
+        wuReplay.payloadFor = noMean
+
+        for run in range(2):
+            found = weatherCheck.historyLookup(date.today(), 7, weatherCheck.API_KEY, '/q/94541')
+            self.assertEqual(len(found), 6)
+            self.assertNotIn(missing, found)
+            self.assertTrue(all(value > -999 for value in found.values()))
+
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], 7)
+
+        stored = weatherCheck.storeRead(weatherCheck.historyStation('/q/94541'), date.today() - timedelta(days=3), 1)
+        self.assertEqual(stored['have'], [1])
+        self.assertNotEqual(stored['meantempi'][0], stored['meantempi'][0])
+
+    def testOnlyTheGapsAreFetched(self):
+        #   Days already in the store, in the middle of the range, aren't asked for again
+        today = date.today()
+        middle = weatherCheck.historyLookup(today - timedelta(days=3), 2, weatherCheck.API_KEY, '/q/94541')
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], 2)
+
+        found = weatherCheck.historyLookup(today, 7, weatherCheck.API_KEY, '/q/94541')
+
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], 7)
+        self.assertEqual(sorted(found), [(today - timedelta(days=back)).strftime('%Y%m%d') for back in range(7, 0, -1)])
+        for assembled_date, value in middle.items():
+            self.assertEqual(found[assembled_date], value)
+
+    def testConditionsSharedBetweenProcesses(self):
+        #   Another process adding a condition name while we hold our own copy of the table doesn't remap our codes
+        station = 'KTEST'
+        rainy = date(2017, 3, 1)
+        foggy = date(2017, 3, 2)
+        summary = {'meantempi': 50.0, 'mintempi': 40.0, 'maxtempi': 60.0, 'precipi': 0.0}
+
+        weatherCheck.storeWrite(station, date(2017, 2, 28), dict(summary, conds=''))
+        self.assertEqual(weatherCheck.STORE_STATIONS[station]['conds'], [''])
+
+        writer = ("import sys, datetime; sys.path.insert(0, %r); import weatherCheck; weatherCheck.CACHE_DIR = %r; "
+                  "weatherCheck.storeWrite('KTEST', datetime.date(2017, 3, 1), dict(%r, conds='Rain'))"
+                  % (os.path.dirname(WEATHER_CHECK), self.cache_dir, summary))
+        subprocess.run([sys.executable, '-c', writer], check=True)
+
+        weatherCheck.storeWrite(station, foggy, dict(summary, conds='Fog'))
+
+        self.assertEqual(weatherCheck.storeRead(station, rainy, 2)['conds'], ['Rain', 'Fog'])
+        for entry in list(weatherCheck.STORE_STATIONS.values()):
+            weatherCheck.storeRelease(entry)
+        weatherCheck.STORE_STATIONS = dict()
+        self.assertEqual(weatherCheck.storeRead(station, rainy, 2)['conds'], ['Rain', 'Fog'])
+
+
+#----------------------------------------------------------------
+class RollingWindowTest(InProcessTestCase):
+
+    def testWindowSlidesAlongAfterMidnight(self):
+        #   Later the same day nothing is fetched, two days on only the two new days are
+        window = weatherCheck.DAYS_2_GET_HISTORICALS
+        first = date(2017, 3, 10)
+
+        days, total = weatherCheck.rollingWindow('/q/94541', window, today=first)
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], window)
+
+        self.assertEqual(weatherCheck.rollingWindow('/q/94541', window, today=first), (days, total))
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], window)
+
+        #   The saved window alone carries the days it keeps, neither the store nor the cached payloads are any help
+        for entry in list(weatherCheck.STORE_STATIONS.values()):
+            weatherCheck.storeRelease(entry)
+        weatherCheck.STORE_STATIONS = dict()
+        shutil.rmtree(weatherCheck.storeDir())
+        weatherCheck.cacheOpen().execute("DELETE FROM responses")
+        weatherCheck.MEMORY_CACHE.clear()
+
+        later = first + timedelta(days=2)
+        slid, slid_total = weatherCheck.rollingWindow('/q/94541', window, today=later)
+
+        self.assertEqual(wuReplay.REPLAY_STATS['feature:history'], window + 2)
+        self.assertEqual(list(slid), [(later - timedelta(days=back)).strftime('%Y%m%d') for back in range(window, 0, -1)])
+        self.assertEqual(list(slid)[:window - 2], list(days)[2:])
+        self.assertAlmostEqual(slid_total, sum(slid.values()))
+
+        end_day, saved, saved_total = weatherCheck.rollingLoad(weatherCheck.historyStation('/q/94541'), window)
+        self.assertEqual(end_day, later - timedelta(days=1))
+        self.assertEqual(saved, slid)
+
+
+#----------------------------------------------------------------
+class ClimatologyTest(InProcessTestCase):
+
+    def setUp(self):
+        if importlib.util.find_spec('numpy') is None:
+            self.skipTest('--climatology needs numpy')
+        InProcessTestCase.setUp(self)
+
+    def testNormalsByCalendarSlot(self):
+        #   Mar 1 lands in the same slot leap year or not, Feb 29 keeps its own, days never stored count for nothing
+        import numpy
+
+        for day, mean, low, high in ((date(2015, 3, 1), 50.0, 40.0, 61.0), (date(2016, 3, 1), 60.0, 45.0, 70.0),
+                                     (date(2016, 2, 29), 44.0, 30.0, 52.0)):
+            weatherCheck.storeWrite('KTEST', day, {'meantempi': mean, 'mintempi': low, 'maxtempi': high, 'precipi': 0.0, 'conds': ''})
+
+        report = weatherCheck.climatology('KTEST', date(2015, 1, 1), date(2016, 12, 31))
+        march_1 = weatherCheck.climateSlot(date(2015, 3, 1))
+        leap_day = weatherCheck.climateSlot(date(2016, 2, 29))
+
+        self.assertEqual(march_1, leap_day + 1)
+        self.assertEqual(report['count'][march_1], 2)
+        self.assertEqual(report['normal'][march_1], 55.0)
+        self.assertEqual(report['p10'][march_1], 51.0)
+        self.assertEqual(report['p50'][march_1], 55.0)
+        self.assertEqual(report['record_low'][march_1], 40.0)
+        self.assertEqual(report['record_high'][march_1], 70.0)
+        self.assertEqual(report['count'][leap_day], 1)
+        self.assertEqual(report['normal'][leap_day], 44.0)
+        self.assertEqual(report['count'].sum(), 3)
+        self.assertTrue(numpy.isnan(report['normal'][march_1 + 1]))
+
+
+#----------------------------------------------------------------
+class ProjectJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, weatherCheck, 'PROJECT_STREAM_BYTES', weatherCheck.PROJECT_STREAM_BYTES)
+
+    def project(self, text, fields):
+        #   Both ways through projectJson, which have to agree
+        weatherCheck.PROJECT_STREAM_BYTES = len(text)
+        picked = weatherCheck.projectJson(text, fields)
+        weatherCheck.PROJECT_STREAM_BYTES = 0
+        streamed = weatherCheck.projectJson(text, fields)
+        self.assertEqual(picked, streamed)
+        return picked
+
+    def testFieldPaths(self):
+        text = json.dumps({'a': {'b': 1, 'c': [10, {'d': 'x', 'e': 'y'}, 30]}, 'f': [{'g': 1}, {'g': 2, 'h': 3}], 'i': 'skip'})
+
+        self.assertEqual(self.project(text, ['a.b']), {'a': {'b': 1}})
+        self.assertEqual(self.project(text, ['a.c.1.d']), {'a': {'c': [None, {'d': 'x'}]}})
+        self.assertEqual(self.project(text, ['f.*.g']), {'f': [{'g': 1}, {'g': 2}]})
+        self.assertEqual(self.project(text, ['a', 'a.b']), {'a': json.loads(text)['a']})
+        self.assertEqual(self.project(text, ['a.b.deeper', 'nowhere', 'a.c.7']), {'a': {'c': []}})
+
+    def testActionFieldsFromAStandInPayload(self):
+        #   What each action reads comes out of a real sized payload just as json.loads had it
+        payload, recorded = wuReplay.payloadFor(['conditions', 'forecast'], '94541')
+        text = json.dumps(payload)
+        forecast_days = payload['forecast']['simpleforecast']['forecastday']
+
+        current = self.project(text, weatherCheck.ACTION_FIELDS['currenttemp'])
+        self.assertEqual(current, {'current_observation': {'temp_f': payload['current_observation']['temp_f']}})
+
+        good_day = self.project(text, weatherCheck.ACTION_FIELDS['agoodday'])['forecast']['simpleforecast']['forecastday']
+        self.assertEqual(good_day, [{'high': {'fahrenheit': forecast_days[0]['high']['fahrenheit']},
+                                     'conditions': forecast_days[0]['conditions']}])
+
+        three_day = self.project(text, weatherCheck.ACTION_FIELDS['threedayforecast'])
+        self.assertEqual(three_day['forecast']['simpleforecast']['forecastday'], forecast_days)
+
+        best_day = self.project(text, weatherCheck.ACTION_FIELDS['bestday'])['forecast']['simpleforecast']['forecastday']
+        self.assertEqual([day['high'] for day in best_day], [{'fahrenheit': day['high']['fahrenheit']} for day in forecast_days])
+        self.assertEqual([sorted(day['date']) for day in best_day], [['day', 'month', 'year']] * len(forecast_days))
+
+
+#----------------------------------------------------------------
+class QuotaTest(InProcessTestCase):
+
+    def emptyLedger(self):
+        return {'minute': [], 'day': '', 'day_count': 0, 'waiters': dict()}
+
+    def testPriorityOrder(self):
+        #   A background call queued first still goes after an interactive one that turns up later
+        ledger = self.emptyLedger()
+        weatherCheck.API_CALLS_PER_MIN = 1
+        ledger['minute'] = [100.0]
+
+        background = weatherCheck.QUOTA_PRIORITIES['background']
+        interactive = weatherCheck.QUOTA_PRIORITIES['interactive']
+        self.assertGreater(weatherCheck.quotaTry(ledger, 'background', background, 150.0)[0], 0)
+        self.assertGreater(weatherCheck.quotaTry(ledger, 'interactive', interactive, 151.0)[0], 0)
+
+        #   Once the minute has room the interactive call is at the head of the queue, the background one waits on it
+        self.assertGreater(weatherCheck.quotaTry(ledger, 'background', background, 161.0)[0], 0)
+        self.assertEqual(weatherCheck.quotaTry(ledger, 'interactive', interactive, 161.0), (0, ''))
+        self.assertEqual(ledger['minute'], [161.0])
+        self.assertEqual(list(ledger['waiters']), ['background'])
+
+    def testReasonKeepsTheBudget(self):
+        #   Queued behind someone while the minute budget is spent: both show up, and the wait covers the budget
+        ledger = self.emptyLedger()
+        weatherCheck.API_CALLS_PER_MIN = 2
+        ledger['minute'] = [100.0, 110.0]
+
+        weatherCheck.quotaTry(ledger, 'first', 0, 120.0)
+        wait, reason = weatherCheck.quotaTry(ledger, 'second', 0, 120.0)
+
+        self.assertEqual(reason, '2 calls/min budget, 1 queued ahead')
+        self.assertAlmostEqual(wait, (100.0 + 60 - 120.0) + 60.0 / 2)
+
+        weatherCheck.API_CALLS_PER_DAY = 5
+        ledger['day_count'] = 5
+        wait, reason = weatherCheck.quotaTry(ledger, 'second', 0, 120.0)
+        self.assertEqual(reason, '5 calls/day budget, 1 queued ahead')
+
+    def testLongWaitIsReportedNotFatal(self):
+        #   Past what used to be the give-up point the call says how long to expect and waits,
+        #       only --quotamaxwait makes it stop
+        weatherCheck.API_CALLS_PER_MIN = 1
+        weatherCheck.quotaLedger(lambda ledger: ledger['minute'].append(time.time() - 58.5))
+
+        weatherCheck.QUOTA_MAX_WAIT = 0.5
+        with self.assertRaises(RuntimeError) as raised:
+            weatherCheck.rateAcquire()
+        self.assertIn('1 calls/min budget', str(raised.exception))
+
+        weatherCheck.QUOTA_MAX_WAIT = None
+        stderr = sys.stderr
+        sys.stderr = reported = io.StringIO()
+        try:
+            started = time.time()
+            weatherCheck.rateAcquire()
+        finally:
+            sys.stderr = stderr
+
+        self.assertGreater(time.time() - started, 0.5)
+        self.assertIn('Waiting about 2s for Weather Underground quota (1 calls/min budget)', reported.getvalue())
+        booked = weatherCheck.quotaLedger(lambda ledger: (ledger['minute'], ledger['waiters']))
+        self.assertGreater(booked[0][-1], started)
+        self.assertEqual(booked[1], dict())
+
+
+
+#----------------------------------------------------------------
+class BestDayTest(unittest.TestCase):
+
+    def setUp(self):
+        if importlib.util.find_spec('numpy') is None:
+            self.skipTest('--bestday needs numpy')
+
+    def testMissingHighNeverRulesADayOut(self):
+        #   The first day came without a high: it still fits every profile, it just can't beat a day that has one
+        import numpy
+
+        cells = {'location':   numpy.array([0, 0, 0]),
+                 'date':       numpy.array(['2017-03-01', '2017-03-02', '2017-03-03'], dtype='datetime64[D]'),
+                 'high':       numpy.array([numpy.nan, 70.0, 90.0]),
+                 'conditions': numpy.array([0, 0, 0]),
+                 'wind':       numpy.full(3, numpy.nan),
+                 'pop':        numpy.full(3, numpy.nan),
+                 'qpf':        numpy.full(3, numpy.nan),
+                 'vocabulary': ['clear'],
+                 'labels':     ['Clear']}
+        profiles = [{'name': 'anything'},
+                    {'name': 'mild', 'min_temp': 60, 'max_temp': 80},
+                    {'name': 'hot', 'min_temp': 95}]
+
+        best, off_ideal = weatherCheck.bestDays(profiles, cells, ['94541'])
+
+        self.assertEqual(best.tolist(), [0, 1, 0])
+        self.assertEqual(off_ideal[1], 0.0)
+        self.assertTrue(numpy.isnan(off_ideal[0]))
+        self.assertTrue(numpy.isnan(off_ideal[2]))
+
+
+#----------------------------------------------------------------
+class ForecastCellsTest(InProcessTestCase):
+
+    def setUp(self):
+        if importlib.util.find_spec('numpy') is None:
+            self.skipTest('--bestday needs numpy')
+        InProcessTestCase.setUp(self)
+
+    def testFailingLocationIsLeftOutWithWUsDescription(self):
+        #   WU refusing one location drops only its days, and the warning says why
+        with self.assertLogs(level='WARNING') as logged:
+            cells = weatherCheck.forecastCells(['94541', '00000'])
+
+        self.assertEqual(set(cells['location'].tolist()), {0})
+        self.assertIn('No forecast for 00000, leaving it out: Weather Underground error: No cities match your search query',
+                      '\n'.join(logged.output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,712 @@
+################################################################
+#
+#   ******** weatherBench *********
+#
+#   This is a benchmark suite for weatherCheck, run end to end against the wuReplay stand-in so no API quota is spent.
+#       Every workload is a real weatherCheck process (or daemon) and we record, per workload:
+#           wall time (median and best of --repeat runs), throughput, peak memory (the child's own high-water RSS)
+#           and upstream calls made
+#       Results are appended to a json lines file and compared against the last run with the same settings,
+#       so a version that got slower, hungrier or chattier shows up as a regression.
+#
+#   ie;  python weatherBench.py                          (everything, 50ms simulated WU latency)
+#        python weatherBench.py --only batch --repeat 5
+#        python weatherBench.py --check                  (exit 1 on regressions, for CI)
+#
+################################################################
+
+import json
+import sys
+import argparse
+import importlib.util
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from   datetime import date, datetime, timedelta
+from   urllib.request import urlopen
+
+
+#-----------------------------------------------------------------------
+# Globals
+#-----------------------------------------------------------------------
+
+#   Setting up human readable exit codes
+EXIT_STATUS_OK         = 0
+EXIT_STATUS_ERROR      = 1
+
+#   The script under test and the stand-in it talks to, both next to this one
+WEATHER_CHECK          = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weatherCheck.py')
+WU_REPLAY              = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wuReplay.py')
+
+#   Results history, one json line per benchmark run
+RESULTS_FILE           = 'weatherBench_results.jsonl'
+
+#   Simulated Weather Underground round trip, in milliseconds
+BENCH_LATENCY          = 50
+
+#   Timed runs per workload, the median is what gets compared
+BENCH_REPEAT           = 3
+
+#   How much worse than last time (as a share) before we call it a regression. Timings below the noise floor are ignored.
+REGRESSION_THRESHOLD   = 0.15
+REGRESSION_NOISE_S     = 0.05
+
+#   Size of the multi-location and long-range workloads
+BATCH_LOCATIONS        = 50
+LONG_HISTORY_DAYS      = 365
+CLIMATE_YEARS          = 2
+SERVE_REQUESTS         = 400
+SERVE_CLIENTS          = 16
+
+#   projection.history: weatherCheck's field projection run in-process over this many history payloads per --repeat,
+#       next to plain json.loads and the streaming walk it uses for oversized payloads
+PROJECTION_CALLS       = 1000
+
+#   Startup workloads: cached answers timed over this many runs per --repeat (they only take milliseconds),
+#       and the modules that must not be loaded when the answer comes straight out of the cache
+STARTUP_RUNS           = 10
+STARTUP_ACTIONS        = ['currenttemp', 'agoodday', 'pastweekavg']
+STARTUP_UNWANTED       = ['requests', 'urllib3', 'http.server', 'tempfile']
+
+#   Limits handed to weatherCheck so its quota ledger never holds the benchmark back (the stand-in doesn't limit us)
+BENCH_CALLS_PER_MIN    = 1000000
+BENCH_CALLS_PER_DAY    = 100000000
+
+#   The key every benchmark run uses, keeps our ledger apart from real ones
+BENCH_API_KEY          = 'weatherbench'
+
+#   Peak memory has to come from the child itself: Linux carries a parent's high-water mark into a forked child's
+#       ru_maxrss (across exec too), so wait4 can never report less than this harness uses. Measured commands run
+#       under this wrapper instead, which runs the python command line it's handed (script, -m module or -c code)
+#       in-process and at exit writes its own peak in KB (VmHWM, a fresh count since exec, or ru_maxrss where there's
+#       no /proc) to the file named by its first argument. A SIGTERM still gets it there, for the daemon.
+PEAK_WRAPPER           = r"""
+import os, runpy, signal, sys
+
+def peakKb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def stop(signum, frame):
+    sys.exit(128 + signum)
+
+peak_path = sys.argv[1]
+signal.signal(signal.SIGTERM, stop)
+try:
+    if sys.argv[2] == '-m':
+        sys.argv = [sys.argv[3]] + sys.argv[4:]
+        runpy.run_module(sys.argv[0], run_name='__main__', alter_sys=True)
+    elif sys.argv[2] == '-c':
+        code = sys.argv[3]
+        sys.argv = ['-c'] + sys.argv[4:]
+        exec(compile(code, '<string>', 'exec'), {'__name__': '__main__'})
+    else:
+        sys.argv = sys.argv[2:]
+        sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+        runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    peak = peakKb()
+    if peak is not None:
+        with open(peak_path, 'w') as peak_file:
+            peak_file.write(str(peak))
+"""
+
+
+#-----------------------------------------------------------------------
+# Functions
+#-----------------------------------------------------------------------
+
+def replayStats(wu_url, reset=False):
+    #   This def reads (or resets) the stand-in's request tallies
+
+    base = wu_url[:-len('/api/')]
+    with urlopen('%s/%s' % (base, '_reset' if reset else '_stats')) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+#----------------------------------------------------------------
+def freePort():
+    #   This def asks the OS for a port nobody is listening on, for the daemon under test
+
+    probe = socket.socket()
+    try:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+    finally:
+        probe.close()
+
+
+#----------------------------------------------------------------
+def startReplay(latency):
+    #   This def starts wuReplay in its own process and returns (process, base API URL) once it answers
+    #       Kept out of our process on purpose, so its work doesn't compete with our timing
+
+    port = freePort()
+    replay = subprocess.Popen([sys.executable, WU_REPLAY, '--port', str(port), '--latency', str(latency)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wu_url = 'http://127.0.0.1:%s/api/' % port
+
+    for i in range(100):
+        try:
+            replayStats(wu_url)
+            return replay, wu_url
+        except OSError:
+            time.sleep(0.05)
+
+    replay.terminate()
+    raise OSError("wuReplay never came up on port %s" % port)
+
+
+#----------------------------------------------------------------
+def peakArgs(argv, peak_path):
+    #   This def wraps a python command line in PEAK_WRAPPER, so it reports its own peak memory to peak_path
+
+    return [argv[0], '-c', PEAK_WRAPPER, peak_path] + list(argv[1:])
+
+
+#----------------------------------------------------------------
+def peakRead(peak_path):
+    #   This def collects (and removes) what PEAK_WRAPPER left in peak_path, the peak RSS in KB or None
+
+    try:
+        with open(peak_path) as peak_file:
+            return int(peak_file.read().strip())
+    except (OSError, ValueError):
+        return None
+    finally:
+        if os.path.exists(peak_path):
+            os.remove(peak_path)
+
+
+#----------------------------------------------------------------
+def peakFile():
+    #   This def makes an empty file for PEAK_WRAPPER to report into
+
+    handle, peak_path = tempfile.mkstemp(prefix='weatherBench_peak_')
+    os.close(handle)
+    return peak_path
+
+
+#----------------------------------------------------------------
+def runProcess(argv, cwd=None, env=None, memory=False):
+    #   This def runs one command to completion and returns (wall seconds, peak RSS in KB or None, exit status, output)
+    #       With memory, argv (a python command line) runs under PEAK_WRAPPER so the peak is that process's own
+
+    peak_path = None
+    if memory:
+        peak_path = peakFile()
+        argv = peakArgs(argv, peak_path)
+
+    started = time.perf_counter()
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd, env=env)
+    output = process.communicate()[0]
+    elapsed = time.perf_counter() - started
+
+    peak_kb = peakRead(peak_path) if peak_path else None
+
+    return elapsed, peak_kb, process.returncode, output.decode('utf-8', 'replace')
+
+
+#----------------------------------------------------------------
+def checkArgs(wu_url, cache_dir, *args):
+    #   This def builds a weatherCheck command line pointed at the stand-in and a benchmark cache dir
+
+    return [sys.executable, WEATHER_CHECK, '--wuurl', wu_url, '--cachedir', cache_dir, '--apikey', BENCH_API_KEY,
+            '--callspermin', str(BENCH_CALLS_PER_MIN), '--callsperday', str(BENCH_CALLS_PER_DAY)] + list(args)
+
+
+#----------------------------------------------------------------
+def batchFile(work_dir, actions):
+    #   This def writes a batch file of BATCH_LOCATIONS zipcodes, each asking for the given actions
+
+    path = os.path.join(work_dir, 'batch_%s.txt' % '_'.join(actions))
+    with open(path, 'w') as batch:
+        for i in range(BATCH_LOCATIONS):
+            batch.write('%05d,%s\n' % (10001 + i * 37, ','.join(actions)))
+    return path
+
+
+#----------------------------------------------------------------
+def workloads(work_dir):
+    #   This def lists every workload as {name: (argument builder, items done per run, unit, warm)}
+    #       The argument builder takes (wu_url, cache_dir). Warm workloads run once untimed first so they're
+    #       measured against a primed cache, cold ones get an empty cache dir every run.
+
+    actions = ['currenttemp', 'agoodday', 'threedayforecast', 'pastweekavg', 'pastweekdailyavg']
+    location_actions = ['currenttemp', 'agoodday', 'threedayforecast']
+    first_day = date.today() - timedelta(days=365 * CLIMATE_YEARS)
+    climate_range = '%s-%s' % (first_day.strftime('%Y%m%d'), (date.today() - timedelta(days=1)).strftime('%Y%m%d'))
+
+    plan = dict()
+
+    #   Each CLI action on its own, from nothing and from cache
+    for action in actions:
+        for warm in (False, True):
+            plan['%s.%s' % (action, 'warm' if warm else 'cold')] = (
+                lambda wu_url, cache_dir, action=action: checkArgs(wu_url, cache_dir, '--zipcode', '94541', '--%s' % action),
+                1, 'runs', warm)
+
+    plan['allactions.cold'] = (
+        lambda wu_url, cache_dir: checkArgs(wu_url, cache_dir, '--zipcode', '94541', *['--%s' % action for action in actions]),
+        1, 'runs', False)
+
+    #   Many locations through batch mode
+    for warm in (False, True):
+        plan['batch%s.%s' % (BATCH_LOCATIONS, 'warm' if warm else 'cold')] = (
+            lambda wu_url, cache_dir: checkArgs(wu_url, cache_dir, '--batch', batchFile(work_dir, location_actions)),
+            BATCH_LOCATIONS, 'locations', warm)
+
+    #   A long history window, pulled day by day then read back out of the store
+    for warm in (False, True):
+        plan['history%s.%s' % (LONG_HISTORY_DAYS, 'warm' if warm else 'cold')] = (
+            lambda wu_url, cache_dir: checkArgs(wu_url, cache_dir, '--zipcode', '94541', '--pastweekavg', '--historydays', str(LONG_HISTORY_DAYS)),
+            LONG_HISTORY_DAYS, 'days', warm)
+
+    #   Years of history for two stations through the climatology report (needs numpy)
+    for warm in (False, True):
+        plan['climatology%sy.%s' % (CLIMATE_YEARS, 'warm' if warm else 'cold')] = (
+            lambda wu_url, cache_dir: checkArgs(wu_url, cache_dir, '--climatology', climate_range, '--locations', '94541,10001', '--backfill'),
+            2 * 365 * CLIMATE_YEARS, 'days', warm)
+
+    return plan
+
+
+#----------------------------------------------------------------
+def measure(name, build, items, unit, warm, wu_url, repeat):
+    #   This def runs one workload 'repeat' times and boils the runs down to a result dict
+
+    walls = []
+    peaks = []
+    calls = []
+    cache_dir = tempfile.mkdtemp(prefix='weatherBench_')
+
+    try:
+        if warm:
+            wall, peak_kb, status, output = runProcess(build(wu_url, cache_dir))
+            if status != 0:
+                return {'error': output.strip().splitlines()[-1:] or ['exit status %s' % status]}
+
+        for i in range(repeat):
+            if not warm:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                os.makedirs(cache_dir)
+
+            replayStats(wu_url, reset=True)
+            wall, peak_kb, status, output = runProcess(build(wu_url, cache_dir), memory=True)
+            if status != 0:
+                return {'error': output.strip().splitlines()[-1:] or ['exit status %s' % status]}
+
+            walls.append(wall)
+            peaks.append(peak_kb)
+            calls.append(replayStats(wu_url).get('requests', 0))
+
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    median = statistics.median(walls)
+    return {'wall_s_median': round(median, 4), 'wall_s_min': round(min(walls), 4),
+            'throughput': round(items / median, 2) if median else None, 'unit': '%s/s' % unit,
+            'peak_rss_kb': max(peaks) if None not in peaks else None,
+            'upstream_calls': max(calls)}
+
+
+#----------------------------------------------------------------
+def measureServe(wu_url, repeat):
+    #   This def benchmarks the --serve daemon: SERVE_REQUESTS requests from SERVE_CLIENTS threads across a handful
+    #       of locations and actions, reporting requests/s, the slowest request and the daemon's peak memory
+
+    cache_dir = tempfile.mkdtemp(prefix='weatherBench_')
+    port = freePort()
+
+    actions = ['currenttemp', 'agoodday', 'threedayforecast', 'pastweekavg']
+    locations = ['94541', '10001', '60601', '98101', '33101']
+    paths = ['/%s?location=%s' % (actions[i % len(actions)], locations[i % len(locations)]) for i in range(SERVE_REQUESTS)]
+
+    replayStats(wu_url, reset=True)
+    peak_path = peakFile()
+    daemon = subprocess.Popen(peakArgs(checkArgs(wu_url, cache_dir, '--serve', str(port)), peak_path),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    walls = []
+    slowest = 0.0
+    try:
+        #   Waiting for the daemon to come up
+        for i in range(100):
+            try:
+                urlopen('http://127.0.0.1:%s/health' % port).read()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            return {'error': ['daemon never came up on port %s' % port]}
+
+        for i in range(repeat):
+            pending = list(paths)
+            lock = threading.Lock()
+            latencies = []
+
+            def client():
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        path = pending.pop()
+                    started = time.perf_counter()
+                    urlopen('http://127.0.0.1:%s%s' % (port, path)).read()
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            clients = [threading.Thread(target=client) for c in range(SERVE_CLIENTS)]
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            walls.append(time.perf_counter() - started)
+            slowest = max(slowest, max(latencies))
+
+        calls = replayStats(wu_url).get('requests', 0)
+
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        peak_kb = peakRead(peak_path)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    median = statistics.median(walls)
+    return {'wall_s_median': round(median, 4), 'wall_s_min': round(min(walls), 4),
+            'throughput': round(SERVE_REQUESTS / median, 2), 'unit': 'requests/s',
+            'slowest_request_s': round(slowest, 4), 'peak_rss_kb': peak_kb, 'upstream_calls': calls}
+
+
+#----------------------------------------------------------------
+def measureProjection(repeat):
+    #   This def times decoding one history payload (as the stand-in makes them) the three ways there are:
+    #       json.loads of the whole thing, projectJson with HISTORY_FIELDS as apiPoll calls it, and the streaming
+    #       walk projectJson keeps for payloads past PROJECT_STREAM_BYTES. Reports each one's time per payload
+    #       and peak allocation (tracemalloc), the projectJson run is the one compared between benchmark runs.
+    import tracemalloc
+
+    sys.path.insert(0, os.path.dirname(WEATHER_CHECK))
+    import weatherCheck
+    import wuReplay
+
+    payload = {'response': {'version': '0.1', 'features': {'history': 1}},
+               'history': wuReplay.syntheticHistory('KHWD', date.today() - timedelta(days=1))}
+    text = json.dumps(payload)
+    fields = weatherCheck.HISTORY_FIELDS + ['response.error']
+
+    def stream():
+        trie = weatherCheck.fieldTrie(fields)
+        return weatherCheck.jsonProject(text, weatherCheck.jsonSkipSpace(text, 0), trie, True)[0]
+
+    ways = [('json.loads', lambda: json.loads(text)), ('projectJson', lambda: weatherCheck.projectJson(text, fields)),
+            ('streaming', stream)]
+
+    compare = dict()
+    walls = []
+    for label, decode in ways:
+        timings = []
+        for i in range(repeat):
+            started = time.perf_counter()
+            for call in range(PROJECTION_CALLS):
+                decode()
+            timings.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        decode()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        compare[label] = {'ms': round(statistics.median(timings) / PROJECTION_CALLS * 1000, 4), 'peak_kb': round(peak / 1024, 1)}
+        if label == 'projectJson':
+            walls = timings
+
+    median = statistics.median(walls)
+    return {'wall_s_median': round(median, 4), 'wall_s_min': round(min(walls), 4),
+            'throughput': round(PROJECTION_CALLS / median, 2), 'unit': 'payloads/s',
+            'peak_rss_kb': None, 'upstream_calls': 0, 'payload_bytes': len(text), 'compare': compare}
+
+
+#----------------------------------------------------------------
+def importedModules(args, cwd):
+    #   This def runs python with 'args' under -X importtime and returns the set of module names it imported
+
+    output = runProcess([sys.executable, '-X', 'importtime'] + args, cwd=cwd)[3]
+    return set(line.rsplit('|', 1)[-1].strip() for line in output.splitlines() if line.startswith('import time:'))
+
+
+#----------------------------------------------------------------
+def measureStartup(action, wu_url, repeat):
+    #   This def times a cached answer from process start to exit, the way a shell prompt or status bar would call it
+    #       Runs go through 'python -m weatherCheck' so the script's bytecode comes out of __pycache__ like any
+    #       installed module (PYTHONDONTWRITEBYTECODE is dropped so it can be written), and we report how far above
+    #       a bare 'python -c pass' (timed alongside, under the same PEAK_WRAPPER) it lands.
+    #       One extra run under -X importtime tells us whether any of STARTUP_UNWANTED got loaded (by us, not by
+    #       the interpreter's own startup - site hooks in some environments pull in tempfile and friends).
+
+    cache_dir = tempfile.mkdtemp(prefix='weatherBench_')
+    module_dir = os.path.dirname(WEATHER_CHECK)
+    env = dict((name, value) for name, value in os.environ.items() if name != 'PYTHONDONTWRITEBYTECODE')
+    argv = [sys.executable, '-m', 'weatherCheck'] + checkArgs(wu_url, cache_dir, '--zipcode', '94541', '--%s' % action)[2:]
+
+    walls = []
+    bare = []
+    peaks = []
+    try:
+        #   Priming the cache (and __pycache__), then making sure the answers really come from there
+        wall, peak_kb, status, output = runProcess(argv, cwd=module_dir, env=env)
+        if status != 0:
+            return {'error': output.strip().splitlines()[-1:] or ['exit status %s' % status]}
+        replayStats(wu_url, reset=True)
+
+        #   Interleaving the two so machine noise hits both alike
+        for i in range(repeat * STARTUP_RUNS):
+            bare.append(runProcess([sys.executable, '-c', 'pass'], env=env, memory=True)[0])
+            wall, peak_kb, status, output = runProcess(argv, cwd=module_dir, env=env, memory=True)
+            if status != 0:
+                return {'error': output.strip().splitlines()[-1:] or ['exit status %s' % status]}
+            walls.append(wall)
+            peaks.append(peak_kb)
+
+        imported = importedModules(argv[1:], module_dir) - importedModules(['-c', 'pass'], module_dir)
+        calls = replayStats(wu_url).get('requests', 0)
+
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    median = statistics.median(walls)
+    return {'wall_s_median': round(median, 4), 'wall_s_min': round(min(walls), 4),
+            'throughput': round(1 / median, 2), 'unit': 'runs/s',
+            'overhead_ms': round((median - statistics.median(bare)) * 1000, 1),
+            'unwanted_imports': sorted(module for module in STARTUP_UNWANTED if module in imported),
+            'peak_rss_kb': max(peaks) if None not in peaks else None,
+            'upstream_calls': calls}
+
+
+#----------------------------------------------------------------
+def benchVersion():
+    #   This def names the version under test, the git commit when there is one
+
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(WEATHER_CHECK),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+#----------------------------------------------------------------
+def previousRun(results_file, settings):
+    #   This def finds the last recorded run with the same settings, regressions are only judged like for like
+
+    previous = None
+    if not os.path.exists(results_file):
+        return None
+
+    with open(results_file) as results:
+        for line in results:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if run.get('settings') == settings:
+                previous = run
+
+    return previous
+
+
+#----------------------------------------------------------------
+def regressions(current, previous):
+    #   This def lists what got worse since 'previous': slower past the threshold (and the noise floor),
+    #       more memory past the threshold, or more upstream calls than before
+
+    found = []
+    for name, result in sorted(current['results'].items()):
+        before = previous['results'].get(name)
+        if not before or 'error' in before or 'error' in result:
+            continue
+
+        if result['wall_s_median'] > before['wall_s_median'] * (1 + REGRESSION_THRESHOLD) and \
+           result['wall_s_median'] - before['wall_s_median'] > REGRESSION_NOISE_S:
+            found.append("%s: %.3fs -> %.3fs" % (name, before['wall_s_median'], result['wall_s_median']))
+
+        if result.get('peak_rss_kb') and before.get('peak_rss_kb') and \
+           result['peak_rss_kb'] > before['peak_rss_kb'] * (1 + REGRESSION_THRESHOLD):
+            found.append("%s: peak memory %s KB -> %s KB" % (name, before['peak_rss_kb'], result['peak_rss_kb']))
+
+        if result['upstream_calls'] > before['upstream_calls']:
+            found.append("%s: upstream calls %s -> %s" % (name, before['upstream_calls'], result['upstream_calls']))
+
+        #   A cached answer that starts loading the network stack again is a regression whatever the clock says
+        creeping = set(result.get('unwanted_imports', [])) - set(before.get('unwanted_imports', []))
+        if creeping:
+            found.append("%s: now imports %s" % (name, ', '.join(sorted(creeping))))
+
+    return found
+
+
+#----------------------------------------------------------------
+def printResult(name, result, before):
+    #   This def prints one workload's line, with the change since the previous run when we have one
+
+    if 'error' in result:
+        print("   %-26s FAILED: %s" % (name, ' '.join(result['error'])))
+        return
+
+    change = ''
+    if before and 'error' not in before and before['wall_s_median']:
+        change = '%+6.1f%%' % ((result['wall_s_median'] / before['wall_s_median'] - 1) * 100)
+
+    print("   %-26s %9.3fs %7s %12.1f %-12s %9s KB %7s calls" % (
+        name, result['wall_s_median'], change, result['throughput'], result['unit'],
+        result['peak_rss_kb'] if result['peak_rss_kb'] is not None else '-', result['upstream_calls']))
+
+    if 'compare' in result:
+        print("   %-26s %s bytes: %s" % ('', result['payload_bytes'], ', '.join(
+              '%s %0.3fms (%s KB)' % (label, way['ms'], way['peak_kb']) for label, way in result['compare'].items())))
+
+    if 'overhead_ms' in result:
+        print("   %-26s %+8.1fms over bare python%s" % ('', result['overhead_ms'],
+              ', imports %s' % ', '.join(result['unwanted_imports']) if result['unwanted_imports'] else ''))
+
+
+#--------------------------------  Yay running stuff!
+# Main
+#-----------------------------------------------------------
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark weatherCheck against the wuReplay stand-in")
+
+    parser.add_argument("--only",
+                    help="Comma separated workload name fragments to run, ie; 'batch,serve'",
+                    action="store", default=False)
+
+    parser.add_argument("--list",
+                    help="List the workloads and exit",
+                    action="store_true", default=False)
+
+    parser.add_argument("--repeat",
+                    help="Timed runs per workload (defaults to %s)" % BENCH_REPEAT,
+                    action="store", type=int, default=BENCH_REPEAT)
+
+    parser.add_argument("--latency",
+                    help="Simulated Weather Underground latency in milliseconds (defaults to %s)" % BENCH_LATENCY,
+                    action="store", type=float, default=BENCH_LATENCY)
+
+    parser.add_argument("--results",
+                    help="Json lines file results are appended to and compared against (defaults to %s)" % RESULTS_FILE,
+                    action="store", default=RESULTS_FILE)
+
+    parser.add_argument("--nosave",
+                    help="Compare against earlier results but don't record this run",
+                    action="store_true", default=False)
+
+    parser.add_argument("--check",
+                    help="Exit with an error when anything regressed since the last comparable run",
+                    action="store_true", default=False)
+
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        print("Error: repeat must be at least 1, got %s" % args.repeat)
+        return EXIT_STATUS_ERROR
+
+    work_dir = tempfile.mkdtemp(prefix='weatherBench_')
+    plan = workloads(work_dir)
+    names = sorted(plan) + ['serve%s' % SERVE_REQUESTS] + ['startup.%s' % action for action in STARTUP_ACTIONS] + ['projection.history']
+
+    #   Climatology reports need numpy (in the weatherCheck runs, not here), without it those workloads can't run at all
+    if importlib.util.find_spec('numpy') is None:
+        names = [name for name in names if not name.startswith('climatology')]
+
+    if args.only:
+        wanted = [fragment.strip() for fragment in args.only.split(',') if fragment.strip()]
+        names = [name for name in names if any(fragment in name for fragment in wanted)]
+
+    if args.list:
+        for name in names:
+            print(name)
+        return EXIT_STATUS_OK
+
+    if not names:
+        print("Error: no workloads match %s" % args.only)
+        return EXIT_STATUS_ERROR
+
+    try:
+        replay, wu_url = startReplay(args.latency)
+    except OSError as e:
+        print("Error: %s" % e)
+        return EXIT_STATUS_ERROR
+
+    #   peak_memory: results from before peaks were measured in the child (see PEAK_WRAPPER) aren't comparable
+    settings = {'latency_ms': args.latency, 'repeat': args.repeat, 'python': platform.python_version(),
+                'batch_locations': BATCH_LOCATIONS, 'history_days': LONG_HISTORY_DAYS,
+                'climate_years': CLIMATE_YEARS, 'serve_requests': SERVE_REQUESTS, 'startup_runs': STARTUP_RUNS,
+                'peak_memory': 'child', 'projection_calls': PROJECTION_CALLS}
+    previous = previousRun(args.results, settings)
+    current = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'version': benchVersion(),
+               'platform': platform.platform(), 'settings': settings, 'results': dict()}
+
+    print("Benchmarking %s against wuReplay (%sms latency, %s runs each)" % (current['version'], args.latency, args.repeat))
+    if previous:
+        print("Comparing with %s from %s" % (previous['version'], previous['timestamp']))
+    print("\n   %-26s %10s %7s %12s %-12s %12s %13s" % ('workload', 'median', 'change', 'throughput', '', 'peak mem', 'upstream'))
+
+    try:
+        for name in names:
+            if name in plan:
+                build, items, unit, warm = plan[name]
+                result = measure(name, build, items, unit, warm, wu_url, args.repeat)
+            elif name.startswith('startup.'):
+                result = measureStartup(name[len('startup.'):], wu_url, args.repeat)
+            elif name == 'projection.history':
+                result = measureProjection(args.repeat)
+            else:
+                result = measureServe(wu_url, args.repeat)
+
+            current['results'][name] = result
+            printResult(name, result, previous['results'].get(name) if previous else None)
+
+    finally:
+        replay.terminate()
+        replay.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not args.nosave:
+        with open(args.results, 'a') as results:
+            results.write(json.dumps(current, sort_keys=True) + '\n')
+
+    found = regressions(current, previous) if previous else []
+    failed = [name for name, result in current['results'].items() if 'error' in result]
+
+    if found:
+        print("\nRegressions since %s:" % previous['version'])
+        for line in found:
+            print("   %s" % line)
+    elif previous:
+        print("\nNo regressions since %s" % previous['version'])
+
+    if args.check and (found or failed):
+        return EXIT_STATUS_ERROR
+
+    return EXIT_STATUS_OK
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,14 +10,29 @@
 # Copyright 2015 Shaun Potts
 ################################################################
 
-import requests
+#   The network stack (requests/urllib3), the daemon's http.server, logging, concurrent.futures, tempfile, getpass, csv,
+#       hashlib and random are imported where they're used so answers straight out of the cache never pay for loading them
 import json
 import datetime
-import getpass
 from   datetime import date, timedelta
 import sys
 import argparse
-import logging
+import os
+import re
+import time
+import sqlite3
+import threading
+import mmap
+import struct
+from   collections import Counter, OrderedDict
+import itertools
+
+#   File locking for the shared quota ledger, fcntl on POSIX and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
 #-----------------------------------------------------------------------
@@ -31,14 +46,14 @@ EXIT_STATUS_ERROR      = 1
 # Getting date
 THIS_DAY = date.today()
 
-#   Getting USER_NAME
-USER_NAME = getpass.getuser()
+#   Getting USER_NAME, looked up by userName() the first time a message needs it
+USER_NAME = None
 
 #   Number of days to pull down from Weather Underground (Cold have a CLI flag to change this)
 #       NOTE:  Weather Underground.com limits you to 10 calls/min, a cache needs to be utilized
 DAYS_2_GET_HISTORICALS = 7
 
-#   Setting up Weather Underground URL
+#   Setting up Weather Underground URL (--wuurl points us somewhere else, ie; the wuReplay stand-in)
 WU_URL = 'http://api.wunderground.com/api/'
 
 #   This is my API key, but could be swapped via CLI if we wanted another user
@@ -53,16 +68,96 @@ PREF_TEMP = 68
 #   Static preferred condition for "A good day to get out"
 PREF_COND = 'Partly Cloudy'
 
+#   --bestday scores every preference profile against every forecast day at once, this many profiles per numpy pass
+#       (each pass holds a profiles x days matrix or two, so this bounds the memory thousands of profiles need)
+BESTDAY_CHUNK = 4096
+
+#   What a --bestday profile line may hold besides its name (see readProfiles)
+PROFILE_LIMITS = ['min_temp', 'max_temp', 'ideal_temp', 'max_wind', 'max_pop', 'max_qpf']
+PROFILE_LISTS  = ['conditions', 'locations']
+
 #   Temporary location used for testing
 #       NOTE: This can also be a zipcode '/q/94541.json' , I verified it pulled the same station KHWD
 #               IF the zipcode can be verified it's no problem to run it.
 LOCATION_QUERY = '/q/CA/San Jose'
+LOCATION_NAME  = 'San Jose, CA'
 
 #   This var will allow for us to switch out data types from json if desired
 URL_EXTENSION = '.json'
 
-#   Temporary flag tossed for testing (Output should be human readable or json by request)
+#   Local daily history store: one memory-mapped column file per field per station, indexed by days since STORE_EPOCH
+#       so any date range is a straight slice. historyLookup only asks WU for the days the store doesn't have yet.
+#       STORE_DIR of None keeps it in a 'history' folder inside CACHE_DIR
+STORE_ENABLED                 = True
+STORE_DIR                     = None
+STORE_EPOCH                   = date(1940, 1, 1)
+STORE_GROW_DAYS               = 366
+STORE_COLUMNS                 = [('meantempi', 'f'), ('mintempi', 'f'), ('maxtempi', 'f'), ('precipi', 'f'),
+                                 ('conds', 'H'), ('have', 'B')]
+STORE_STATIONS                = dict()
+STORE_LOCK                    = threading.Lock()
+
+#   Climatology report settings: percentiles of the daily mean temp reported for each day of the year
+CLIMATE_PERCENTILES           = [10, 50, 90]
+
+#   numpy dtypes matching the STORE_COLUMNS typecodes, climatology reads the column files straight into arrays
+STORE_NUMPY_TYPES             = {'f': 'float32', 'H': 'uint16', 'B': 'uint8'}
+
+#   Persisted rolling-window aggregates behind --pastweekavg/--pastweekdailyavg (kept in the cache db)
+ROLLING_ENABLED               = True
+
+#   Pieces of the stdlib json decoder projectJson uses to walk payloads without building what it skips
+JSON_DECODER                  = json.JSONDecoder()
+JSON_SCANSTRING               = json.decoder.scanstring
+JSON_WHITESPACE               = re.compile(r'[ \t\n\r]*')
+JSON_MISSING                  = object()
+
+#   Payloads up to this size are decoded whole by json's C decoder and then picked through, several times less CPU
+#       than walking the text in Python. Only bigger ones get the streaming walk, which never builds what it skips
+PROJECT_STREAM_BYTES          = 1024 * 1024
+
+#   Zip/city -> reporting station resolution, so '/q/94541' and '/q/CA/Hayward' share requests and cache entries as '/q/KHWD'
+#       Lookups go through WU's geolookup once, then live in the cache db. STATION_TABLE_FILE is an optional
+#       offline 'location,station' csv checked before spending any API calls.
+RESOLVE_STATIONS              = True
+STATION_TABLE_FILE            = None
+STATION_TTL                   = 30 * 24 * 60 * 60
+#   Locations WU couldn't place are remembered as themselves for STATION_MISS_TTL so they stop costing a geolookup every run,
+#       a lookup that failed outright (network trouble, quota) is only remembered for the rest of this process
+STATION_MISS_TTL              = 24 * 60 * 60
+STATION_INDEX                 = None
+STATION_LOCK                  = threading.Lock()
+
+#   Which WU features each location-based CLI action reads. The query planner merges these into one chained request.
+#       FEATURE_ORDER keeps chained URLs stable so they land on the same cache entry run to run
+ACTION_FEATURES = {'currenttemp':      ['conditions'],
+                   'agoodday':         ['forecast'],
+                   'threedayforecast': ['forecast'],
+                   'bestday':          ['forecast']}
+FEATURE_ORDER   = ['conditions', 'forecast']
+
+#   Fields each action actually reads, apiPoll only decodes these out of the payload
+HISTORY_FIELDS  = ['history.dailysummary.0.meantempi', 'history.dailysummary.0.mintempi', 'history.dailysummary.0.maxtempi',
+                   'history.dailysummary.0.precipi', 'history.observations.*.conds']
+ACTION_FIELDS   = {'currenttemp':      ['current_observation.temp_f'],
+                   'agoodday':         ['forecast.simpleforecast.forecastday.0.high.fahrenheit',
+                                        'forecast.simpleforecast.forecastday.0.conditions'],
+                   'threedayforecast': ['forecast.simpleforecast.forecastday.*'],
+                   'bestday':          ['forecast.simpleforecast.forecastday.*.%s' % field for field in
+                                        ('date.year', 'date.month', 'date.day', 'high.fahrenheit', 'conditions',
+                                         'avewind.mph', 'pop', 'qpf_allday.in')]}
+
+#   Every action a batch file line may ask for, history ones are served by lookAtHistory
+VALID_ACTIONS   = ['currenttemp', 'agoodday', 'threedayforecast', 'pastweekavg', 'pastweekdailyavg']
+HISTORY_ACTIONS = ['pastweekavg', 'pastweekdailyavg']
+
+#   Number of unique batch queries we'll have in flight at once (the rate limiter still has the final say)
+BATCH_WORKERS   = 8
+
+#   Output should be human readable or json by request (--json). Json goes out as one record per line (NDJSON),
+#       each written and flushed the moment it's known, so a long history range starts flowing after its first day
 OUTPUT_JSON = False
+OUTPUT_LOCK = threading.Lock()
 OUTPUT_AVG_HIST_7_DAY_TOTAL   = False
 OUTPUT_AVG_HIST_7_DAY_BY_DAY  = False
 
@@ -70,6 +165,173 @@ OUTPUT_CURRENT_TEMP           = False
 OUTPUT_GOOD_DAY               = False
 OUTPUT_THREE_DAY_FORECAST     = False
 
+#   Response cache settings (apiPoll checks here before spending any of our API quota)
+#       Keys are the assembled query URL with the API key stripped out, so swapping keys doesn't waste the cache
+CACHE_ENABLED                 = True
+#       CACHE_DIR of None is worked out by main as a 'weatherCheck_cache' folder in the system temp dir
+CACHE_DIR                     = None
+CACHE_DB_NAME                 = 'responses.sqlite3'
+
+#   Seconds a payload stays fresh. History for days that are already over never changes, so it never expires.
+CACHE_TTL_CONDITIONS          = 10 * 60
+CACHE_TTL_FORECAST            = 60 * 60
+CACHE_TTL_HISTORY_TODAY       = 10 * 60
+
+#   Total size cap for cached payloads, least recently used entries get evicted past this
+CACHE_MAX_BYTES               = 64 * 1024 * 1024
+
+#   A cache hit only writes its new access time back when the old one is older than this, so answering
+#       from the cache is normally a read-only trip to sqlite (LRU order to the minute is plenty)
+CACHE_TOUCH_INTERVAL          = 60
+
+#   Open sqlite connection to the cache, set up on first use by cacheOpen()
+CACHE_CONN                    = None
+
+#   Serializes cache access, history days are fetched from worker threads sharing the one connection
+CACHE_LOCK                    = threading.Lock()
+
+#   In-process copy of the hottest cache entries in front of sqlite, {key: (body, expires, fetched)} in LRU order
+MEMORY_CACHE                  = OrderedDict()
+MEMORY_CACHE_ENTRIES          = 256
+
+#   Stale-while-revalidate for conditions/forecast: past its TTL a cached payload is still served (marked with its age)
+#       for up to CACHE_MAX_STALE more seconds while a background refresh replaces it
+STALE_ENABLED                 = True
+CACHE_MAX_STALE               = 3 * 60 * 60
+STALE_AGE_KEY                 = '_stale_age'
+REFRESHES                     = []
+REFRESH_LOCK                  = threading.Lock()
+
+#   A one-shot run never waits on its refreshes: they're queued in REFRESH_PENDING and handed to a detached child process
+#       at exit, so whoever called us gets our exit (and the end of our output) as soon as the answer is out.
+#       The daemon refreshes on background threads, as do one-shot runs where there's no fork, which then wait at most
+#       REFRESH_EXIT_WAIT seconds in all for them before exiting
+REFRESH_DETACH                = hasattr(os, 'fork')
+REFRESH_PENDING               = dict()
+REFRESH_EXIT_WAIT             = 1.0
+
+#   Payload archive (--archive): every good payload pulled from WU is trimmed to ARCHIVE_FIELDS for its feature and
+#       appended to one data file in compressed blocks (zlib or lzma), with a sqlite index of (station, feature, day) ->
+#       (block offset, item) for random access. Nothing is rewritten in place: a newer payload for a key lands at the end
+#       and the index follows it. ARCHIVE_DIR of None keeps it in an 'archive' folder inside CACHE_DIR
+ARCHIVE_ENABLED               = False
+ARCHIVE_DIR                   = None
+ARCHIVE_DATA_NAME             = 'payloads.wca'
+ARCHIVE_INDEX_NAME            = 'index.sqlite3'
+ARCHIVE_CODEC                 = 'zlib'
+ARCHIVE_CODECS                = {'zlib': 0, 'lzma': 1}
+
+#   Blocks are compressed once they hold this many bytes of records, queued records are also written at exit
+#       and whenever the oldest has waited ARCHIVE_FLUSH_AFTER seconds (prefetch/serve run for a long time)
+ARCHIVE_BLOCK_BYTES           = 256 * 1024
+ARCHIVE_FLUSH_AFTER           = 5 * 60
+
+#   Block header: magic, codec, compressed bytes, raw bytes, records
+ARCHIVE_MAGIC                 = b'WCA1'
+ARCHIVE_HEADER                = struct.Struct('>4sBIII')
+
+#   Field paths kept per feature (see projectJson), None keeps the whole payload. Features not listed aren't archived.
+#       --archivefields swaps in a json file of {feature: [paths]}
+ARCHIVE_FIELDS                = {'history':    ['history.date', 'history.dailysummary'] +
+                                               ['history.observations.*.%s' % field for field in
+                                                ('utcdate.epoch', 'tempi', 'dewpti', 'hum', 'wspdi', 'wdird',
+                                                 'pressurei', 'precipi', 'conds')],
+                                 'conditions': ['current_observation.%s' % field for field in
+                                                ('station_id', 'observation_epoch', 'weather', 'temp_f', 'dewpoint_f',
+                                                 'relative_humidity', 'wind_mph', 'wind_degrees', 'pressure_in',
+                                                 'precip_today_in')],
+                                 'forecast':   ['forecast.simpleforecast.forecastday.*.%s' % field for field in
+                                                ('date.epoch', 'date.year', 'date.month', 'date.day', 'high', 'low',
+                                                 'conditions', 'pop', 'qpf_allday', 'snow_allday', 'avewind',
+                                                 'maxwind', 'avehumidity')]}
+
+#   Records waiting to make up a block, [(station, feature, day, fetched, record json)], and the archive index connection
+ARCHIVE_PENDING               = []
+ARCHIVE_PENDING_SINCE         = None
+ARCHIVE_LOCK                  = threading.Lock()
+ARCHIVE_CONN                  = None
+
+#   Upstream calls currently in flight, so concurrent identical queries wait on one fetch instead of each making their own
+INFLIGHT                      = dict()
+INFLIGHT_LOCK                 = threading.Lock()
+
+#   Weather Underground's published limits for our key. rateAcquire() holds calls back so we never trip them.
+#       Paid plans (and the wuReplay stand-in) allow more, --callspermin/--callsperday raise them
+API_CALLS_PER_MIN             = 10
+API_CALLS_PER_DAY             = 500
+
+#   Quota ledger: every process using the same API key books its calls in one file-locked ledger in CACHE_DIR,
+#       so the limits hold across all of them. Waiting calls queue by priority (lower goes first, FIFO within one).
+QUOTA_PRIORITIES              = {'interactive': 0, 'batch': 1, 'background': 2}
+QUOTA_PRIORITY                = QUOTA_PRIORITIES['interactive']
+
+#   A queued call waits its turn however long that is, saying how long to expect. --quotamaxwait opts into giving up
+#       (with the expected wait) rather than blocking longer than QUOTA_MAX_WAIT seconds, ie; once the day's budget is spent
+QUOTA_MAX_WAIT                = None
+
+#   How often a queued call rechecks the ledger, and how long before a waiter that stopped checking is dropped
+QUOTA_POLL                    = 0.25
+QUOTA_WAITER_TIMEOUT          = 30
+QUOTA_WAITER_IDS              = itertools.count()
+
+#   Upstream calls this process has booked through the ledger
+API_CALLS_MADE                = 0
+API_CALLS_LOCK                = threading.Lock()
+
+#   Background prefetcher for a watch-list of locations (--prefetch). It only ever uses PREFETCH_MINUTE_SHARE of the
+#       per-minute budget, leaving the rest for interactive runs, and books its calls at background priority
+PREFETCH_MINUTE_SHARE         = 0.5
+
+#   Conditions/forecast are refreshed a little before their TTL runs out so readers always find them fresh
+PREFETCH_CURRENT_EVERY        = 0.9
+
+#   How long after midnight yesterday's history gets pulled (WU needs a little while to finalize the summary)
+PREFETCH_HISTORY_AFTER        = 15 * 60
+
+#   While prefetching, every upstream call (each day of a history fan-out included) is held PREFETCH_SPACING seconds
+#       behind the one before it. None outside --prefetch
+PREFETCH_SPACING              = None
+PREFETCH_NEXT_CALL            = 0.0
+PREFETCH_PACE_LOCK            = threading.Lock()
+
+#   Number of history days we'll have in flight at once
+HISTORY_WORKERS               = 7
+
+#   Shared HTTP session settings, one keep-alive pool for every call this process makes
+HTTP_SESSION                  = None
+TIMED_POOLS                   = None
+SERVE_CLASSES                 = None
+HTTP_SESSION_LOCK             = threading.Lock()
+HTTP_POOL_SIZE                = 10
+
+#   Seconds to wait for a connection to Weather Underground and for its answer (--connecttimeout/--timeout)
+HTTP_CONNECT_TIMEOUT          = 3.05
+HTTP_READ_TIMEOUT             = 15
+
+#   Retry policy for 5xx responses, connection errors and WU rate-limit bodies (jittered exponential backoff)
+HTTP_RETRIES                  = 3
+HTTP_BACKOFF_BASE             = 0.5
+HTTP_BACKOFF_MAX              = 8.0
+
+#   WU error 'type' values worth retrying, anything else in data['response']['error'] is treated as a hard failure
+WU_RETRYABLE_ERRORS           = ['ratelimited', 'rate_limited', 'toomanyrequests', 'serviceunavailable']
+
+#   Instrumentation: every apiPoll call and action handler books its counts and timings here. Phases of an upstream
+#       call are dns, connect, wait (for the first byte), transfer, plus parse, cache (lookups), store (cache writes),
+#       quota (waiting on the ledger) and backoff (sleeping between retries).
+#       --metricslog writes one json line per event ('-' for stderr), --metricsfile a Prometheus text file at exit
+#       (after every pass when prefetching, and the daemon serves it at /metrics), --profile prints a breakdown at exit
+METRIC_COUNTS                 = Counter()
+METRIC_TIMINGS                = dict()
+METRIC_LOCK                   = threading.Lock()
+METRIC_LOCAL                  = threading.local()
+METRIC_STARTED                = time.time()
+METRIC_PREFIX                 = 'weathercheck_'
+METRICS_LOG                   = None
+METRICS_FILE                  = None
+METRICS_LOGGER                = None
+PROFILE_ENABLED               = False
+
 
 ###################################################################
 #           TODO:
@@ -80,9 +342,6 @@ OUTPUT_THREE_DAY_FORECAST     = False
 #                                    ie; A user inputs 20140323 and gets mean temp data from between 20140316 20140322
 #                                           Some provisions are in place that could allow these changes and would just take more time.   
 #
-#                   -A CACHE would be a good idea, be it in a temp dir, or a REDIS/et al database. Weather Underground's API call
-#                       limit is easy to hit. (Not necessarily the 500/day, but the 10/min is easy as EACH day in the 7-day-call is singular)
-#
 #                   -Arg parsing, thoroughly validating commandline args is preferred and could be setup
 #
 #                   -Add arg to give city/state optionally vs zipcode as a creature-comfort
@@ -101,8 +360,21 @@ OUTPUT_THREE_DAY_FORECAST     = False
 
 
 #-----------------------------------------------------------------------------
-def historyLookup(start_date, days_2_go_back, wu_key, location):
+def historyLookup(start_date, days_2_go_back, wu_key, location, poller=None):
     #   This def gathers historical data going back 'x' days from start_date
+    #       Returns {'YYYYMMDD': meantempi} in date order, historyStream is the day-by-day version underneath it
+    
+    found = dict(historyStream(start_date, days_2_go_back, wu_key, location, poller))
+    
+    return dict((assembled_date, found[assembled_date]) for assembled_date in sorted(found))
+    
+#----------------------------------------------------------------
+def historyStream(start_date, days_2_go_back, wu_key, location, poller=None):
+    #   This def yields (YYYYMMDD, meantempi) for each day going back 'x' days from start_date as soon as it's known
+    #       Days WU has no mean temperature for are skipped
+    #       Days in the local store come out first, then fetched days in the order they land (not date order)
+    #       poller defaults to apiPoll, batch mode swaps in one that reads from its deduped prefetch (called as poller(query, fields))
+    #       At most HISTORY_WORKERS * 2 fetches are in flight or waiting on us, so a long range never piles up payloads
     
     #   Testing args to ensure we have what we need
     if not isinstance(start_date, date):
@@ -121,210 +393,3362 @@ def historyLookup(start_date, days_2_go_back, wu_key, location):
         print("Error: location provided must be a string. Got: %s of type %s" % (location, type(location)))
         sys.exit(EXIT_STATUS_ERROR)
 
+    if poller is None:
+        poller = apiPoll
+    
+    #   Building every day's query up front, furthest day first
+    queries = historyQueries(start_date, days_2_go_back, wu_key, location)
+    
+    if not queries:
+        return
+    
+    #   Days already in the local store are answered from it, only the gaps go out to Weather Underground
+    station = historyStation(location)
+    first_day = start_date - timedelta(days=days_2_go_back)
+    stored = None
+    if STORE_ENABLED:
+        stored = storeRead(station, first_day, days_2_go_back)
+    
+    missing = []
+    for offset, (assembled_date, query_string) in enumerate(queries):
+        if not (stored is not None and stored['have'][offset]):
+            missing.append((offset, assembled_date, query_string))
+    
+    if STORE_ENABLED:
+        metricCount('store_days_total', len(queries) - len(missing), result='hit')
+        metricCount('store_days_total', len(missing), result='miss')
+        
+    #   A stored day WU had no mean for stays stored (it won't have one next time either) but has nothing to give
+    for offset, (assembled_date, query_string) in enumerate(queries):
+        if stored is not None and stored['have'][offset] and stored['meantempi'][offset] == stored['meantempi'][offset]:
+            yield assembled_date, int(stored['meantempi'][offset])
+    
+    if not missing:
+        return
+    
+    #   Running the gap queries to Weather Underground in parallel, rateAcquire() inside apiPoll keeps us under the limits.
+    #       New days are only handed to the pool as earlier ones are taken off our hands
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    
+    todo = iter(missing)
+    pending = dict()
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(HISTORY_WORKERS, len(missing)))) as pool:
+        while True:
+            for day in itertools.islice(todo, max(0, HISTORY_WORKERS * 2 - len(pending))):
+                pending[pool.submit(poller, day[2], HISTORY_FIELDS)] = day
+                
+            if not pending:
+                break
+            
+            done, still_running = wait(pending, return_when=FIRST_COMPLETED)
+            
+            for future in done:
+                offset, assembled_date, query_string = pending.pop(future)
+                summary = historySummary(future.result())
+                
+                #   Only finished days go in the store, today's summary is still changing
+                day = first_day + timedelta(days=offset)
+                if STORE_ENABLED and day < date.today():
+                    storeWrite(station, day, summary)
+                
+                #   WU's '' or -999 for a mean it doesn't have is left out rather than averaged in
+                if summary['meantempi'] == summary['meantempi']:
+                    yield assembled_date, int(summary['meantempi'])
+    
+#----------------------------------------------------------------
+def rollingWindow(location, window, poller=None, today=None):
+    #   This def keeps a persisted rolling window of daily mean temps per station, ending yesterday
+    #       Later the same day it's answered straight from the saved aggregate, after the date rolls over only the
+    #       new days are fetched, added to the running total and the oldest ones dropped off
+    #       today defaults to THIS_DAY, the daemon hands in each request's own date
+    #       Returns ({'YYYYMMDD': meantempi} in date order, total of the window's values)
+    
+    days = dict(rollingStream(location, window, poller, today))
+    days = dict((assembled_date, days[assembled_date]) for assembled_date in sorted(days))
+    
+    return days, sum(days.values())
+    
+    
+#----------------------------------------------------------------
+def rollingStream(location, window, poller=None, today=None):
+    #   This def is rollingWindow as a generator: yields (YYYYMMDD, meantempi) for each day of the window as soon as it's known
+    #       Saved days come out straight away, new ones as their fetches land, the window is saved once the last one is in
+    
+    today = today or THIS_DAY
+    station = historyStation(location)
+    yesterday = today - timedelta(days=1)
+    saved = None
+    
+    if ROLLING_ENABLED and CACHE_ENABLED and STORE_ENABLED:
+        saved = rollingLoad(station, window)
+    
+    if saved is not None:
+        end_day, days, total = saved
+        behind = (yesterday - end_day).days
+        
+        #   Still the same day, nothing to fetch
+        if behind == 0:
+            for assembled_date, value in days.items():
+                yield assembled_date, value
+            return
+        
+        #   A few days behind: drop the oldest ones, fetch just the new ones and slide the window along
+        if 0 < behind < window:
+            for oldest in list(days)[:behind]:
+                total = total - days.pop(oldest)
+                
+            for assembled_date, value in days.items():
+                yield assembled_date, value
+                
+            for assembled_date, value in historyStream(today, behind, API_KEY, location, poller):
+                days[assembled_date] = value
+                total = total + value
+                yield assembled_date, value
+            
+            rollingSave(station, window, yesterday, dict((assembled_date, days[assembled_date]) for assembled_date in sorted(days)), total)
+            return
+    
+    #   Nothing usable saved (first run, window too far behind, or clock went backwards), start fresh
+    days = dict()
+    for assembled_date, value in historyStream(today, window, API_KEY, location, poller):
+        days[assembled_date] = value
+        yield assembled_date, value
+    
+    if ROLLING_ENABLED and CACHE_ENABLED and STORE_ENABLED:
+        rollingSave(station, window, yesterday, dict((assembled_date, days[assembled_date]) for assembled_date in sorted(days)), sum(days.values()))
+        
+        
+#----------------------------------------------------------------
+def rollingLoad(station, window):
+    #   This def reads a saved rolling window, returning (end date, {'YYYYMMDD': value}, total) or None
+    
+    try:
+        with CACHE_LOCK:
+            row = cacheOpen().execute("SELECT end_day, days, total FROM rolling WHERE station = ? AND window = ?",
+                                      (station, window)).fetchone()
+        if row is None:
+            return None
+        
+        end_day = datetime.datetime.strptime(row[0], '%Y%m%d').date()
+        days = dict(json.loads(row[1]))
+        
+        #   A window that doesn't hold exactly 'window' days can't be slid reliably
+        if len(days) != window:
+            return None
+        
+        return end_day, days, row[2]
+    
+    except (sqlite3.Error, OSError, ValueError) as e:
+        logWarning("Could not read rolling window for %s: %s" % (station, e))
+        return None
+    
+    
+#----------------------------------------------------------------
+def rollingSave(station, window, end_day, days, total):
+    #   This def persists a rolling window (days kept as a list of pairs so the order survives)
+    
+    try:
+        with CACHE_LOCK:
+            conn = cacheOpen()
+            conn.execute("INSERT OR REPLACE INTO rolling (station, window, end_day, days, total) VALUES (?, ?, ?, ?, ?)",
+                         (station, window, end_day.strftime('%Y%m%d'), json.dumps(list(days.items())), total))
+            conn.commit()
+            
+    except (sqlite3.Error, OSError) as e:
+        logWarning("Could not save rolling window for %s: %s" % (station, e))
+        
+        
+#----------------------------------------------------------------
+def historyStation(location):
+    #   This def names the store a '/q/...' history location belongs to, the resolved station when we have one
+    
+    if location.startswith('/q/'):
+        return resolveLocation(location[len('/q/'):])
+    return location.strip('/')
+    
+    
+#----------------------------------------------------------------
+def historySummary(polled):
+    #   This def boils a (projected) history payload down to the values kept in the store
+    #       WU hands back '' or '-999' for readings it doesn't have, those become NaN
+    
+    summary = dict()
+    daily = polled['history']['dailysummary'][0]
+    
+    for field in ('meantempi', 'mintempi', 'maxtempi', 'precipi'):
+        try:
+            value = float(daily.get(field))
+        except (TypeError, ValueError):
+            value = float('nan')
+        if value <= -999:
+            value = float('nan')
+        summary[field] = value
+    
+    #   The day's conditions are the ones most often reported through it
+    observed = [obs.get('conds') for obs in polled['history'].get('observations', []) if obs and obs.get('conds')]
+    summary['conds'] = Counter(observed).most_common(1)[0][0] if observed else ''
+    
+    return summary
+    
+#----------------------------------------------------------------
+def historyQueries(start_date, days_2_go_back, wu_key, location):
+    #   This def lists (YYYYMMDD, assembled_query) for each day going back 'x' days from start_date, furthest day first
+    
     # Setting up counter which we'll use to start our lookup on the furthest days
     date_countdown = days_2_go_back
     
-    # Creating an empty Dict to store each day's polled data
-    hist_dict = dict()
+    #   Asking for the reporting station so every alias of it shares the same history entries
+    if location.startswith('/q/'):
+        location = '/q/%s' % resolveLocation(location[len('/q/'):])
+    
+    queries = []
     
     #   Looping through the date range to grab weather for the previous 7 days
     for i in range(1, (days_2_go_back + 1)):
-        #   Initializing meantempi holder
-        p_data = 0 
-    
         #   setting timedelta each time we loop to grab another day
         d = start_date - timedelta(days=date_countdown)
         assembled_date = '%s%s%s' % (d.year, d.strftime('%m'), d.strftime('%d'))
-
     
         query_string = '%s%s%s%s%s%s' % (WU_URL, wu_key, TIME_FRAME, assembled_date, location, URL_EXTENSION)
-
-        
-        #   Running the query to Weather Underground and pulling the mean temp
-        p_data = int(apiPoll(query_string)['history']['dailysummary'][0]['meantempi'])
+        queries.append((assembled_date, query_string))
         
-        #   Adding this date's mean temp to the dir
-        hist_dict.update({'%s' % assembled_date : p_data})
         #   Decrementing our counter to poll the next date closer to start_date
         date_countdown = date_countdown - 1
         
-        
-    return hist_dict
+    return queries
     
 #----------------------------------------------------------------    
-def apiPoll(assembled_query):
-        #   TODO: Adjust this def to accept a list, or possibly a dict of things to pull from retrieved data
-        #            instead of a full json dump
-
+def apiPoll(assembled_query, fields=None, allow_stale=False, raise_errors=False):
     #   This def assembles an http call for json data from Weather Underground
     #   We assume the WU_URL global var is the canonical source for the API's URL
+    #       fields is an optional list of paths to keep, ie; ['history.dailysummary.0.meantempi'] (see projectJson)
+    #       Only those values get decoded, the rest of the payload is skipped over without building any objects
+    #       allow_stale lets a cached payload past its TTL (but inside CACHE_MAX_STALE) answer right away while a
+    #       background refresh runs, the payload then carries its age in seconds under STALE_AGE_KEY
+    #       raise_errors hands a WU error back as a ValueError instead of reporting it and exiting, for lookups
+    #       made on the side that have a fallback of their own
     
     # Assuring the assembled_query is a string
     if not isinstance(assembled_query, str):
         print("Error: apiPoll must be given a string, got: %s of type %s" % (assembled_query, type(assembled_query)))
         sys.exit(EXIT_STATUS_ERROR)
         
+    #   Phases below (and down in httpFetch) add themselves to this call's breakdown
+    started = time.perf_counter()
+    METRIC_LOCAL.phases = dict()
+    feature = queryFeature(assembled_query)
+        
+    #   Checking the local cache first, a hit costs us nothing against the API limits
+    cache_key = cacheKey(assembled_query)
+    body = None
+    stale_age = None
+    if CACHE_ENABLED:
+        lookup_started = time.perf_counter()
+        body, stale_age = cacheGet(cache_key, CACHE_MAX_STALE if (allow_stale and STALE_ENABLED) else 0)
+        metricPhase('cache', time.perf_counter() - lookup_started)
+    fresh = body is None
+    
+    if not CACHE_ENABLED:
+        outcome = 'off'
+    elif fresh:
+        outcome = 'miss'
+    elif stale_age is not None:
+        outcome = 'stale'
+    else:
+        outcome = 'hit'
+    metricCount('cache_lookups_total', feature=feature, result=outcome)
+    
+    #   Serving stale: the answer goes out now, the refresh happens off to the side
+    if stale_age is not None:
+        revalidate(assembled_query, cache_key)
+    
+    #   Pulling the payload over the shared session, retrying anything that's likely to clear up
+    #       Identical queries already on their way share that one call
+    if fresh:
+        body = singleFlight(cache_key, lambda: httpFetch(assembled_query))
+
+    #   The cache keeps the raw text, so projection is applied the same way to hits and fresh pulls
+    parse_started = time.perf_counter()
+    if fields is None:
+        data = json.loads(body)
+    else:
+        data = projectJson(body, list(fields) + ['response.error'])
+    metricPhase('parse', time.perf_counter() - parse_started)
     
-    r = requests.get(assembled_query)
-    data = r.json()
+    metricCount('payload_bytes_total', len(body), feature=feature)
 
     #   Testing return to ensure that it doesn't contain an 'error' key. (The operation DOES NOT fail and responds with 200 anyway)
-    if 'error' in data['response']:
-        print("\n   Error retrieving weather: %s" % data['response']['error']['description'])
+    if 'error' in data.get('response', {}):
+        metricCount('errors_total', feature=feature, kind=str(data['response']['error'].get('type', 'unknown')))
+        apiPollDone(cache_key, feature, outcome, body, started, data['response']['error'].get('description'))
+        if raise_errors:
+            raise ValueError("Weather Underground error: %s" % data['response']['error'].get('description'))
+        print("\n   Error retrieving weather: %s" % data['response']['error']['description'], file=sys.stderr if OUTPUT_JSON else sys.stdout)
         sys.exit(EXIT_STATUS_ERROR)
 
+    #   Only good responses make it into the cache
+    if fresh and CACHE_ENABLED:
+        store_started = time.perf_counter()
+        cacheStore(assembled_query, body)
+        metricPhase('store', time.perf_counter() - store_started)
+        
+    #   The archive keeps its own trimmed copy of everything good we pull
+    if fresh and ARCHIVE_ENABLED:
+        archivePayload(assembled_query, body)
+
+    if stale_age is not None:
+        data[STALE_AGE_KEY] = stale_age
+
+    apiPollDone(cache_key, feature, outcome, body, started)
     return data        
     
     
 #----------------------------------------------------------------
-
-def lookAtHistory():
-    #   This def handles historical requests from the user, 
-    #       including 7-day overall meant temp of an area, per day, and a json holding the data
-
-    #   Future possibility: Checking to see if json output is requested, if so, push results out to return
+def apiPollDone(cache_key, feature, outcome, body, started, error=None):
+    #   This def books a finished apiPoll call: its total time and one log line with the phase breakdown
+    
+    elapsed = time.perf_counter() - started
+    metricTime('api_poll', elapsed, feature=feature, cache=outcome)
+    
+    if METRICS_LOG is not None:
+        phases = getattr(METRIC_LOCAL, 'phases', None) or dict()
+        fields = {'query': cache_key, 'feature': feature, 'cache': outcome, 'bytes': len(body), 'ms': round(elapsed * 1000, 3),
+                  'phases_ms': dict((phase, round(seconds * 1000, 3)) for phase, seconds in phases.items())}
+        if error is not None:
+            fields['error'] = error
+        metricEvent('api_poll', **fields)
+    
+    
+#----------------------------------------------------------------
+def revalidate(assembled_query, cache_key):
+    #   This def refreshes a stale cache entry on a background thread, once per key no matter how many callers saw it stale
+    
+    with INFLIGHT_LOCK:
+        if cache_key in INFLIGHT:
+            return
+    
+    #   One-shot runs leave it for the detached child finishRefreshes starts
+    if REFRESH_DETACH:
+        with REFRESH_LOCK:
+            REFRESH_PENDING.setdefault(cache_key, assembled_query)
+        return
+    
+    def refresh():
+        try:
+            refreshEntry(assembled_query)
+        except Exception as e:
+            logWarning("Background refresh of %s failed: %s" % (cache_key, e))
+    
+    refresher = threading.Thread(target=refresh, daemon=True)
+    with REFRESH_LOCK:
+        REFRESHES.append(refresher)
+    refresher.start()
+    
+    
+#----------------------------------------------------------------
+def refreshEntry(assembled_query):
+    #   This def pulls a query from upstream regardless of what's cached and stores it, returning True if it stored
+    #       Error bodies never replace a good (if stale) entry
+    
+    cache_key = cacheKey(assembled_query)
+    body = singleFlight(cache_key, lambda: httpFetch(assembled_query))
+    
+    wu_error = projectJson(body, ['response.error']).get('response', {}).get('error')
+    if wu_error:
+        logWarning("Refresh of %s failed: %s" % (cache_key, wu_error.get('description')))
+        return False
+    
+    cacheStore(assembled_query, body)
+    if ARCHIVE_ENABLED:
+        archivePayload(assembled_query, body)
+    return True
+    
+    
+#----------------------------------------------------------------
+def cacheStore(assembled_query, body):
+    #   This def caches a good payload under its query, and a chained query's payload under each single feature too
+    #       ie; /conditions/forecast/q/KHWD also answers /conditions/q/KHWD and /forecast/q/KHWD until their own TTLs run out
+    
+    cachePut(cacheKey(assembled_query), body, cacheTTL(assembled_query))
+    
+    match = re.match(r'^(.*/api/[^/]*/+)([^?]*?)(/q/.*)$', assembled_query)
+    if match is None:
+        return
+    
+    features = [feature for feature in match.group(2).split('/') if feature]
+    if len(features) < 2:
+        return
+    
+    for feature in features:
+        single_query = '%s%s%s' % (match.group(1), feature, match.group(3))
+        cachePut(cacheKey(single_query), body, cacheTTL(single_query))
         
-    if OUTPUT_JSON:
-        lookup_hist = historyLookup(THIS_DAY, DAYS_2_GET_HISTORICALS, API_KEY, LOCATION_QUERY)
-        return lookup_hist
+        
+#----------------------------------------------------------------
+def archiveDir():
+    #   This def returns where the payload archive lives
     
-    #   If the user is solely looking for CLI printed results:
-    elif OUTPUT_AVG_HIST_7_DAY_TOTAL or OUTPUT_AVG_HIST_7_DAY_BY_DAY:
+    if ARCHIVE_DIR:
+        return ARCHIVE_DIR
+    return os.path.join(CACHE_DIR, 'archive')
     
-        # Calling data from the API only once to keep our api key from getting locked out, then parsing differently for each call.
-        lookup_hist = historyLookup(THIS_DAY, DAYS_2_GET_HISTORICALS, API_KEY, LOCATION_QUERY)
-
+    
+#----------------------------------------------------------------
+def archiveIndex():
+    #   This def opens (and creates if needed) the archive's sqlite index, only once per process
+    global ARCHIVE_CONN
+    
+    if ARCHIVE_CONN is None:
+        os.makedirs(archiveDir(), exist_ok=True)
         
-        if OUTPUT_AVG_HIST_7_DAY_TOTAL:
-            weekly_avg = sum(lookup_hist.values()) / len(lookup_hist.values())
-            print("\n   The average temperature of San Jose, CA was %0d F over the last 7 days." %  weekly_avg)
-                
-                
-        if OUTPUT_AVG_HIST_7_DAY_BY_DAY:
-            print("\n   The average temperature for the last 7 days in San Jose, CA is as follows:\n")
-            for key, value in lookup_hist.items():
-                print("Average Temperature for %s was %sF" % (key, value))
+        conn = sqlite3.connect(os.path.join(archiveDir(), ARCHIVE_INDEX_NAME), timeout=10, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS payloads ("
+                     " station  TEXT    NOT NULL,"
+                     " feature  TEXT    NOT NULL,"
+                     " day      TEXT    NOT NULL,"
+                     " block    INTEGER NOT NULL,"
+                     " item     INTEGER NOT NULL,"
+                     " fetched  REAL    NOT NULL,"
+                     " PRIMARY KEY (station, feature, day))")
         
-        #   If we got this far without outputting it's time to fail
+        #   'end' is where the last indexed block stops, anything past it is new to us (or a torn write)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.commit()
+        ARCHIVE_CONN = conn
+        
+    return ARCHIVE_CONN
+    
+    
+#----------------------------------------------------------------
+def archiveEncode(lines):
+    #   This def packs record lines into one block: header then the newline joined records, compressed with ARCHIVE_CODEC
+    
+    raw = '\n'.join(lines).encode('utf-8')
+    
+    if ARCHIVE_CODEC == 'lzma':
+        import lzma
+        packed = lzma.compress(raw)
     else:
-        print("Error: We hit the lookAtHistory function but no output flag was matched")
-        sys.exit(EXIT_STATUS_ERROR)
+        import zlib
+        packed = zlib.compress(raw, 9)
+        
+    return ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_CODECS[ARCHIVE_CODEC], len(packed), len(raw), len(lines)) + packed
+    
+    
+#----------------------------------------------------------------
+def archiveBlocks(archive_file, offset=0, strict=False):
+    #   This def reads archive blocks front to back from offset, yielding (offset, end, [record lines]) for each
+    #       A block cut short (a writer that died part way) ends the scan, the last end yielded is where good data stops,
+    #       or raises ValueError when strict (an import shouldn't quietly stop part way)
+    #       Pipes (an import from stdin) are read from wherever they are
+    
+    if archive_file.seekable():
+        archive_file.seek(offset)
+    
+    while True:
+        header = archive_file.read(ARCHIVE_HEADER.size)
+        if not header:
+            return
+        if len(header) < ARCHIVE_HEADER.size:
+            break
+        
+        magic, codec, packed_size, raw_size, count = ARCHIVE_HEADER.unpack(header)
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError("not a weatherCheck archive block at offset %s" % offset)
+        
+        packed = archive_file.read(packed_size)
+        if len(packed) < packed_size:
+            break
+        
+        if codec == ARCHIVE_CODECS['lzma']:
+            import lzma
+            raw = lzma.decompress(packed)
+        elif codec == ARCHIVE_CODECS['zlib']:
+            import zlib
+            raw = zlib.decompress(packed)
+        else:
+            raise ValueError("unknown archive codec %s at offset %s" % (codec, offset))
+        
+        end = offset + ARCHIVE_HEADER.size + packed_size
+        yield offset, end, raw.decode('utf-8').split('\n')
+        offset = end
+        
+    if strict:
+        raise ValueError("archive ends part way through a block at offset %s" % offset)
+        
+        
+#----------------------------------------------------------------
+def archiveCatchUp(conn, archive_file):
+    #   This def brings the index up to the data file before we append to it, must be called holding the file lock
+    #       Complete blocks past the indexed end (ie; the index was restored from a backup) get indexed,
+    #       a torn block at the very end is cut off. An index that's missing or ahead of the file is rebuilt.
+    #       Returns where the next block goes
+    
+    row = conn.execute("SELECT value FROM meta WHERE name = 'end'").fetchone()
+    size = archive_file.seek(0, os.SEEK_END)
+    end = row[0] if row else 0
+    
+    if end > size or (row is None and size):
+        logWarning("Rebuilding the payload archive index from %s" % archive_file.name)
+        conn.execute("DELETE FROM payloads")
+        end = 0
+    
+    if size > end:
+        for offset, end, lines in archiveBlocks(archive_file, end):
+            rows = []
+            for item, line in enumerate(lines):
+                record = json.loads(line)
+                rows.append((record['station'], record['feature'], record['day'], offset, item, record['fetched']))
+            archiveIndexRows(conn, rows)
+        
+        if size > end:
+            logWarning("Cutting a torn block (%s bytes) off the end of %s" % (size - end, archive_file.name))
+            archive_file.truncate(end)
+    
+    return end
+    
+    
+#----------------------------------------------------------------
+def archiveIndexRows(conn, rows):
+    #   This def points the index at [(station, feature, day, block, item, fetched)], an older payload never wins over a newer one
+    
+    conn.executemany("INSERT INTO payloads (station, feature, day, block, item, fetched) VALUES (?, ?, ?, ?, ?, ?)"
+                     " ON CONFLICT (station, feature, day) DO UPDATE SET"
+                     " block = excluded.block, item = excluded.item, fetched = excluded.fetched"
+                     " WHERE excluded.fetched >= payloads.fetched", rows)
+    
+    
+#----------------------------------------------------------------
+def archiveAppend(records):
+    #   This def appends [(station, feature, day, fetched, record json)] to the archive in blocks of about ARCHIVE_BLOCK_BYTES
+    #       Data and index are updated under an exclusive lock on the data file, so any number of processes can add to it
+    #       Returns the number of blocks written
+    
+    if not records:
+        return 0
+    
+    conn = archiveIndex()
+    
+    with open(os.path.join(archiveDir(), ARCHIVE_DATA_NAME), 'a+b') as archive_file:
+        archive_file.seek(0)
+        if fcntl is not None:
+            fcntl.flock(archive_file.fileno(), fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(archive_file.fileno(), msvcrt.LK_LOCK, 1)
+            
+        try:
+            end = archiveCatchUp(conn, archive_file)
+            
+            #   Cutting the records into blocks
+            blocks = [[]]
+            size = 0
+            for record in records:
+                if size >= ARCHIVE_BLOCK_BYTES:
+                    blocks.append([])
+                    size = 0
+                blocks[-1].append(record)
+                size = size + len(record[4])
+            
+            rows = []
+            for block in blocks:
+                archive_file.seek(end)
+                packed = archiveEncode([record[4] for record in block])
+                archive_file.write(packed)
+                rows.extend((station, feature, day, end, item, fetched) for item, (station, feature, day, fetched, line) in enumerate(block))
+                end = end + len(packed)
             
+            #   The data is on disk before the index points at it
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+            
+            archiveIndexRows(conn, rows)
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('end', ?)", (end,))
+            conn.commit()
+            
+        finally:
+            archive_file.seek(0)
+            if fcntl is not None:
+                fcntl.flock(archive_file.fileno(), fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(archive_file.fileno(), msvcrt.LK_UNLCK, 1)
+    
+    metricCount('archive_records_total', len(records))
+    return len(blocks)
+    
+    
+#----------------------------------------------------------------
+def archiveRecord(station, feature, day, fetched, payload_json):
+    #   This def builds one archive record line around an already serialized payload, returns the archiveAppend tuple
+    
+    line = '{"station": %s, "feature": %s, "day": %s, "fetched": %s, "payload": %s}' % (
+        json.dumps(station), json.dumps(feature), json.dumps(day), json.dumps(fetched), payload_json)
+    
+    return station, feature, day, fetched, line
+    
+    
+#----------------------------------------------------------------
+def archivePayload(assembled_query, body):
+    #   This def queues a good payload from WU for the archive, one record per archived feature in the query trimmed to
+    #       its ARCHIVE_FIELDS. History is filed under the day it covers, everything else under the day it was pulled.
+    #       A full block's worth (or one that's waited too long) gets written out right away
+    global ARCHIVE_PENDING_SINCE
+    
+    features, sep, station = cacheKey(assembled_query).split('/api/', 1)[-1].partition('/q/')
+    if station.endswith(URL_EXTENSION):
+        station = station[:-len(URL_EXTENSION)]
+    fetched = round(time.time(), 3)
+    
+    records = []
+    for feature in features.split('/'):
+        day = date.fromtimestamp(fetched).strftime('%Y%m%d')
+        if feature.startswith(TIME_FRAME):
+            feature, day = TIME_FRAME.rstrip('_'), feature[len(TIME_FRAME):]
+        
+        if feature not in ARCHIVE_FIELDS:
+            continue
+        
+        if ARCHIVE_FIELDS[feature] is None:
+            payload = json.loads(body)
+        else:
+            payload = projectJson(body, ARCHIVE_FIELDS[feature])
+        records.append(archiveRecord(station, feature, day, fetched, json.dumps(payload, separators=(',', ':'))))
+    
+    with ARCHIVE_LOCK:
+        if not ARCHIVE_PENDING:
+            ARCHIVE_PENDING_SINCE = time.time()
+        ARCHIVE_PENDING.extend(records)
+        
+        if sum(len(record[4]) for record in ARCHIVE_PENDING) < ARCHIVE_BLOCK_BYTES and \
+           time.time() - ARCHIVE_PENDING_SINCE < ARCHIVE_FLUSH_AFTER:
+            return
+        
+    archiveFlush()
+    
+    
+#----------------------------------------------------------------
+def archiveFlush():
+    #   This def writes out whatever records are queued for the archive, a failing archive never stops a lookup
+    
+    with ARCHIVE_LOCK:
+        records = list(ARCHIVE_PENDING)
+        del ARCHIVE_PENDING[:]
+        
+    try:
+        archiveAppend(records)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        logWarning("Could not archive %s payloads: %s" % (len(records), e))
+        
+        
+#----------------------------------------------------------------
+def archiveRead(station, feature, day):
+    #   This def hands back the latest archived record for a key ({'station', 'feature', 'day', 'fetched', 'payload'}) or None
+    #       One index lookup, then one block read and decompressed
+    
+    row = archiveIndex().execute("SELECT block, item FROM payloads WHERE station = ? AND feature = ? AND day = ?",
+                                 (station, feature, day)).fetchone()
+    if row is None:
+        return None
+    
+    with open(os.path.join(archiveDir(), ARCHIVE_DATA_NAME), 'rb') as archive_file:
+        for offset, end, lines in archiveBlocks(archive_file, row[0]):
+            return json.loads(lines[row[1]])
+        
+    return None
+    
+    
+#----------------------------------------------------------------
+def archiveExport(export_path):
+    #   This def writes the latest record for every archived key to export_path ('-' for stdout) as an archive data file
+    #       Superseded payloads are left behind and records are packed into full blocks. The source is read front to back,
+    #       each block that still holds a latest record decompressed once.
+    #       Returns the number of records written
+    
+    archiveFlush()
+    
+    #   Which items of each block are still current
+    current = dict()
+    for block, item in archiveIndex().execute("SELECT block, item FROM payloads ORDER BY block, item"):
+        current.setdefault(block, set()).add(item)
+    
+    if export_path == '-':
+        out = sys.stdout.buffer
+    else:
+        out = open(export_path + '.tmp', 'wb')
+    
+    exported = 0
+    try:
+        lines = []
+        size = 0
+        data_path = os.path.join(archiveDir(), ARCHIVE_DATA_NAME)
+        
+        if current:
+            with open(data_path, 'rb') as archive_file:
+                for block in sorted(current):
+                    for offset, end, block_lines in archiveBlocks(archive_file, block):
+                        for item in sorted(current[block]):
+                            lines.append(block_lines[item])
+                            size = size + len(block_lines[item])
+                        break
+                    
+                    if size >= ARCHIVE_BLOCK_BYTES:
+                        out.write(archiveEncode(lines))
+                        exported = exported + len(lines)
+                        lines = []
+                        size = 0
+                        
+        if lines:
+            out.write(archiveEncode(lines))
+            exported = exported + len(lines)
+        out.flush()
+        
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+            
+    if out is not sys.stdout.buffer:
+        os.replace(export_path + '.tmp', export_path)
+        
+    return exported
+    
+    
+#----------------------------------------------------------------
+def archiveImport(import_path):
+    #   This def seeds this host from an exported archive ('-' for stdin) in one sequential read
+    #       Every record lands in the local archive and history days go into the history store as well,
+    #       so none of them ever has to be pulled from WU again.
+    #       Returns (records imported, history days stored)
+    
+    source = sys.stdin.buffer if import_path == '-' else open(import_path, 'rb')
+    
+    imported = 0
+    stored = 0
+    try:
+        records = []
+        size = 0
+        for offset, end, lines in archiveBlocks(source, strict=True):
+            for line in lines:
+                record = json.loads(line)
+                records.append((record['station'], record['feature'], record['day'], record['fetched'], line))
+                size = size + len(line)
+                
+                if record['feature'] == TIME_FRAME.rstrip('_') and STORE_ENABLED:
+                    try:
+                        day = datetime.datetime.strptime(record['day'], '%Y%m%d').date()
+                        storeWrite(record['station'], day, historySummary(record['payload']))
+                        stored = stored + 1
+                    except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+                        pass
+            
+            if size >= ARCHIVE_BLOCK_BYTES:
+                archiveAppend(records)
+                imported = imported + len(records)
+                records = []
+                size = 0
+        
+        archiveAppend(records)
+        imported = imported + len(records)
+        
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+            
+    return imported, stored
+    
+    
+#----------------------------------------------------------------
+def finishRefreshes(timeout=None):
+    #   This def sees a one-shot run's refreshes off: queued ones go to a detached child, ones already running on
+    #       threads get up to 'timeout' seconds in all to land in the cache
+    
+    with REFRESH_LOCK:
+        pending = list(REFRESHES)
+        del REFRESHES[:]
+        queued = list(REFRESH_PENDING.values())
+        REFRESH_PENDING.clear()
+        
+    if queued:
+        refreshDetached(queued)
+        
+    deadline = None if timeout is None else time.time() + timeout
+    for refresher in pending:
+        refresher.join(None if deadline is None else max(0.0, deadline - time.time()))
+    
+    
+#----------------------------------------------------------------
+def refreshDetached(queries):
+    #   This def forks a child that refreshes 'queries' on its own time, in its own session with its output going nowhere,
+    #       so nothing waiting on us (a shell, a pipe) waits on Weather Underground. The child uses its own cache and
+    #       http connections, queues for quota behind everything interactive and leaves without our exit handling
+    global CACHE_CONN
+    global ARCHIVE_CONN
+    global HTTP_SESSION
+    global QUOTA_PRIORITY
+    
+    sys.stdout.flush()
+    sys.stderr.flush()
+    
+    try:
+        pid = os.fork()
+    except OSError as e:
+        logWarning("Could not start background refresh of %s queries: %s" % (len(queries), e))
+        return
+    
+    if pid:
+        return
+    
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        
+        #   The parent's handles stay referenced (and open) until we're gone, they aren't ours to use or close
+        inherited = (CACHE_CONN, ARCHIVE_CONN, HTTP_SESSION)
+        CACHE_CONN = None
+        ARCHIVE_CONN = None
+        HTTP_SESSION = None
+        QUOTA_PRIORITY = QUOTA_PRIORITIES['background']
+        
+        #   Anything the parent already queued for the archive is the parent's to write
+        with ARCHIVE_LOCK:
+            del ARCHIVE_PENDING[:]
+        
+        for assembled_query in queries:
+            try:
+                refreshEntry(assembled_query)
+            except Exception as e:
+                logWarning("Background refresh of %s failed: %s" % (cacheKey(assembled_query), e))
+        
+        archiveFlush()
+        
+    finally:
+        os._exit(EXIT_STATUS_OK)
+    
+    
+#----------------------------------------------------------------
+def metricCount(name, amount=1, **labels):
+    #   This def adds to a counter, ie; metricCount('retries_total', reason='http')
+    
+    key = (name, tuple(sorted(labels.items())))
+    with METRIC_LOCK:
+        METRIC_COUNTS[key] = METRIC_COUNTS[key] + amount
+        
+        
+#----------------------------------------------------------------
+def metricTime(name, seconds, **labels):
+    #   This def books one timing under name/labels, kept as [count, total seconds, slowest]
+    
+    key = (name, tuple(sorted(labels.items())))
+    with METRIC_LOCK:
+        timing = METRIC_TIMINGS.get(key)
+        if timing is None:
+            METRIC_TIMINGS[key] = [1, seconds, seconds]
+        else:
+            timing[0] = timing[0] + 1
+            timing[1] = timing[1] + seconds
+            timing[2] = max(timing[2], seconds)
+            
+            
+#----------------------------------------------------------------
+def metricPhase(phase, seconds):
+    #   This def books time spent in one phase, both process wide and on the apiPoll call running on this thread
+    
+    metricTime('phase', seconds, phase=phase)
+    
+    phases = getattr(METRIC_LOCAL, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+        
+        
+#----------------------------------------------------------------
+def logWarning(message):
+    #   This def logs a warning through the root logger, logging is only loaded by runs that have something to warn about
+    import logging
+    
+    logging.warning(message)
+    
+    
+#----------------------------------------------------------------
+def metricEvent(event, **fields):
+    #   This def writes one structured json log line when --metricslog is on
+    
+    if METRICS_LOG is None:
+        return
+    
+    fields['event'] = event
+    fields['ts'] = round(time.time(), 3)
+    METRICS_LOGGER.info(json.dumps(fields, sort_keys=True))
+    
+    
+#----------------------------------------------------------------
+def metricsSetup(log_path):
+    #   This def points the metrics logger at a file (appended to) or stderr for '-', apart from the root logger
+    import logging
+    global METRICS_LOG, METRICS_LOGGER
+    
+    METRICS_LOGGER = logging.getLogger('weatherCheck.metrics')
+    if log_path == '-':
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = logging.FileHandler(log_path)
+        
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    METRICS_LOGGER.addHandler(handler)
+    METRICS_LOGGER.setLevel(logging.INFO)
+    METRICS_LOGGER.propagate = False
+    METRICS_LOG = log_path
+    
+    
+#----------------------------------------------------------------
+def queryFeature(assembled_query):
+    #   This def names a query's features for metric labels, ie; .../conditions/forecast/q/KHWD.json -> 'conditions+forecast'
+    #       history_YYYYMMDD counts as plain 'history' so days don't each get their own series
+    
+    features = cacheKey(assembled_query).split('/api/', 1)[-1].split('/q/', 1)[0].split('/')
+    
+    return '+'.join(TIME_FRAME.rstrip('_') if feature.startswith(TIME_FRAME) else feature for feature in features if feature)
+    
+    
+#----------------------------------------------------------------
+def timedAction(action):
+    #   Decorator timing an action handler as a whole, ie; @timedAction('currenttemp')
+    #       sys.exit on the way out still gets booked (as an error) before it carries on
+    
+    def wrap(handler):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = handler(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                elapsed = time.perf_counter() - started
+                metricTime('action', elapsed, action=action, outcome=outcome)
+                metricEvent('action', action=action, outcome=outcome, ms=round(elapsed * 1000, 3))
+                
+        timed.__name__ = handler.__name__
+        timed.__doc__ = handler.__doc__
+        return timed
+        
+    return wrap
+    
+    
+#----------------------------------------------------------------
+def metricsPrometheus():
+    #   This def renders everything collected so far in the Prometheus text exposition format
+    #       Counters come out as weathercheck_<name>, timings as summaries (_count/_sum) plus a _max gauge
+    
+    def series(name, labels, value):
+        if labels:
+            label_text = ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+            return '%s%s{%s} %s' % (METRIC_PREFIX, name, label_text, value)
+        return '%s%s %s' % (METRIC_PREFIX, name, value)
+    
+    with METRIC_LOCK:
+        counts = sorted(METRIC_COUNTS.items())
+        timings = sorted(METRIC_TIMINGS.items())
+        
+    lines = []
+    
+    #   Quota this process spent, and where the shared ledger stands
+    lines.append('# TYPE %squota_calls_total counter' % METRIC_PREFIX)
+    lines.append(series('quota_calls_total', (), API_CALLS_MADE))
+    
+    last_name = None
+    for (name, labels), value in counts:
+        if name != last_name:
+            lines.append('# TYPE %s%s counter' % (METRIC_PREFIX, name))
+            last_name = name
+        lines.append(series(name, labels, value))
+        
+    last_name = None
+    for (name, labels), (count, total, slowest) in timings:
+        if name != last_name:
+            lines.append('# TYPE %s%s_seconds summary' % (METRIC_PREFIX, name))
+            last_name = name
+        lines.append(series('%s_seconds_count' % name, labels, count))
+        lines.append(series('%s_seconds_sum' % name, labels, '%.6f' % total))
+        
+    last_name = None
+    for (name, labels), (count, total, slowest) in timings:
+        if name != last_name:
+            lines.append('# TYPE %s%s_seconds_max gauge' % (METRIC_PREFIX, name))
+            last_name = name
+        lines.append(series('%s_seconds_max' % name, labels, '%.6f' % slowest))
+        
+    lines.append('# TYPE %suptime_seconds gauge' % METRIC_PREFIX)
+    lines.append(series('uptime_seconds', (), '%.3f' % (time.time() - METRIC_STARTED)))
+    
+    return '\n'.join(lines) + '\n'
+    
+    
+#----------------------------------------------------------------
+def metricsWrite():
+    #   This def writes the Prometheus text file, through a temp file so a scraper never reads half of one
+    
+    if not METRICS_FILE:
+        return
+    
+    try:
+        temp_path = '%s.%s.tmp' % (METRICS_FILE, os.getpid())
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(metricsPrometheus())
+        os.replace(temp_path, METRICS_FILE)
+        
+    except OSError as e:
+        logWarning("Couldn't write metrics to %s: %s" % (METRICS_FILE, e))
+        
+        
+#----------------------------------------------------------------
+def profileReport():
+    #   This def prints where the run's time went, per phase and per action, plus cache/retry/quota tallies (to stderr)
+    
+    with METRIC_LOCK:
+        counts = dict(METRIC_COUNTS)
+        timings = dict(METRIC_TIMINGS)
+        
+    def total(name, **labels):
+        return sum(value for (count_name, count_labels), value in counts.items()
+                   if count_name == name and all(item in count_labels for item in labels.items()))
+    
+    wall = time.time() - METRIC_STARTED
+    out = sys.stderr
+    
+    out.write("\n   Profile (%0.3fs wall)\n" % wall)
+    out.write("%-30s %7s %10s %10s %10s\n" % ('phase', 'calls', 'total ms', 'avg ms', 'max ms'))
+    
+    for kind in ('phase', 'api_poll', 'action'):
+        rows = sorted(((labels, timing) for (name, labels), timing in timings.items() if name == kind),
+                      key=lambda row: -row[1][1])
+        for labels, (count, seconds, slowest) in rows:
+            label = '/'.join(str(value) for key, value in labels)
+            if kind != 'phase':
+                label = '%s %s' % (kind, label)
+            out.write("%-30s %7s %10.1f %10.2f %10.2f\n" % (label[:30], count, seconds * 1000, seconds * 1000 / count, slowest * 1000))
+    
+    hits = total('cache_lookups_total', result='hit') + total('cache_lookups_total', result='stale')
+    lookups = total('cache_lookups_total') - total('cache_lookups_total', result='off')
+    
+    out.write("\nCache hit ratio:   %s\n" % ('%0.1f%% of %s lookups' % (hits * 100.0 / lookups, lookups) if lookups else 'no lookups'))
+    out.write("History store:     %s days stored, %s fetched\n" % (total('store_days_total', result='hit'), total('store_days_total', result='miss')))
+    out.write("Upstream calls:    %s (%s bytes, %s retries, %s shared)\n" % (API_CALLS_MADE, total('upstream_bytes_total'),
+                                                                          total('retries_total'), total('coalesced_total')))
+    
+    
+#----------------------------------------------------------------
+def metricsFinish():
+    #   This def is the at-exit hook: final Prometheus file and the --profile breakdown
+    
+    metricsWrite()
+    
+    if PROFILE_ENABLED:
+        profileReport()
+    
+    
+#----------------------------------------------------------------
+def fieldTrie(fields):
+    #   This def turns field paths into the nested lookup projectJson walks
+    #       Paths are dotted strings or tuples, digits index into lists and '*' matches every list element
+    #       ie; ['forecast.simpleforecast.forecastday.0.high', 'forecast.simpleforecast.forecastday.0.conditions']
+    #            -> {'forecast': {'simpleforecast': {'forecastday': {0: {'high': True, 'conditions': True}}}}}
+    
+    trie = dict()
+    for field in fields:
+        if isinstance(field, str):
+            field = field.split('.')
+        
+        path = [int(step) if isinstance(step, str) and step.isdigit() else step for step in field]
+        if not path:
+            continue
+        
+        node = trie
+        for step in path[:-1]:
+            child = node.get(step)
+            
+            #   A shorter path already asked for this whole subtree
+            if child is True:
+                break
+            if child is None:
+                child = node[step] = dict()
+            node = child
+            
+        else:
+            node[path[-1]] = True
+            
+    return trie
+    
+    
+#----------------------------------------------------------------
+def projectJson(text, fields):
+    #   This def pulls only the requested field paths out of a json document
+    #       Returns the same nesting as json.loads would (lists padded with None) holding only what was found.
+    #       Up to PROJECT_STREAM_BYTES the document is decoded whole and picked through (jsonPick). Past that it's
+    #       streamed in a single pass over the text (jsonProject): wanted values are kept, everything else is handed
+    #       to json's C scanner and dropped right away, and the pass stops once the last wanted field has been read.
+    
+    if len(text) <= PROJECT_STREAM_BYTES:
+        value = jsonPick(json.loads(text), fieldTrie(fields))
+    else:
+        value, end = jsonProject(text, jsonSkipSpace(text, 0), fieldTrie(fields), True)
+        
+    if value is JSON_MISSING:
+        return dict()
+    return value
+    
+    
+#----------------------------------------------------------------
+def jsonPick(value, trie):
+    #   This def projects an already decoded value through trie, returning the projected value or JSON_MISSING
+    
+    if trie is True:
+        return value
+    
+    if isinstance(value, dict):
+        projected = dict()
+        for key, child in trie.items():
+            if key in value:
+                picked = jsonPick(value[key], child)
+                if picked is not JSON_MISSING:
+                    projected[key] = picked
+        return projected
+    
+    if isinstance(value, list):
+        projected = []
+        wildcard = trie.get('*')
+        for index, item in enumerate(value):
+            child = trie.get(index, wildcard)
+            if child is None:
+                continue
+            picked = jsonPick(item, child)
+            if picked is not JSON_MISSING:
+                projected.extend([None] * (index - len(projected)))
+                projected.append(picked)
+        return projected
+    
+    #   A scalar where the path wanted to go deeper, nothing to keep
+    return JSON_MISSING
+    
+    
+#----------------------------------------------------------------
+def jsonSkipSpace(text, pos):
+    #   This def returns the position of the next non-whitespace character
+    
+    return JSON_WHITESPACE.match(text, pos).end()
+    
+    
+#----------------------------------------------------------------
+def jsonProject(text, pos, trie, last):
+    #   This def projects the value starting at pos through trie, returning (projected value or JSON_MISSING, end position)
+    #       last means nothing after this value is wanted, so once trie is satisfied we can return None as the
+    #       end position and every caller above us stops reading too
+    
+    #   Whole value wanted, hand it to the C decoder
+    if trie is True:
+        return JSON_DECODER.raw_decode(text, pos)
+    
+    opener = text[pos]
+    
+    if opener == '{':
+        projected = dict()
+        remaining = set(trie)
+        pos = jsonSkipSpace(text, pos + 1)
+        
+        if text[pos] == '}':
+            return projected, pos + 1
+        
+        while True:
+            if text[pos] != '"':
+                raise ValueError("Expecting property name at char %s" % pos)
+            
+            key, pos = JSON_SCANSTRING(text, pos + 1)
+            pos = jsonSkipSpace(text, pos)
+            if text[pos] != ':':
+                raise ValueError("Expecting ':' at char %s" % pos)
+            pos = jsonSkipSpace(text, pos + 1)
+            
+            if key in remaining:
+                remaining.discard(key)
+                value, pos = jsonProject(text, pos, trie[key], last and not remaining)
+                if value is not JSON_MISSING:
+                    projected[key] = value
+                    
+                #   Everything wanted has been read
+                if pos is None or (last and not remaining):
+                    return projected, None
+            else:
+                pos = JSON_DECODER.raw_decode(text, pos)[1]
+            
+            pos = jsonSkipSpace(text, pos)
+            if text[pos] == ',':
+                pos = jsonSkipSpace(text, pos + 1)
+            elif text[pos] == '}':
+                return projected, pos + 1
+            else:
+                raise ValueError("Expecting ',' or '}' at char %s" % pos)
+    
+    if opener == '[':
+        projected = []
+        wildcard = trie.get('*')
+        remaining = set(index for index in trie if index != '*')
+        pos = jsonSkipSpace(text, pos + 1)
+        
+        if text[pos] == ']':
+            return projected, pos + 1
+        
+        index = 0
+        while True:
+            child = trie.get(index, wildcard)
+            
+            if child is None:
+                pos = JSON_DECODER.raw_decode(text, pos)[1]
+            else:
+                remaining.discard(index)
+                done = last and wildcard is None and not remaining
+                
+                value, pos = jsonProject(text, pos, child, done)
+                if value is not JSON_MISSING:
+                    projected.extend([None] * (index - len(projected)))
+                    projected.append(value)
+                    
+                if pos is None or done:
+                    return projected, None
+            
+            index = index + 1
+            pos = jsonSkipSpace(text, pos)
+            if text[pos] == ',':
+                pos = jsonSkipSpace(text, pos + 1)
+            elif text[pos] == ']':
+                return projected, pos + 1
+            else:
+                raise ValueError("Expecting ',' or ']' at char %s" % pos)
+    
+    #   A scalar where the path wanted to go deeper, nothing to keep
+    return JSON_MISSING, JSON_DECODER.raw_decode(text, pos)[1]
+    
+    
+#----------------------------------------------------------------
+def singleFlight(key, fetch):
+    #   This def runs fetch() once per key at a time, anyone asking for the same key meanwhile waits and gets the same answer
+    
+    with INFLIGHT_LOCK:
+        call = INFLIGHT.get(key)
+        leader = call is None
+        if leader:
+            call = {'done': threading.Event(), 'result': None, 'error': None}
+            INFLIGHT[key] = call
+    
+    if not leader:
+        metricCount('coalesced_total')
+        call['done'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+    
+    try:
+        call['result'] = fetch()
+        return call['result']
+    
+    except BaseException as e:
+        call['error'] = e
+        raise
+    
+    finally:
+        with INFLIGHT_LOCK:
+            del INFLIGHT[key]
+        call['done'].set()
+        
+        
+#----------------------------------------------------------------
+def httpSession():
+    #   This def hands back the process wide requests session, built once with a bounded keep-alive pool
+    global HTTP_SESSION
+    
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            import requests
+            
+            session = requests.Session()
+            
+            #   Retries are done by httpFetch so they can be jittered and pass through rateAcquire
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE,
+                                                    pool_block=True, max_retries=0)
+            
+            #   Pools whose connections time their own dns lookup and connect for the instrumentation
+            adapter.poolmanager.pool_classes_by_scheme = timedPools()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            
+            HTTP_SESSION = session
+            
+    return HTTP_SESSION
+    
+    
+#----------------------------------------------------------------------------
+
+def timedPools():
+    #   This def builds (once) the urllib3 pool classes whose connections time their own dns lookup and connect
+    #       They're made here rather than at import so a cache hit never loads urllib3
+    global TIMED_POOLS
+    
+    if TIMED_POOLS is not None:
+        return TIMED_POOLS
+    
+    import socket
+    import urllib3
+    
+    class TimedConnection(object):
+        #   urllib3 connection mixin that resolves the host itself so dns and connect can be timed apart
+        #       The times land on this thread's METRIC_LOCAL for httpFetch to book against the request
+    
+        def _new_conn(self):
+            host = self._dns_host
+            started = time.perf_counter()
+        
+            try:
+                address = socket.getaddrinfo(host, self.port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)[0][4][0]
+            except (socket.gaierror, IndexError):
+                address = None
+            
+            resolved = time.perf_counter()
+            METRIC_LOCAL.dns = resolved - started
+        
+            #   Connecting to the address we resolved, falling back to urllib3's own lookup (every address) if it won't take
+            try:
+                if address is not None:
+                    self._dns_host = address
+                    try:
+                        return super(TimedConnection, self)._new_conn()
+                    except urllib3.exceptions.NewConnectionError:
+                        pass
+                    finally:
+                        self._dns_host = host
+                return super(TimedConnection, self)._new_conn()
+        
+            finally:
+                METRIC_LOCAL.connect = time.perf_counter() - resolved
+            
+            
+    class TimedHTTPConnection(TimedConnection, urllib3.connection.HTTPConnection):
+        pass
+    
+    
+    class TimedHTTPSConnection(TimedConnection, urllib3.connection.HTTPSConnection):
+        pass
+    
+    
+    class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+    
+    
+    class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+        
+        
+    TIMED_POOLS = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+    return TIMED_POOLS
+    
+    
+#----------------------------------------------------------------
+def wuErrorRetryable(wu_error):
+    #   This def classifies the error block WU hands back with a 200, rate limiting is worth another go, bad keys/queries are not
+    
+    error_type = str(wu_error.get('type', '')).lower()
+    error_desc = str(wu_error.get('description', '')).lower()
+    
+    if error_type in WU_RETRYABLE_ERRORS:
+        return True
+    
+    return ('rate limit' in error_desc) or ('too many' in error_desc) or ('calls per minute' in error_desc)
+    
+    
+#----------------------------------------------------------------
+def httpBackoff(attempt, retry_after=None):
+    #   This def returns how long to sleep before retry number 'attempt' (full jitter, capped at HTTP_BACKOFF_MAX)
+    
+    import random
+    
+    delay = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+    
+    #   Honoring the server when it tells us how long to wait
+    if retry_after is not None:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+        
+    return delay
+    
+    
+#----------------------------------------------------------------
+def httpFetch(assembled_query):
+    #   This def pulls a single query over the shared session and returns the raw json text
+    #       5xx/429 responses, connection errors and WU rate-limit bodies are retried up to HTTP_RETRIES times,
+    #       the last payload (error body and all) is handed back for apiPoll to report on
+    
+    import requests
+    
+    session = httpSession()
+    feature = queryFeature(assembled_query)
+    attempt = 0
+    
+    while True:
+        #   Every attempt is a real API call so each one waits its turn against the limits
+        quota_started = time.perf_counter()
+        rateAcquire()
+        metricPhase('quota', time.perf_counter() - quota_started)
+        
+        #   dns/connect are filled in by TimedConnection when this request has to open a new connection
+        METRIC_LOCAL.dns = 0.0
+        METRIC_LOCAL.connect = 0.0
+        request_started = time.perf_counter()
+        
+        try:
+            r = session.get(assembled_query, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+            
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metricCount('retries_total' if attempt < HTTP_RETRIES else 'errors_total', feature=feature, kind='connection')
+            if attempt >= HTTP_RETRIES:
+                raise
+            logWarning("Connection problem on %s (%s), retrying" % (cacheKey(assembled_query), e))
+            httpSleep(httpBackoff(attempt))
+            attempt = attempt + 1
+            continue
+        
+        httpPhases(r, request_started, feature)
+        
+        #   Server side trouble, try again after backing off
+        if (r.status_code >= 500 or r.status_code == 429) and attempt < HTTP_RETRIES:
+            metricCount('retries_total', feature=feature, kind='http_%s' % r.status_code)
+            logWarning("HTTP %s on %s, retrying" % (r.status_code, cacheKey(assembled_query)))
+            httpSleep(httpBackoff(attempt, r.headers.get('Retry-After')))
+            attempt = attempt + 1
+            continue
+        
+        r.raise_for_status()
+        
+        #   JSON is utf-8, decoding it ourselves skips requests' charset sniffing over the whole body
+        body = r.content.decode('utf-8')
+        
+        #   WU answers with a 200 even when it's refusing us, only the rate limit flavor is worth waiting out
+        wu_error = projectJson(body, ['response.error']).get('response', {}).get('error')
+        if wu_error and wuErrorRetryable(wu_error) and attempt < HTTP_RETRIES:
+            metricCount('retries_total', feature=feature, kind='ratelimited')
+            logWarning("Weather Underground rate limited %s, retrying" % cacheKey(assembled_query))
+            httpSleep(httpBackoff(attempt))
+            attempt = attempt + 1
+            continue
+        
+        return body
+        
+        
+#----------------------------------------------------------------
+def httpPhases(r, request_started, feature):
+    #   This def splits one request's time into phases: dns and connect (new connections only), wait until the
+    #       response headers were in (requests' elapsed), then transfer of the body
+    
+    total = time.perf_counter() - request_started
+    headers_in = r.elapsed.total_seconds()
+    dns = getattr(METRIC_LOCAL, 'dns', 0.0)
+    connect = getattr(METRIC_LOCAL, 'connect', 0.0)
+    
+    if dns or connect:
+        metricCount('connections_total')
+        metricPhase('dns', dns)
+        metricPhase('connect', connect)
+        
+    metricPhase('wait', max(0.0, headers_in - dns - connect))
+    metricPhase('transfer', max(0.0, total - headers_in))
+    metricCount('upstream_bytes_total', len(r.content), feature=feature, status=r.status_code)
+    
+    
+#----------------------------------------------------------------
+def httpSleep(delay):
+    #   This def sleeps between retries, booking it as backoff time
+    
+    metricPhase('backoff', delay)
+    time.sleep(delay)
+        
+        
+#----------------------------------------------------------------
+def rateAcquire():
+    #   This def blocks until the shared quota ledger lets this process make one API call, then books it
+    #       Calls are queued by QUOTA_PRIORITY across every process on the same key. When the wait is noticeable
+    #       we say how long to expect and keep waiting, unless
+    #       QUOTA_MAX_WAIT is set and the wait is past it, then we stop and report it instead of sitting there.
+    
+    prefetchPace()
+    
+    waiter_id = '%s-%s-%s' % (os.getpid(), threading.get_ident(), next(QUOTA_WAITER_IDS))
+    reported = False
+    
+    while True:
+        wait, reason = quotaLedger(lambda ledger: quotaTry(ledger, waiter_id, QUOTA_PRIORITY, time.time()))
+        
+        if wait == 0:
+            return
+        
+        if QUOTA_MAX_WAIT is not None and wait > QUOTA_MAX_WAIT:
+            quotaLedger(lambda ledger: ledger['waiters'].pop(waiter_id, None))
+            raise RuntimeError("Weather Underground quota exhausted (%s), next call expected in %s" % (reason, quotaWaitText(wait)))
+        
+        if wait >= 1 and not reported:
+            sys.stderr.write("Waiting about %s for Weather Underground quota (%s)\n" % (quotaWaitText(wait), reason))
+            reported = True
+            
+        time.sleep(min(wait, QUOTA_POLL))
+        
+        
+#----------------------------------------------------------------
+def prefetchPace():
+    #   This def holds a prefetcher's call back until its slot comes up, slots being PREFETCH_SPACING apart
+    #       Slots are handed out under a lock so parallel history fetches queue up one behind the other too
+    global PREFETCH_NEXT_CALL
+    
+    if PREFETCH_SPACING is None:
+        return
+    
+    with PREFETCH_PACE_LOCK:
+        slot = max(time.time(), PREFETCH_NEXT_CALL)
+        PREFETCH_NEXT_CALL = slot + PREFETCH_SPACING
+    
+    pause = slot - time.time()
+    if pause > 0:
+        time.sleep(pause)
+        
+        
+#----------------------------------------------------------------
+def quotaTry(ledger, waiter_id, priority, now):
+    #   This def is one pass at the ledger for a queued call: books the call if it's at the head of the queue and
+    #       both budgets have room, otherwise returns how long it should expect to wait. Returns (seconds, reason)
+    
+    #   Minute budget is a sliding window of call times, the day budget resets with the calendar day
+    ledger['minute'] = sorted(t for t in ledger['minute'] if t > now - 60)
+    today = date.fromtimestamp(now).isoformat()
+    if ledger['day'] != today:
+        ledger['day'] = today
+        ledger['day_count'] = 0
+    
+    #   Waiters re-stamp themselves every pass, ones that went quiet (crashed, killed) drop out of the queue
+    waiters = ledger['waiters']
+    for other_id in [other_id for other_id, waiter in waiters.items() if waiter[2] < now - QUOTA_WAITER_TIMEOUT]:
+        del waiters[other_id]
+    waiter = waiters.setdefault(waiter_id, [priority, now, now])
+    waiter[2] = now
+    
+    queue = sorted(waiters, key=lambda other_id: (waiters[other_id][0], waiters[other_id][1]))
+    ahead = queue.index(waiter_id)
+    
+    wait = 0.0
+    reason = ''
+    
+    if len(ledger['minute']) >= API_CALLS_PER_MIN:
+        wait = ledger['minute'][-API_CALLS_PER_MIN] + 60 - now
+        reason = '%s calls/min budget' % API_CALLS_PER_MIN
+        
+    if ledger['day_count'] >= API_CALLS_PER_DAY:
+        tomorrow = datetime.datetime.combine(date.fromtimestamp(now) + timedelta(days=1), datetime.time())
+        wait = max(wait, time.mktime(tomorrow.timetuple()) - now)
+        reason = '%s calls/day budget' % API_CALLS_PER_DAY
+    
+    #   Head of the queue with room in both budgets: spend it
+    if ahead == 0 and wait <= 0:
+        ledger['minute'].append(now)
+        ledger['day_count'] = ledger['day_count'] + 1
+        quotaCount()
+        del waiters[waiter_id]
+        return 0, ''
+    
+    #   Behind someone: roughly one minute-budget slot each before our turn, on top of whatever budget is holding us all up
+    if ahead > 0:
+        wait = max(wait, QUOTA_POLL) + ahead * 60.0 / API_CALLS_PER_MIN
+        reason = '%s%s queued ahead' % (reason + ', ' if reason else '', ahead)
+        
+    return wait, reason
+    
+    
+#----------------------------------------------------------------
+def quotaCount():
+    #   This def tallies an upstream call booked by this process
+    global API_CALLS_MADE
+    
+    with API_CALLS_LOCK:
+        API_CALLS_MADE = API_CALLS_MADE + 1
+        
+        
+#----------------------------------------------------------------
+def quotaLedger(update):
+    #   This def runs update(ledger) under an exclusive lock on this API key's ledger file and saves what it leaves behind
+    #       Returns whatever update returns
+    
+    import hashlib
+    
+    key_hash = hashlib.sha1(API_KEY.strip('/').encode('utf-8')).hexdigest()[:16]
+    ledger_path = os.path.join(CACHE_DIR, 'quota_%s.json' % key_hash)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    
+    with open(ledger_path, 'a+') as ledger_file:
+        ledger_file.seek(0)
+        if fcntl is not None:
+            fcntl.flock(ledger_file.fileno(), fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(ledger_file.fileno(), msvcrt.LK_LOCK, 1)
+            
+        try:
+            ledger_file.seek(0)
+            try:
+                ledger = json.loads(ledger_file.read() or '{}')
+            except ValueError:
+                ledger = dict()
+            
+            ledger.setdefault('minute', [])
+            ledger.setdefault('day', '')
+            ledger.setdefault('day_count', 0)
+            ledger.setdefault('waiters', dict())
+            
+            result = update(ledger)
+            
+            ledger_file.seek(0)
+            ledger_file.truncate()
+            ledger_file.write(json.dumps(ledger))
+            ledger_file.flush()
+            
+        finally:
+            ledger_file.seek(0)
+            if fcntl is not None:
+                fcntl.flock(ledger_file.fileno(), fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(ledger_file.fileno(), msvcrt.LK_UNLCK, 1)
+                
+    return result
+    
+    
+#----------------------------------------------------------------
+def quotaWaitText(seconds):
+    #   This def prints a wait as something a person can read at a glance
+    
+    seconds = int(seconds + 0.999)
+    if seconds < 60:
+        return '%ss' % seconds
+    if seconds < 3600:
+        return '%sm %ss' % (seconds // 60, seconds % 60)
+    return '%sh %sm' % (seconds // 3600, (seconds % 3600) // 60)
+    
+    
+#----------------------------------------------------------------
+def quotaStatus():
+    #   This def prints where the shared ledger stands for the current API key
+    
+    def peek(ledger):
+        now = time.time()
+        minute = [t for t in ledger['minute'] if t > now - 60]
+        day_count = ledger['day_count'] if ledger['day'] == date.today().isoformat() else 0
+        waiters = [waiter for waiter in ledger['waiters'].values() if waiter[2] >= now - QUOTA_WAITER_TIMEOUT]
+        return minute, day_count, waiters
+    
+    minute, day_count, waiters = quotaLedger(peek)
+    
+    print("\n   Weather Underground quota for this API key")
+    print("Calls in the last minute: %s of %s" % (len(minute), API_CALLS_PER_MIN))
+    print("Calls today:              %s of %s" % (day_count, API_CALLS_PER_DAY))
+    print("Calls waiting:            %s" % len(waiters))
+    
+    if day_count >= API_CALLS_PER_DAY:
+        print("Next call expected in:    tomorrow")
+    elif len(minute) >= API_CALLS_PER_MIN:
+        print("Next call expected in:    %s" % quotaWaitText(sorted(minute)[-API_CALLS_PER_MIN] + 60 - time.time()))
+    else:
+        print("Next call expected in:    now")
+        
+        
+#----------------------------------------------------------------
+def stationIndex():
+    #   This def loads the location -> station index once per process: the offline table first, then what's been resolved before
+    global STATION_INDEX
+    
+    if STATION_INDEX is not None:
+        return STATION_INDEX
+    
+    index = dict()
+    
+    if STATION_TABLE_FILE:
+        import csv
+        
+        try:
+            with open(STATION_TABLE_FILE, newline='') as table:
+                for row in csv.reader(table):
+                    if len(row) >= 2 and row[0].strip() and not row[0].startswith('#'):
+                        index[row[0].strip().lower()] = (row[1].strip(), None)
+        except OSError as e:
+            logWarning("Could not read station table %s: %s" % (STATION_TABLE_FILE, e))
+    
+    try:
+        with CACHE_LOCK:
+            conn = cacheOpen()
+            for location, station, expires in conn.execute("SELECT location, station, expires FROM stations"):
+                #   The offline table wins over anything we looked up
+                index.setdefault(location, (station, expires))
+    except (sqlite3.Error, OSError) as e:
+        logWarning("Could not read station index: %s" % e)
+    
+    STATION_INDEX = index
+    return STATION_INDEX
+    
+    
+#----------------------------------------------------------------
+def resolveLocation(location):
+    #   This def turns a zipcode or ST/City into the WU query for its reporting station, ie; 94541 -> KHWD
+    #       Unresolvable locations (or RESOLVE_STATIONS off) come back untouched so WU can still have a go at them
+    
+    if not RESOLVE_STATIONS:
+        return location
+    
+    location_key = location.strip().strip('/').lower()
+    
+    with STATION_LOCK:
+        index = stationIndex()
+        
+        if location_key in index:
+            station, expires = index[location_key]
+            if expires is None or expires > time.time():
+                return station
+    
+    #   Callers resolving the same location at the same time share the one lookup
+    return singleFlight('station:%s' % location_key, lambda: stationLookup(location, location_key))
+    
+    
+#----------------------------------------------------------------
+def stationLookup(location, location_key):
+    #   This def spends one geolookup call on a location and remembers the answer, found or not
+    #       A station is good for STATION_TTL, a location WU couldn't place stands for itself for STATION_MISS_TTL,
+    #       and a lookup that never got an answer stands for itself until this process exits
+    
+    try:
+        geo = apiPoll("%s%sgeolookup/q/%s%s" % (WU_URL, API_KEY, location, URL_EXTENSION), ['location.nearby_weather_stations'],
+                      raise_errors=True)
+        station = stationFromGeolookup(geo)
+        
+    except ValueError as e:
+        logWarning("Station lookup failed for %s: %s" % (location, e))
+        station = None
+        
+    except Exception as e:
+        logWarning("Station lookup failed for %s: %s" % (location, e))
+        with STATION_LOCK:
+            STATION_INDEX[location_key] = (location, float('inf'))
+        return location
+    
+    if station is None:
+        station = location
+        expires = time.time() + STATION_MISS_TTL
+    else:
+        expires = time.time() + STATION_TTL
+        
+    with STATION_LOCK:
+        STATION_INDEX[location_key] = (station, expires)
+        
+    try:
+        with CACHE_LOCK:
+            conn = cacheOpen()
+            conn.execute("INSERT OR REPLACE INTO stations (location, station, expires) VALUES (?, ?, ?)",
+                         (location_key, station, expires))
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        logWarning("Could not save station for %s: %s" % (location, e))
+        
+    return station
+    
+    
+#----------------------------------------------------------------
+def stationFromGeolookup(geo):
+    #   This def picks the reporting station out of a geolookup payload, airports (ICAO) first, then personal weather stations
+    
+    nearby = geo.get('location', {}).get('nearby_weather_stations', {})
+    
+    for station in nearby.get('airport', {}).get('station', []):
+        if station.get('icao'):
+            return station['icao']
+        
+    for station in nearby.get('pws', {}).get('station', []):
+        if station.get('id'):
+            return 'pws:%s' % station['id']
+        
+    return None
+    
+    
+#----------------------------------------------------------------
+def storeDir():
+    #   This def returns where the history store lives
+    
+    if STORE_DIR:
+        return STORE_DIR
+    return os.path.join(CACHE_DIR, 'history')
+    
+    
+#----------------------------------------------------------------
+def storeStation(station, days_needed=0):
+    #   This def maps a station's column files, growing them (in STORE_GROW_DAYS steps) when days_needed is past the end
+    #       Returns {'days': n, 'columns': {name: memoryview}, 'conds': [condition names], ...}, or None
+    #       when reading a station we have nothing for. Must be called holding STORE_LOCK.
+    
+    entry = STORE_STATIONS.get(station)
+    station_dir = os.path.join(storeDir(), re.sub(r'[^A-Za-z0-9_.-]', '_', station))
+    
+    #   Another process may have grown the files since we mapped them
+    if entry is not None and days_needed > entry['days']:
+        storeRelease(entry)
+        entry = None
+        
+    if entry is None:
+        if not os.path.isdir(station_dir):
+            if days_needed == 0:
+                return None
+            os.makedirs(station_dir, exist_ok=True)
+        
+        entry = {'dir': station_dir, 'conds': storeConds(station_dir), 'files': [], 'maps': [], 'columns': dict(), 'days': None}
+        
+        for name, typecode in STORE_COLUMNS:
+            itemsize = memoryview(b'\0' * 8).cast(typecode).itemsize
+            column_path = os.path.join(station_dir, '%s.%s' % (name, typecode))
+            
+            column_file = open(column_path, 'a+b')
+            size = os.fstat(column_file.fileno()).st_size
+            
+            #   Growing with sparse zero fill, zero in 'have' means we never stored that day
+            if size < days_needed * itemsize:
+                size = (days_needed + STORE_GROW_DAYS) * itemsize
+                column_file.truncate(size)
+            
+            entry['files'].append(column_file)
+            if size == 0:
+                entry['days'] = 0
+                continue
+            
+            column_map = mmap.mmap(column_file.fileno(), size)
+            entry['maps'].append(column_map)
+            entry['columns'][name] = memoryview(column_map).cast(typecode)
+            
+            days = size // itemsize
+            entry['days'] = days if entry['days'] is None else min(entry['days'], days)
+        
+        STORE_STATIONS[station] = entry
+        
+    return entry
+    
+    
+#----------------------------------------------------------------
+def storeConds(station_dir):
+    #   This def reads a station's condition names, the column only holds their index (0 is unknown)
+    #       The side table is only ever appended to (see storeCondition), so an index means the same name to every process
+    
+    conds_path = os.path.join(station_dir, 'conds.json')
+    if not os.path.exists(conds_path):
+        return ['']
+    
+    with open(conds_path) as conds_file:
+        return json.load(conds_file)
+    
+    
+#----------------------------------------------------------------
+def storeCondition(entry, conds):
+    #   This def returns the index of a condition name for a station, adding it to the side table if it's new
+    #       Other processes add to the same table, so it's reloaded under an exclusive lock before appending and
+    #       replaced whole, readers never see it half written
+    
+    if conds in entry['conds']:
+        return entry['conds'].index(conds)
+    
+    with open(os.path.join(entry['dir'], 'conds.lock'), 'a+b') as lock_file:
+        lock_file.seek(0)
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            
+        try:
+            entry['conds'] = storeConds(entry['dir'])
+            if conds not in entry['conds']:
+                entry['conds'].append(conds)
+                conds_path = os.path.join(entry['dir'], 'conds.json')
+                with open(conds_path + '.tmp', 'w') as conds_file:
+                    json.dump(entry['conds'], conds_file)
+                os.replace(conds_path + '.tmp', conds_path)
+                
+        finally:
+            lock_file.seek(0)
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+                
+    return entry['conds'].index(conds)
+    
+    
+#----------------------------------------------------------------
+def storeRelease(entry):
+    #   This def unmaps and closes a station's column files
+    
+    for view in entry['columns'].values():
+        view.release()
+    for column_map in entry['maps']:
+        column_map.close()
+    for column_file in entry['files']:
+        column_file.close()
+    entry['columns'] = dict()
+        
+        
+#----------------------------------------------------------------
+def storeRead(station, first_day, days):
+    #   This def returns the stored columns for 'days' days starting at first_day, as {name: slice}
+    #       Each column is one contiguous slice off the memory map, no per-day seeks or lookups.
+    #       'conds' is translated back to names, anything outside the stored range reads as missing ('have' of 0)
+    
+    start = (first_day - STORE_EPOCH).days
+    
+    with STORE_LOCK:
+        entry = storeStation(station)
+        
+        #   Picking up growth made by other processes before deciding we don't have a day
+        if entry is not None and start + days > entry['days']:
+            entry = storeStation(station, min(start + days, os.path.getsize(os.path.join(entry['dir'], 'have.B'))))
+        
+        result = dict()
+        for name, typecode in STORE_COLUMNS:
+            if entry is None or name not in entry['columns'] or start < 0:
+                result[name] = [0] * days
+                continue
+            
+            column = entry['columns'][name][max(0, start):start + days]
+            result[name] = column.tolist() + [0] * (days - len(column))
+            
+        if entry is not None:
+            #   Codes past the end of our copy of the side table were added by another process since we loaded it
+            if result['conds'] and max(result['conds']) >= len(entry['conds']):
+                entry['conds'] = storeConds(entry['dir'])
+            result['conds'] = [entry['conds'][code] if code < len(entry['conds']) else '' for code in result['conds']]
+        
+    return result
+    
+    
+#----------------------------------------------------------------
+def storeWrite(station, day, summary):
+    #   This def saves one day's summary (see historySummary) into the station's columns
+    
+    offset = (day - STORE_EPOCH).days
+    if offset < 0:
+        return
+    
+    try:
+        with STORE_LOCK:
+            entry = storeStation(station, offset + 1)
+            
+            code = storeCondition(entry, summary.get('conds', ''))
+            
+            for name, typecode in STORE_COLUMNS:
+                if name == 'conds':
+                    entry['columns'][name][offset] = code
+                elif name == 'have':
+                    continue
+                else:
+                    entry['columns'][name][offset] = summary.get(name, float('nan'))
+            
+            #   Flipping 'have' last so a reader never sees a half written day
+            entry['columns']['have'][offset] = 1
+            
+    except (OSError, ValueError) as e:
+        logWarning("Could not store history for %s on %s: %s" % (station, day, e))
+        
+        
+#----------------------------------------------------------------
+def cacheKey(assembled_query):
+    #   This def strips the API key out of a query URL so the cache is shared between keys
+    #       http://api.wunderground.com/api/<key>/conditions/q/94541.json -> http://api.wunderground.com/api/conditions/q/94541.json
+    
+    return re.sub(r'/api/[^/]+/', '/api/', assembled_query, count=1)
+    
+    
+#----------------------------------------------------------------
+def cacheTTL(assembled_query):
+    #   This def decides how long a payload stays fresh based on the features in the query URL
+    #       Returns seconds, or None if the payload never expires (history of a day that's already over)
+    
+    features = cacheKey(assembled_query).split('/api/', 1)[-1].split('/q/', 1)[0].split('/')
+    
+    ttls = []
+    for feature in features:
+        #   Doubled slashes in the URL leave empty segments behind
+        if not feature:
+            continue
+            
+        if feature.startswith(TIME_FRAME):
+            #   history_YYYYMMDD: past days are set in stone, today's summary is still filling in
+            try:
+                hist_day = datetime.datetime.strptime(feature[len(TIME_FRAME):], '%Y%m%d').date()
+            except ValueError:
+                ttls.append(CACHE_TTL_HISTORY_TODAY)
+                continue
+            
+            if hist_day < date.today():
+                continue
+            ttls.append(CACHE_TTL_HISTORY_TODAY)
+            
+        elif feature == 'conditions':
+            ttls.append(CACHE_TTL_CONDITIONS)
+            
+        elif feature == 'forecast':
+            ttls.append(CACHE_TTL_FORECAST)
+            
+        #   Anything we don't know about gets the shortest lifetime we hand out
+        else:
+            ttls.append(min(CACHE_TTL_CONDITIONS, CACHE_TTL_FORECAST))
+    
+    #   A chained query is only as fresh as its shortest lived feature
+    if ttls:
+        return min(ttls)
+    return None
+    
+    
+#----------------------------------------------------------------
+def cacheOpen():
+    #   This def opens (and creates if needed) the sqlite cache db, only once per process
+    global CACHE_CONN
+    
+    if CACHE_CONN is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        
+        CACHE_CONN = sqlite3.connect(os.path.join(CACHE_DIR, CACHE_DB_NAME), timeout=10, check_same_thread=False)
+        CACHE_CONN.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           " key      TEXT PRIMARY KEY,"
+                           " body     TEXT    NOT NULL,"
+                           " size     INTEGER NOT NULL,"
+                           " fetched  REAL    NOT NULL,"
+                           " expires  REAL,"
+                           " accessed REAL    NOT NULL)")
+        CACHE_CONN.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        CACHE_CONN.execute("CREATE TABLE IF NOT EXISTS rolling ("
+                           " station  TEXT    NOT NULL,"
+                           " window   INTEGER NOT NULL,"
+                           " end_day  TEXT    NOT NULL,"
+                           " days     TEXT    NOT NULL,"
+                           " total    REAL    NOT NULL,"
+                           " PRIMARY KEY (station, window))")
+        CACHE_CONN.execute("CREATE TABLE IF NOT EXISTS stations ("
+                           " location TEXT PRIMARY KEY,"
+                           " station  TEXT NOT NULL,"
+                           " expires  REAL)")
+        CACHE_CONN.commit()
+        
+    return CACHE_CONN
+    
+    
+#----------------------------------------------------------------
+def cacheGet(cache_key, max_stale=0):
+    #   This def returns (raw json text, stale age) for a key, or (None, None) if we don't have a usable one
+    #       Entries past their TTL are only handed back if they expired no more than max_stale seconds ago,
+    #       stale age is then how old the payload is in seconds (it's None for fresh entries)
+    
+    try:
+        with CACHE_LOCK:
+            now = time.time()
+            
+            #   Hot entries are answered from memory without touching sqlite
+            if cache_key in MEMORY_CACHE:
+                entry = MEMORY_CACHE[cache_key]
+                MEMORY_CACHE.move_to_end(cache_key)
+            else:
+                conn = cacheOpen()
+                row = conn.execute("SELECT body, expires, fetched, accessed FROM responses WHERE key = ?", (cache_key,)).fetchone()
+        
+                if row is None:
+                    return None, None
+                entry = row[:3]
+        
+                #   Bumping the access time keeps this entry away from LRU eviction
+                if now - row[3] > CACHE_TOUCH_INTERVAL:
+                    conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, cache_key))
+                    conn.commit()
+                
+                memoryCachePut(cache_key, *entry)
+        
+        body, expires, fetched = entry
+        
+        if expires is None or expires > now:
+            return body, None
+        
+        #   Stale entries are left for cachePut to overwrite
+        if now - expires <= max_stale:
+            return body, now - fetched
+        return None, None
+    
+    #   A broken cache should never stop us from asking Weather Underground directly
+    except (sqlite3.Error, OSError) as e:
+        logWarning("Cache read failed for %s: %s" % (cache_key, e))
+        return None, None
+    
+    
+#----------------------------------------------------------------
+def cachePut(cache_key, body, ttl):
+    #   This def stores raw json text under cache_key for ttl seconds (None never expires), then evicts past the size cap
+    
+    try:
+        with CACHE_LOCK:
+            conn = cacheOpen()
+            now = time.time()
+            expires = None if ttl is None else now + ttl
+        
+            memoryCachePut(cache_key, body, expires, now)
+            
+            conn.execute("INSERT OR REPLACE INTO responses (key, body, size, fetched, expires, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                         (cache_key, body, len(body), now, expires, now))
+            cacheEvict(conn)
+            conn.commit()
+        
+    except (sqlite3.Error, OSError) as e:
+        logWarning("Cache write failed for %s: %s" % (cache_key, e))
+        
+        
+#----------------------------------------------------------------
+def memoryCachePut(cache_key, body, expires, fetched):
+    #   This def keeps a copy of an entry in the in-process LRU, must be called holding CACHE_LOCK
+    
+    MEMORY_CACHE[cache_key] = (body, expires, fetched)
+    MEMORY_CACHE.move_to_end(cache_key)
+    
+    while len(MEMORY_CACHE) > MEMORY_CACHE_ENTRIES:
+        MEMORY_CACHE.popitem(last=False)
+        
+        
+#----------------------------------------------------------------
+def cacheEvict(conn):
+    #   This def drops least recently used entries until the cache fits under CACHE_MAX_BYTES
+    
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    
+    #   Expired entries go first as they'd need a refetch anyway
+    conn.execute("DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    
+    doomed = []
+    for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC"):
+        if total <= CACHE_MAX_BYTES:
+            break
+        doomed.append((key,))
+        total = total - size
+        
+    conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+    
+    
+#----------------------------------------------------------------
+
+@timedAction('history')
+def lookAtHistory(location=LOCATION_QUERY, location_name=LOCATION_NAME, poller=None):
+    #   This def handles historical requests from the user, 
+    #       including 7-day overall meant temp of an area, per day, and a json holding the data
+    #       location/location_name default to San Jose, batch mode hands in each of its own locations
+
+    #   Json output streams each day out as it arrives, the average follows once the window is complete
+    if OUTPUT_JSON:
+        days = 0
+        window_total = 0
+        for assembled_date, value in rollingStream(location, DAYS_2_GET_HISTORICALS, poller):
+            days = days + 1
+            window_total = window_total + value
+            if OUTPUT_AVG_HIST_7_DAY_BY_DAY:
+                emitRecord({'action': 'pastweekdailyavg', 'location': location_name, 'date': assembled_date, 'meantempi': value})
+                
+        if OUTPUT_AVG_HIST_7_DAY_TOTAL:
+            emitRecord({'action': 'pastweekavg', 'location': location_name, 'days': days,
+                        'meantempi': window_total / days if days else None})
+    
+    #   If the user is solely looking for CLI printed results:
+    elif OUTPUT_AVG_HIST_7_DAY_TOTAL or OUTPUT_AVG_HIST_7_DAY_BY_DAY:
+    
+        # Calling data from the API only once to keep our api key from getting locked out, then parsing differently for each call.
+        #       The rolling window only fetches days it hasn't seen, and nothing at all later in the same day
+        lookup_hist, window_total = rollingWindow(location, DAYS_2_GET_HISTORICALS, poller)
+
+        
+        if OUTPUT_AVG_HIST_7_DAY_TOTAL:
+            weekly_avg = window_total / len(lookup_hist.values())
+            print("\n   The average temperature of %s was %0d F over the last %s days." %  (location_name, weekly_avg, len(lookup_hist)))
+                
+                
+        if OUTPUT_AVG_HIST_7_DAY_BY_DAY:
+            print("\n   The average temperature for the last %s days in %s is as follows:\n" % (len(lookup_hist), location_name))
+            for key, value in lookup_hist.items():
+                print("Average Temperature for %s was %sF" % (key, value))
+        
+        #   If we got this far without outputting it's time to fail
+    else:
+        print("Error: We hit the lookAtHistory function but no output flag was matched")
+        sys.exit(EXIT_STATUS_ERROR)
+            
+#----------------------------------------------------------------------------
+
+@timedAction('currenttemp')
+def currentTemp(given_zip, polled_current_weather=None):
+    #   This def pulls current weather data for a given zipcode
+    #       polled_current_weather can be handed in by the query planner when conditions came down in a chained request
+    
+# http://api.wunderground.com/api/5f348904b60ca855/conditions/q/94541.json    
+    lookup_curr_query = "%s%sconditions/q/%s%s" % (WU_URL, API_KEY, resolveLocation(given_zip), URL_EXTENSION)
+    
+    #   Pulling current data from Weather Underground
+    try:
+        if polled_current_weather is None:
+            polled_current_weather = apiPoll(lookup_curr_query, ACTION_FIELDS['currenttemp'], allow_stale=True)
+    
+        #   Checking to see what data is actually required 
+        #       (Looking forward, if there are calls for more pieces of data we can get away with flagging them and polling only once)
+        if OUTPUT_CURRENT_TEMP:
+        
+            curr_temp = polled_current_weather['current_observation']['temp_f']
+            
+            #   This is currently checking a global boolean variable called OUTPUT_JSON
+            #       It is a placeholder for the possibility of returning json as a switch at the commandline.
+            if not OUTPUT_JSON:
+                print("\n   The current temperature is %0d F in %s%s" % (curr_temp, given_zip, staleNote(polled_current_weather)))
+                
+            #   If OUTPUT_JSON is set the record goes out as a json line, and back to the caller
+            else:
+                emitRecord(staleField({'action': 'currenttemp', 'location': given_zip, 'temp_f': curr_temp}, polled_current_weather))
+                return curr_temp
+            
+            #   Failing to get the current temp data should drop us out and tell us
+    except Exception as e:
+        reportError(e, action='currenttemp', location=given_zip)
+        sys.exit(EXIT_STATUS_ERROR)
+
+    
+#----------------------------------------------------------------------------
+
+@timedAction('forecast')
+def forecastWeather(given_zip, theFuture=None):
+    #   This def takes a user-input zipcode and a switch for either 3-day or "a good day to get out"
+    #       (Future additions may include different preferences for "A good day to get out")
+    #       theFuture can be handed in by the query planner when the forecast came down in a chained request
+    
+    # Making a legend of keys to ease the use of super-long lines ahead
+    fC  = 'forecast'
+    sFc = 'simpleforecast'
+    fCd = 'forecastday'
+    fH  = 'fahrenheit'
+    hG  = 'high'
+    cD  = 'conditions'
+    wD  = 'weekday'
+    mN  = 'monthname'
+    
+    lookup_curr_query = "%s%sforecast/q/%s%s" % (WU_URL, API_KEY, resolveLocation(given_zip), URL_EXTENSION)
+    
+    
+    #   Pulling forecast data from Weather Underground,... or.... the FUTURE!!
+    try:
+        if theFuture is None:
+            theFuture = apiPoll(lookup_curr_query, actionFields([action for action, wanted in (('agoodday', OUTPUT_GOOD_DAY), ('threedayforecast', OUTPUT_THREE_DAY_FORECAST)) if wanted]), allow_stale=True)
+        
+        #Failing to get the forecast data should drop us out and tell us
+    except Exception as e:
+        reportError(e, actions=[action for action, wanted in (('agoodday', OUTPUT_GOOD_DAY), ('threedayforecast', OUTPUT_THREE_DAY_FORECAST)) if wanted],
+                    location=given_zip)
+        sys.exit(EXIT_STATUS_ERROR)
+
+    #   Owning up to an old forecast before anything is said about it
+    if STALE_AGE_KEY in theFuture and not OUTPUT_JSON:
+        print("\n   Forecast for %s%s" % (given_zip, staleNote(theFuture)))
+    
+    #   If the good day flag was thrown check today's conditions and high temp    
+    if OUTPUT_GOOD_DAY:
+        try:
+            # Checking forecastday 0 as that signifies "today" (1, 2, 3 are the 3day forecast)
+            forecast_temp = int(theFuture[fC][sFc][fCd][0][hG][fH])
+            forecast_cond = theFuture[fC][sFc][fCd][0][cD]
+            
+            if OUTPUT_JSON:
+                emitRecord(staleField({'action': 'agoodday', 'location': given_zip, 'good_day': isGoodDay(forecast_temp, forecast_cond),
+                                       'high_f': forecast_temp, 'conditions': forecast_cond}, theFuture))
+            
+            #   Ensuring both the high temp and the sunny conditions are both met then printing
+            elif isGoodDay(forecast_temp, forecast_cond):
+                print("\n   Today will be a good day to get out of the house %s." % userName())
+                print("The forecast is %s with a high of %0d F" % (forecast_cond, forecast_temp))
+                
+            else:
+                print("\n   Today is not a good day to get out %s." % userName())
+                print("The high will be %s with %s conditions" % (forecast_temp, forecast_cond))
+                
+        except Exception as e:
+            reportError(e, action='agoodday', location=given_zip)
+            sys.exit(EXIT_STATUS_ERROR)
+            
+    
+            
+        
+    #   If the 3-day forecast flag is thrown return it
+    if OUTPUT_THREE_DAY_FORECAST:
+        
+        try:
+            three_day_dict = dict()
+            if not OUTPUT_JSON:
+                print("\n   Three Day forecast for %s" % given_zip)
+            
+            for i, forecast_day in forecastDays(theFuture, 1, 3):
+                #   Pushing each day into a seperate dict as storing them via weekday named keys causes sorting
+                three_day_dict.update({'Day%s' % i : forecast_day})
+                
+                #   Json output sends each day on as it's read
+                if OUTPUT_JSON:
+                    emitRecord(staleField({'action': 'threedayforecast', 'location': given_zip, 'day': i,
+                                           'date': '%04d-%02d-%02d' % (int(forecast_day['date']['year']), int(forecast_day['date']['month']), int(forecast_day['date']['day'])),
+                                           'weekday': forecast_day['date'][wD], 'high_f': forecast_day[hG][fH],
+                                           'low_f': forecast_day.get('low', {}).get(fH), 'conditions': forecast_day[cD]}, theFuture))
+                
+        except Exception as e:
+            reportError(e, action='threedayforecast', location=given_zip)
+            sys.exit(EXIT_STATUS_ERROR)
+
+        if OUTPUT_JSON:
+            return three_day_dict
+            
+        else:
+            #   As a json output wasn't asked for, we are simply printing te 3day forecast to stdout
+            for i in range(1, 4):
+                print("\n   The forecast for %s %s %s is %s with a high of %s F" % 
+                (three_day_dict['Day%s' % i]['date'][wD], 
+                 three_day_dict['Day%s' % i]['date'][mN], 
+                 three_day_dict['Day%s' % i]['date']['day'], 
+                 three_day_dict['Day%s' % i][cD], 
+                 three_day_dict['Day%s' % i][hG][fH])
+                )
+        
+        
+                
+#----------------------------------------------------------------------------
+
+def forecastDays(theFuture, first, last):
+    #   This def yields (index, forecastday) for the simpleforecast days first..last (0 is today)
+    
+    forecast_days = theFuture['forecast']['simpleforecast']['forecastday']
+    
+    for i in range(first, last + 1):
+        yield i, forecast_days[i]
+        
+        
+#----------------------------------------------------------------------------
+
+def emitRecord(record):
+    #   This def writes one json output record as its own line and flushes it, so whoever reads our stdout gets it now
+    
+    line = json.dumps(record, sort_keys=True) + '\n'
+    
+    with OUTPUT_LOCK:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        
+        
+#----------------------------------------------------------------------------
+
+def reportError(e, **record):
+    #   This def says what went wrong: a plain line normally, under --json an {'error': ...} record carrying whatever
+    #       the caller knows (action, location) so stdout stays one json object per line
+    
+    if OUTPUT_JSON:
+        record['error'] = str(e)
+        emitRecord(record)
+    else:
+        print("Error: %s" % e)
+        
+        
+#----------------------------------------------------------------------------
+
+def staleField(record, polled):
+    #   This def carries a stale payload's age over to a json record (the text output says it with staleNote)
+    
+    if STALE_AGE_KEY in polled:
+        record['stale_age_s'] = round(polled[STALE_AGE_KEY], 1)
+        
+    return record
+    
+    
+#----------------------------------------------------------------------------
+
+def planQueries(actions, given_zip):
+    #   This def works out the fewest requests needed to serve every location-based action asked for
+    #       Features are deduped and chained into one URL, ie; /conditions/forecast/q/94541.json
+    #       Returns a dict of {assembled_query: [actions served by it]}
+    
+    features = []
+    served = []
+    
+    for action in actions:
+        if action not in ACTION_FEATURES:
+            continue
+        
+        served.append(action)
+        for feature in ACTION_FEATURES[action]:
+            if feature not in features:
+                features.append(feature)
+    
+    if not features:
+        return dict()
+    
+    #   Stable ordering so the same set of actions always builds the same URL
+    features.sort(key=lambda f: FEATURE_ORDER.index(f) if f in FEATURE_ORDER else len(FEATURE_ORDER))
+    
+    query_string = "%s%s%s/q/%s%s" % (WU_URL, API_KEY, '/'.join(features), resolveLocation(given_zip), URL_EXTENSION)
+    
+    return {query_string: served}
+    
+    
+#----------------------------------------------------------------------------
+
+def actionFields(actions):
+    #   This def lists every payload field the given actions read, for apiPoll to project down to
+    
+    fields = []
+    for action in actions:
+        for field in ACTION_FIELDS.get(action, []):
+            if field not in fields:
+                fields.append(field)
+                
+    return fields
+    
+    
+#----------------------------------------------------------------------------
+
+@timedAction('plan')
+def runPlan(actions, given_zip):
+    #   This def polls each planned query once and hands the payload to every output routine that needs it
+    
+    for query_string, served in planQueries(actions, given_zip).items():
+        try:
+            polled = apiPoll(query_string, actionFields(served), allow_stale=True)
+            
+        except Exception as e:
+            reportError(e, actions=served, location=given_zip)
+            sys.exit(EXIT_STATUS_ERROR)
+        
+        if 'currenttemp' in served:
+            currentTemp(given_zip, polled)
+            
+        #   Both forecast actions are handled in the one pass, forecastWeather checks the global flags itself
+        if ('agoodday' in served) or ('threedayforecast' in served):
+            forecastWeather(given_zip, polled)
+    
+    
+#----------------------------------------------------------------------------
+
+def readBatch(batch_source, default_actions):
+    #   This def reads a batch list of locations, one per line, from a file path or '-' for stdin
+    #       Line format:  location[,action,action...]   ie;  94541,currenttemp,agoodday   or   CA/San Jose,pastweekavg
+    #       Lines without actions use the ones thrown on the commandline, blank lines and '#' comments are skipped
+    #       Returns a list of (location, [actions])
+    
+    if batch_source == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(batch_source) as batch_file:
+            lines = batch_file.read().splitlines()
+    
+    batch = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        
+        fields = [field.strip() for field in line.split(',')]
+        location = fields[0].strip('/')
+        actions = [field.lower().lstrip('-') for field in fields[1:] if field] or list(default_actions)
+        
+        for action in actions:
+            if action not in VALID_ACTIONS:
+                raise ValueError("batch line %s: unknown action '%s', expected one of %s" % (line_number, action, ', '.join(VALID_ACTIONS)))
+        
+        if not actions:
+            raise ValueError("batch line %s: no actions given for %s and none on the commandline" % (line_number, location))
+        
+        batch.append((location, actions))
+        
+    return batch
+    
+    
+#----------------------------------------------------------------------------
+
+def setOutputFlags(actions):
+    #   This def points the global output switches at one location's actions, batch mode flips them location by location
+    global OUTPUT_AVG_HIST_7_DAY_TOTAL
+    global OUTPUT_AVG_HIST_7_DAY_BY_DAY
+    global OUTPUT_CURRENT_TEMP
+    global OUTPUT_GOOD_DAY
+    global OUTPUT_THREE_DAY_FORECAST
+    
+    OUTPUT_AVG_HIST_7_DAY_TOTAL  = 'pastweekavg' in actions
+    OUTPUT_AVG_HIST_7_DAY_BY_DAY = 'pastweekdailyavg' in actions
+    OUTPUT_CURRENT_TEMP          = 'currenttemp' in actions
+    OUTPUT_GOOD_DAY              = 'agoodday' in actions
+    OUTPUT_THREE_DAY_FORECAST    = 'threedayforecast' in actions
+    
+    
+#----------------------------------------------------------------------------
+
+@timedAction('batch')
+def runBatch(batch):
+    #   This def runs every (location, actions) pair in one process
+    #       All queries are planned first and collapsed so identical URLs are only polled once,
+    #       then the unique set goes out in parallel over the shared session/cache/rate limiter
+    #       Each location's output is written as soon as its own payloads are in rather than after the slowest one
+    #       Returns EXIT_STATUS_ERROR if any location failed, the rest still get their output
+    
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    #   Merging every line's actions per location first, so repeats of a location share one chained request
+    merged = dict()
+    for location, actions in batch:
+        merged.setdefault(location, [])
+        for action in actions:
+            if action not in merged[location]:
+                merged[location].append(action)
+    
+    #   Resolving every location's station up front and in parallel, planning then reads them straight from the index
+    if RESOLVE_STATIONS and merged:
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(merged)))) as pool:
+            list(pool.map(resolveLocation, merged))
+    
+    #   Planning: unique URLs in first-seen order, each with every field any of its locations will read,
+    #       and which URLs each location is waiting on so it can go out as soon as its own are in
+    wanted = dict()
+    needs = dict()
+    for location, actions in merged.items():
+        needs[location] = set()
+        for query_string, served in planQueries(actions, location).items():
+            wanted.setdefault(query_string, [])
+            wanted[query_string].extend(actionFields(served))
+            needs[location].add(query_string)
+            
+        if any(action in HISTORY_ACTIONS for action in actions):
+            #   Days already in the history store don't need fetching at all
+            stored = None
+            if STORE_ENABLED:
+                stored = storeRead(historyStation('/q/%s' % location), THIS_DAY - timedelta(days=DAYS_2_GET_HISTORICALS), DAYS_2_GET_HISTORICALS)
+            
+            for offset, (assembled_date, query_string) in enumerate(historyQueries(THIS_DAY, DAYS_2_GET_HISTORICALS, API_KEY, '/q/%s' % location)):
+                if stored is not None and stored['have'][offset]:
+                    continue
+                wanted.setdefault(query_string, [])
+                wanted[query_string].extend(HISTORY_FIELDS)
+                needs[location].add(query_string)
+    
+    unique = list(wanted)
+    
+    #   How many locations still need each payload, it's let go once the last of them has been output
+    users = Counter(query_string for location_needs in needs.values() for query_string in location_needs)
+    
+    #   Which locations are waiting on each URL, needs[] is whittled down as payloads arrive
+    waiting = dict()
+    for location, location_needs in needs.items():
+        for query_string in location_needs:
+            waiting.setdefault(query_string, []).append(location)
+    planned = dict((location, set(location_needs)) for location, location_needs in needs.items())
+    
+    polled = dict()
+    failed = dict()
+    
+    def batchPoll(query_string, fields=None):
+        #   Serving from the prefetch, anything we didn't plan for falls through to apiPoll
+        #       WU errors come back as exceptions so they land on their own location's line
+        if query_string in failed:
+            raise failed[query_string]
+        if query_string in polled:
+            return polled[query_string]
+        return apiPoll(query_string, fields, raise_errors=True)
+    
+    def batchLine(location, actions):
+        #   Output for one batch line, returns EXIT_STATUS_ERROR if the location failed
+        if not OUTPUT_JSON:
+            print("\n==== %s ====" % location)
+        setOutputFlags(actions)
+        
+        try:
+            if any(action in HISTORY_ACTIONS for action in actions):
+                lookAtHistory('/q/%s' % location, location, batchPoll)
+            
+            for query_string, served in planQueries(merged[location], location).items():
+                served = [action for action in served if action in actions]
+                if not served:
+                    continue
+                
+                payload = batchPoll(query_string)
+                
+                if 'currenttemp' in served:
+                    currentTemp(location, payload)
+                if ('agoodday' in served) or ('threedayforecast' in served):
+                    forecastWeather(location, payload)
+        
+        #   The output routines report bad data themselves and bail with sys.exit, in a batch that only sinks this location
+        except SystemExit:
+            return EXIT_STATUS_ERROR
+            
+        except Exception as e:
+            reportError('%s failed: %s' % (location, e), location=location, actions=actions)
+            return EXIT_STATUS_ERROR
+        
+        return EXIT_STATUS_OK
+    
+    #   Output: text keeps the order given, so a line waits for those before it. Json lines go out the moment their
+    #       location's payloads are all in. Once a location's last line is out its payloads are dropped.
+    lines_left = Counter(location for location, actions in batch)
+    written = [False] * len(batch)
+    exit_status = EXIT_STATUS_OK
+    
+    def flush():
+        status = EXIT_STATUS_OK
+        
+        for index, (location, actions) in enumerate(batch):
+            if written[index]:
+                continue
+            if needs[location]:
+                if OUTPUT_JSON:
+                    continue
+                break
+            
+            if batchLine(location, actions) != EXIT_STATUS_OK:
+                status = EXIT_STATUS_ERROR
+            written[index] = True
+            
+            lines_left[location] = lines_left[location] - 1
+            if not lines_left[location]:
+                for query_string in planned[location]:
+                    users[query_string] = users[query_string] - 1
+                    if not users[query_string]:
+                        polled.pop(query_string, None)
+                        
+        return status
+    
+    #   Locations answered entirely from the store plan nothing and can go right away
+    if flush() != EXIT_STATUS_OK:
+        exit_status = EXIT_STATUS_ERROR
+    
+    #   Fetching: failures are remembered per URL so only the locations that need them are affected
+    if unique:
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(unique)))) as pool:
+            futures = dict((pool.submit(apiPoll, query_string, wanted[query_string], allow_stale=True, raise_errors=True), query_string)
+                           for query_string in unique)
+            
+            for future in as_completed(futures):
+                query_string = futures[future]
+                try:
+                    polled[query_string] = future.result()
+                except BaseException as e:
+                    failed[query_string] = e
+                    
+                for location in waiting[query_string]:
+                    needs[location].discard(query_string)
+                    
+                if flush() != EXIT_STATUS_OK:
+                    exit_status = EXIT_STATUS_ERROR
+            
+    return exit_status
+    
+    
+#----------------------------------------------------------------------------
+
+def prefetch(watch, once=False):
+    #   This def keeps a watch-list of (location, actions) warm in the local cache/store until interrupted
+    #       Current/forecast payloads are re-pulled just before they'd go stale, yesterday's history shortly after
+    #       midnight (which also slides the rolling window along). Calls are spaced out so the prefetcher never uses
+    #       more than PREFETCH_MINUTE_SHARE of the per-minute budget. once does a single pass and returns.
+    import heapq
+    global THIS_DAY, PREFETCH_SPACING
+    
+    #   Every call we make is spaced, not just every task, a history backfill fans out to HISTORY_WORKERS fetches
+    PREFETCH_SPACING = 60.0 / max(1.0, API_CALLS_PER_MIN * PREFETCH_MINUTE_SHARE)
+    current_every = min(CACHE_TTL_CONDITIONS, CACHE_TTL_FORECAST) * PREFETCH_CURRENT_EVERY
+    
+    #   History goes through the same error path as everything else here rather than exiting the prefetcher
+    def poller(query_string, fields=None):
+        return apiPoll(query_string, fields, raise_errors=True)
+    
+    #   Tasks are (due time, order, kind, location, actions), kinds being 'current' and 'history'
+    order = itertools.count()
+    tasks = []
+    now = time.time()
+    for location, actions in watch:
+        if any(action in ACTION_FEATURES for action in actions):
+            heapq.heappush(tasks, (now, next(order), 'current', location, actions))
+        if any(action in HISTORY_ACTIONS for action in actions):
+            heapq.heappush(tasks, (now, next(order), 'history', location, actions))
+    
+    print("Prefetching %s locations, at most one call every %0.1fs (Ctrl-C to stop)" % (len(watch), PREFETCH_SPACING))
+    
+    behind_warned = False
+    
+    try:
+        while tasks:
+            due, task_order, kind, location, actions = heapq.heappop(tasks)
+            
+            #   Waiting for the task to come due, prefetchPace() waits out the budget for each call it makes
+            pause = due - time.time()
+            if pause > 0 and not once:
+                time.sleep(pause)
+            
+            THIS_DAY = date.today()
+            
+            try:
+                if kind == 'current':
+                    for query_string in planQueries(actions, location):
+                        refreshEntry(query_string)
+                    reschedule = time.time() + current_every
+                    
+                else:
+                    rollingWindow('/q/%s' % location, DAYS_2_GET_HISTORICALS, poller)
+                    tomorrow = datetime.datetime.combine(THIS_DAY + timedelta(days=1), datetime.time())
+                    reschedule = time.mktime(tomorrow.timetuple()) + PREFETCH_HISTORY_AFTER
+            
+            #   One bad location shouldn't stop the rest from staying warm, try it again next round
+            except Exception as e:
+                logWarning("Prefetch of %s for %s failed: %s" % (kind, location, e))
+                reschedule = time.time() + current_every
+            
+            #   A long running prefetcher keeps its metrics file current rather than only writing it at exit
+            metricsWrite()
+            
+            if kind == 'current' and PREFETCH_NEXT_CALL > reschedule and not behind_warned:
+                logWarning("Watch-list is too long to refresh every %0.0fs within the prefetch budget" % current_every)
+                behind_warned = True
+            
+            if not once:
+                heapq.heappush(tasks, (reschedule, task_order, kind, location, actions))
+                
+    except KeyboardInterrupt:
+        pass
+    
+    return EXIT_STATUS_OK
+    
+    
+#----------------------------------------------------------------------------
+
+def storeArrays(station, first_day, days):
+    #   This def reads a station's stored columns for a date range into numpy arrays, one read per column file
+    #       Float columns come back NaN wherever the day was never stored
+    import numpy
+    
+    start = (first_day - STORE_EPOCH).days
+    arrays = dict()
+    
+    station_dir = os.path.join(storeDir(), re.sub(r'[^A-Za-z0-9_.-]', '_', station))
+    for name, typecode in STORE_COLUMNS:
+        dtype = numpy.dtype(STORE_NUMPY_TYPES[typecode])
+        column = numpy.zeros(days, dtype=dtype)
+        column_path = os.path.join(station_dir, '%s.%s' % (name, typecode))
+        
+        #   Reading only the slice we want, days before the epoch or past the end of the file stay empty
+        if os.path.exists(column_path) and start + days > 0:
+            skip = max(0, -start)
+            stored = numpy.fromfile(column_path, dtype=dtype, count=days - skip, offset=max(0, start) * dtype.itemsize)
+            column[skip:skip + len(stored)] = stored
+            
+        arrays[name] = column
+    
+    have = arrays['have'].astype(bool)
+    for name, typecode in STORE_COLUMNS:
+        if typecode == 'f':
+            arrays[name] = numpy.where(have, arrays[name], numpy.nan)
+    arrays['have'] = have
+    
+    return arrays
+    
+    
+#----------------------------------------------------------------------------
+
+def climatology(station, first_day, last_day):
+    #   This def builds day-of-year normals for a station out of the history store, all in vectorized numpy passes
+    #       Days are bucketed by calendar slot (0-365, Feb 29 gets its own), then for each slot we get the mean of
+    #       meantempi, CLIMATE_PERCENTILES of it, the record low (mintempi) and record high (maxtempi)
+    #       Returns a dict of 366 long arrays plus 'count' of years that went into each slot
+    import numpy
+    
+    days = (last_day - first_day).days + 1
+    arrays = storeArrays(station, first_day, days)
+    
+    #   Calendar slot of every day: leap year day-of-year, so Mar 1 is always slot 60 whatever the year
+    dates = numpy.datetime64(first_day.isoformat(), 'D') + numpy.arange(days)
+    months = dates.astype('datetime64[M]')
+    month_index = months.astype(int) % 12
+    month_starts = numpy.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335])
+    slots = month_starts[month_index] + (dates - months).astype(int)
+    
+    report = {'count': numpy.zeros(366, dtype=int)}
+    
+    #   Normals and percentiles of the daily mean
+    mean = arrays['meantempi']
+    valid = ~numpy.isnan(mean)
+    report['count'] = numpy.bincount(slots[valid], minlength=366)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        report['normal'] = numpy.bincount(slots[valid], weights=mean[valid], minlength=366) / report['count']
+    
+    #   Sorting once by (slot, value) puts every slot's values in order next to each other,
+    #       each percentile is then a fractional index into its slot's run
+    order = numpy.lexsort((mean[valid], slots[valid]))
+    ordered = mean[valid][order].astype(float)
+    starts = numpy.concatenate(([0], numpy.cumsum(report['count'])[:-1]))
+    populated = report['count'] > 0
+    
+    for percentile in CLIMATE_PERCENTILES:
+        result = numpy.full(366, numpy.nan)
+        position = (report['count'][populated] - 1) * (percentile / 100.0)
+        low = numpy.floor(position).astype(int)
+        high = numpy.ceil(position).astype(int)
+        base = starts[populated]
+        result[populated] = ordered[base + low] + (ordered[base + high] - ordered[base + low]) * (position - low)
+        report['p%s' % percentile] = result
+    
+    #   Records out of the daily min/max columns
+    for name, field, reducer in (('record_low', 'mintempi', numpy.fmin), ('record_high', 'maxtempi', numpy.fmax)):
+        result = numpy.full(366, numpy.nan)
+        values = arrays[field]
+        has = ~numpy.isnan(values)
+        reducer.at(result, slots[has], values[has])
+        report[name] = result
+    
+    #   Keeping the raw series around for anomaly lookups
+    report['dates'] = dates
+    report['slots'] = slots
+    report['meantempi'] = mean
+    
+    return report
+    
+    
+#----------------------------------------------------------------------------
+
+@timedAction('climatology')
+def lookAtClimatology(locations, first_day, last_day, backfill=False):
+    #   This def prints a climatology report for each location over first_day..last_day
+    #       Reports come from the local history store, backfill pulls any missing days from WU first (slow, it's quota bound)
+    
+    try:
+        import numpy
+    except ImportError:
+        print("Error: climatology reports need numpy installed (pip install numpy)")
+        sys.exit(EXIT_STATUS_ERROR)
+    
+    for location in locations:
+        location_query = '/q/%s' % location.strip('/')
+        station = historyStation(location_query)
+        
+        #   Only the store needs the days, they're not kept as they stream past
+        if backfill:
+            for assembled_date, value in historyStream(last_day + timedelta(days=1), (last_day - first_day).days + 1, API_KEY, location_query):
+                pass
+            
+        report = climatology(station, first_day, last_day)
+        
+        print("\n   Climatology for %s (%s) from %s to %s, %s days on record" %
+              (location, station, first_day, last_day, int(report['count'].sum())))
+        
+        #   Today's slot, and how the latest recorded day compares with its own normal
+        today_slot = int(report['slots'][-1]) if last_day == THIS_DAY else climateSlot(THIS_DAY)
+        if report['count'][today_slot]:
+            print("Normal for %s is %0.1f F (%s), record low %s F, record high %s F" %
+                  (THIS_DAY.strftime('%b %d'), report['normal'][today_slot],
+                   ', '.join('p%s %0.1f' % (p, report['p%s' % p][today_slot]) for p in CLIMATE_PERCENTILES),
+                   climateValue(report['record_low'][today_slot]), climateValue(report['record_high'][today_slot])))
+        else:
+            print("No recorded %s in range to build a normal from" % THIS_DAY.strftime('%b %d'))
+        
+        recorded = numpy.flatnonzero(~numpy.isnan(report['meantempi']))
+        if len(recorded):
+            latest = recorded[-1]
+            slot = report['slots'][latest]
+            anomaly = report['meantempi'][latest] - report['normal'][slot]
+            print("Latest recorded day %s averaged %0.1f F, %+0.1f F against its normal of %0.1f F" %
+                  (report['dates'][latest], report['meantempi'][latest], anomaly, report['normal'][slot]))
+            
+            
+#----------------------------------------------------------------------------
+
+def climateSlot(day):
+    #   This def is the single-date version of the calendar slot climatology() buckets by
+    
+    return (date(2000, day.month, day.day) - date(2000, 1, 1)).days
+
+
+#----------------------------------------------------------------------------
+
+def climateValue(value):
+    #   This def formats a possibly-missing report value
+    
+    if value != value:
+        return 'n/a'
+    return '%0.0f' % value
+    
+    
+#----------------------------------------------------------------------------
+
+def staleNote(polled):
+    #   This def describes how old a stale-served payload is for printed output, empty for fresh ones
+    
+    if STALE_AGE_KEY not in polled:
+        return ''
+    return " (as of %0d min ago, refreshing)" % (polled[STALE_AGE_KEY] // 60)
+    
+    
+#----------------------------------------------------------------------------
+
+def userName():
+    #   This def looks up (once) who we're telling about their good day, getpass only gets loaded when we need it
+    global USER_NAME
+    
+    if USER_NAME is None:
+        import getpass
+        USER_NAME = getpass.getuser()
+    return USER_NAME
+    
+    
+#----------------------------------------------------------------------------
+
+def isGoodDay(forecast_temp, forecast_cond):
+    #   This def is the "good day to get out" rule: exactly our preferred high and conditions
+    
+    return (forecast_temp == PREF_TEMP) and (forecast_cond == PREF_COND)
+    
+    
+#----------------------------------------------------------------------------
+
+def readProfiles(profile_source):
+    #   This def reads good day preference profiles for --bestday, one json object per line from a file path or '-' for stdin
+    #       ie; {"name": "sam", "min_temp": 62, "max_temp": 75, "conditions": ["Clear", "Partly Cloudy"], "max_wind": 12, "max_pop": 20}
+    #       Every key is optional and a limit that's left out doesn't rule anything out. ideal_temp is the high a day is
+    #       scored against (the middle of min_temp..max_temp by default), max_wind is average mph, max_pop the chance of
+    #       precipitation in percent, max_qpf the day's rain in inches and locations narrows it down to some of --locations
+    #       Blank lines and '#' comments are skipped. Returns a list of profile dicts
+    
+    if profile_source == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(profile_source) as profile_file:
+            lines = profile_file.read().splitlines()
+    
+    profiles = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        
+        try:
+            profile = json.loads(line)
+        except ValueError as e:
+            raise ValueError("profile line %s: %s" % (line_number, e))
+        
+        if not isinstance(profile, dict):
+            raise ValueError("profile line %s: expected a json object, got %s" % (line_number, line))
+        
+        for key, value in profile.items():
+            if key in PROFILE_LIMITS:
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError("profile line %s: %s should be a number, got %r" % (line_number, key, value))
+            elif key in PROFILE_LISTS:
+                if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                    raise ValueError("profile line %s: %s should be a list of strings, got %r" % (line_number, key, value))
+            elif key != 'name':
+                raise ValueError("profile line %s: unknown key '%s', expected name, %s" % (line_number, key, ', '.join(PROFILE_LIMITS + PROFILE_LISTS)))
+        
+        profile['name'] = str(profile.get('name', 'profile %s' % line_number))
+        profiles.append(profile)
+        
+    return profiles
+    
+    
+#----------------------------------------------------------------------------
+
+def forecastNumber(value):
+    #   This def reads a forecast figure WU may hand back as a number, a string or not at all (nan when it's missing)
+    
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+        
+        
+#----------------------------------------------------------------------------
+
+def forecastCells(locations):
+    #   This def polls every location's forecast (in parallel, one request each) and lays every forecast day out as flat arrays
+    #       Returns {'location': index into locations, 'date': datetime64[D], 'high'/'wind'/'pop'/'qpf': floats (nan when
+    #       WU left them out), 'conditions': codes into 'vocabulary' (lowercased, 'labels' as WU wrote them)} sorted by date then location,
+    #       or None when no location had a forecast
+    
+    import numpy
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def poll(location):
+        for query_string, served in planQueries(['bestday'], location).items():
+            return apiPoll(query_string, actionFields(served), allow_stale=True, raise_errors=True)
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(locations)))) as pool:
+        futures = [pool.submit(poll, location) for location in locations]
+    
+    rows = []
+    for index, future in enumerate(futures):
+        #   One bad location only leaves its own days out, with whatever WU said about it
+        try:
+            forecast_days = future.result()['forecast']['simpleforecast']['forecastday']
+        except Exception as e:
+            logWarning("No forecast for %s, leaving it out: %s" % (locations[index], e))
+            continue
+        
+        for offset, day in enumerate(forecast_days):
+            if not day:
+                continue
+            
+            try:
+                when = date(int(day['date']['year']), int(day['date']['month']), int(day['date']['day']))
+            except (KeyError, TypeError, ValueError):
+                when = THIS_DAY + timedelta(days=offset)
+            
+            rows.append((index, when, forecastNumber(day.get('high', {}).get('fahrenheit')), str(day.get('conditions', '')),
+                         forecastNumber(day.get('avewind', {}).get('mph')), forecastNumber(day.get('pop')),
+                         forecastNumber(day.get('qpf_allday', {}).get('in'))))
+    
+    if not rows:
+        return None
+    
+    location, when, high, conditions, wind, pop, qpf = zip(*rows)
+    
+    #   Conditions are matched case blind, but printed the way WU wrote them
+    labels = dict()
+    for name in conditions:
+        labels.setdefault(name.lower(), name)
+    vocabulary = sorted(labels)
+    codes = dict((name, code) for code, name in enumerate(vocabulary))
+    
+    cells = {'location':   numpy.array(location, dtype=int),
+             'date':       numpy.array(when, dtype='datetime64[D]'),
+             'high':       numpy.array(high, dtype=float),
+             'conditions': numpy.array([codes[name.lower()] for name in conditions], dtype=int),
+             'wind':       numpy.array(wind, dtype=float),
+             'pop':        numpy.array(pop, dtype=float),
+             'qpf':        numpy.array(qpf, dtype=float)}
+    
+    #   Date first so the earliest of equally good days wins
+    order = numpy.lexsort((cells['location'], cells['date']))
+    cells = dict((name, column[order]) for name, column in cells.items())
+    cells['vocabulary'] = vocabulary
+    cells['labels'] = [labels[name] for name in vocabulary]
+    
+    return cells
+    
+    
+#----------------------------------------------------------------------------
+
+def bestDays(profiles, cells, locations):
+    #   This def scores every profile against every forecast day in cells (see forecastCells) in vectorized passes
+    #       A day fits when its high is inside the profile's range, its conditions are allowed, it's one of the profile's
+    #       locations and wind/pop/qpf are under the limits (a figure WU didn't send, high included, doesn't count against it).
+    #       The best fitting day is the one whose high is closest to ideal_temp, the earliest one on a tie. A day without
+    #       a high can't be scored against ideal_temp, it only gets picked when no fitting day has one.
+    #       Returns (index into cells or -1 when nothing fits, degrees F off ideal or nan) as arrays, one entry per profile
+    
+    import numpy
+    
+    count = len(profiles)
+    
+    #   Profiles into arrays, a missing limit is one nothing can break
+    def limit(key, missing):
+        return numpy.array([float(profile.get(key, missing)) for profile in profiles], dtype=float)
+    
+    min_temp = limit('min_temp', -numpy.inf)
+    max_temp = limit('max_temp', numpy.inf)
+    limits = dict((column, limit(key, numpy.inf)) for key, column in (('max_wind', 'wind'), ('max_pop', 'pop'), ('max_qpf', 'qpf')))
+    
+    #   Ideal high: given, else the middle of the range, else whichever end there is (nan scores every fitting day alike)
+    ideal = limit('ideal_temp', numpy.nan)
+    bounded = numpy.where(numpy.isfinite(min_temp), min_temp, max_temp)
+    with numpy.errstate(invalid='ignore'):
+        middle = numpy.where(numpy.isfinite(min_temp) & numpy.isfinite(max_temp), (min_temp + max_temp) / 2, bounded)
+    ideal = numpy.where(numpy.isnan(ideal), numpy.where(numpy.isfinite(middle), middle, numpy.nan), ideal)
+    
+    #   Which conditions and locations each profile takes, profiles x vocabulary and profiles x locations
+    codes = dict((name, code) for code, name in enumerate(cells['vocabulary']))
+    places = dict((location.strip('/').lower(), index) for index, location in enumerate(locations))
+    allowed = numpy.ones((count, len(codes)), dtype=bool)
+    wanted = numpy.ones((count, len(locations)), dtype=bool)
+    
+    for table, key, lookup in ((allowed, 'conditions', codes), (wanted, 'locations', places)):
+        listed = [index for index, profile in enumerate(profiles) if key in profile]
+        table[listed] = False
+        rows = [(index, lookup[item.strip('/').lower()]) for index in listed for item in profiles[index][key] if item.strip('/').lower() in lookup]
+        if rows:
+            table[tuple(numpy.array(rows).T)] = True
+    
+    #   Profiles without an ideal score every fitting day the same, the earliest wins
+    unscored = numpy.isnan(ideal)
+    ideal = numpy.where(unscored, 0.0, ideal).astype(numpy.float32)
+    
+    best = numpy.full(count, -1, dtype=int)
+    off_ideal = numpy.full(count, numpy.nan)
+    high = cells['high']
+    high32 = high.astype(numpy.float32)
+    unknown = numpy.isnan(high)
+    unscorable = numpy.finfo(numpy.float32).max
+    
+    for start in range(0, count, BESTDAY_CHUNK):
+        chunk = slice(start, start + BESTDAY_CHUNK)
+        
+        fits = unknown | ((high >= min_temp[chunk, None]) & (high <= max_temp[chunk, None]))
+        fits &= allowed[chunk][:, cells['conditions']]
+        fits &= wanted[chunk][:, cells['location']]
+        for column, ceiling in limits.items():
+            fits &= ~(cells[column] > ceiling[chunk, None])
+        
+        #   Degrees off ideal (float32 is plenty for temperatures and halves the matrix), days that don't fit are infinitely off
+        distance = numpy.subtract(high32, ideal[chunk, None])
+        numpy.abs(distance, out=distance)
+        distance[:, unknown] = unscorable
+        distance[unscored[chunk]] = 0.0
+        numpy.copyto(distance, numpy.inf, where=~fits)
+        
+        pick = distance.argmin(axis=1)
+        closest = distance[numpy.arange(len(pick)), pick]
+        found = numpy.isfinite(closest)
+        best[chunk] = numpy.where(found, pick, -1)
+        off_ideal[chunk] = numpy.where(found & ~unscored[chunk] & (closest < unscorable), closest, numpy.nan)
+        
+    return best, off_ideal
+    
+    
 #----------------------------------------------------------------------------
 
-def currentTemp(given_zip):
-    #   This def pulls current weather data for a given zipcode
+@timedAction('bestday')
+def lookAtBestDays(profiles, locations):
+    #   This def prints each profile's best day to get out across every location's forecast
+    #       The forecasts are polled once per location, however many profiles there are
     
-# http://api.wunderground.com/api/5f348904b60ca855/conditions/q/94541.json    
-    lookup_curr_query = "%s%sconditions/q/%s%s" % (WU_URL, API_KEY, given_zip, URL_EXTENSION)
+    #   Checking numpy is there before spending any calls on forecasts, bestDays imports it itself
+    import importlib.util
+    if importlib.util.find_spec('numpy') is None:
+        print("Error: --bestday needs numpy installed (pip install numpy)")
+        sys.exit(EXIT_STATUS_ERROR)
     
-    #   Pulling current data from Weather Underground
-    try:
-        polled_current_weather = apiPoll(lookup_curr_query)
+    cells = forecastCells(locations)
+    if cells is None:
+        print("Error: couldn't get a forecast for any of %s" % ', '.join(locations))
+        sys.exit(EXIT_STATUS_ERROR)
     
-        #   Checking to see what data is actually required 
-        #       (Looking forward, if there are calls for more pieces of data we can get away with flagging them and polling only once)
-        if OUTPUT_CURRENT_TEMP:
+    best, off_ideal = bestDays(profiles, cells, locations)
+    
+    if not OUTPUT_JSON:
+        print("\n   Best days to get out for %s profiles across %s locations (%s forecast days)" %
+              (len(profiles), len(set(cells['location'].tolist())), len(cells['high'])))
+    
+    for profile, pick, off in zip(profiles, best.tolist(), off_ideal.tolist()):
+        if pick < 0:
+            if OUTPUT_JSON:
+                emitRecord({'action': 'bestday', 'profile': profile['name'], 'location': None, 'date': None})
+            else:
+                print("%s: no day in the forecast fits" % profile['name'])
+            continue
         
-            curr_temp = polled_current_weather['current_observation']['temp_f']
+        location = locations[cells['location'][pick]]
+        when = cells['date'][pick].item()
+        high = cells['high'][pick]
+        conditions = cells['labels'][cells['conditions'][pick]]
+        
+        if OUTPUT_JSON:
+            emitRecord({'action': 'bestday', 'profile': profile['name'], 'location': location, 'date': when.isoformat(),
+                        'high_f': None if high != high else float(high), 'conditions': conditions,
+                        'off_ideal_f': None if off != off else off})
+        elif high != high:
+            print("%s: %s in %s, no forecast high and %s" % (profile['name'], when.strftime('%a %b %d'), location, conditions))
+        else:
+            print("%s: %s in %s, a high of %0.0f F and %s" % (profile['name'], when.strftime('%a %b %d'), location, high, conditions))
             
-            #   This is currently checking a global boolean variable called OUTPUT_JSON
-            #       It is a placeholder for the possibility of returning json as a switch at the commandline.
-            if not OUTPUT_JSON:
-                print("\n   The current temperature is %0d F in %s" % (curr_temp, given_zip))
-                
-            #   If OUTPUT_JSON is set return the raw data
-            else:
-                return curr_temp
             
-            #   Failing to get the current temp data should drop us out and tell us
-    except Exception as e:
-        print("Error: %s", e )
-        sys.exit(EXIT_STATUS_ERROR)
+#----------------------------------------------------------------------------
 
+def serveAction(action, location, today=None):
+    #   This def answers one action for one location as plain data, the daemon's version of the print-based output routines
+    #       Everything goes through the same planner/apiPoll/rolling window paths, so it shares their cache and limits
+    #       today is the date the request was made on (THIS_DAY if not given), history windows end the day before it
+    #       WU errors come back as a ValueError carrying WU's description, nothing is printed and nobody exits
+    
+    if action not in VALID_ACTIONS:
+        raise ValueError("unknown action '%s', expected one of %s" % (action, ', '.join(VALID_ACTIONS)))
+    
+    if action in HISTORY_ACTIONS:
+        def poller(query_string, fields=None):
+            return apiPoll(query_string, fields, raise_errors=True)
+        
+        days, total = rollingWindow('/q/%s' % location.strip('/'), DAYS_2_GET_HISTORICALS, poller, today)
+        
+        if action == 'pastweekavg':
+            return {'days': len(days), 'average_f': total / len(days) if days else None}
+        return {'days': days}
+    
+    for query_string, served in planQueries([action], location).items():
+        polled = apiPoll(query_string, actionFields(served), allow_stale=True, raise_errors=True)
+        
+        if action == 'currenttemp':
+            result = {'temp_f': polled['current_observation']['temp_f']}
+        
+        elif action == 'agoodday':
+            forecast_day = polled['forecast']['simpleforecast']['forecastday'][0]
+            forecast_temp = int(forecast_day['high']['fahrenheit'])
+            forecast_cond = forecast_day['conditions']
+            result = {'good_day': isGoodDay(forecast_temp, forecast_cond), 'high_f': forecast_temp, 'conditions': forecast_cond}
+        
+        else:
+            result = dict(('Day%s' % i, forecast_day) for i, forecast_day in forecastDays(polled, 1, 3))
+        
+        #   Letting the caller know they got a cached answer past its freshness
+        return staleField(result, polled)
+    
     
 #----------------------------------------------------------------------------
 
-def forecastWeather(given_zip):
-    #   This def takes a user-input zipcode and a switch for either 3-day or "a good day to get out"
-    #       (Future additions may include different preferences for "A good day to get out")
+def serveClasses():
+    #   This def builds (once) the request handler and unix socket server for --serve
+    #       http.server only gets loaded when we're actually running the daemon
+    global SERVE_CLASSES
     
-    # Making a legend of keys to ease the use of super-long lines ahead
-    fC  = 'forecast'
-    sFc = 'simpleforecast'
-    fCd = 'forecastday'
-    fH  = 'fahrenheit'
-    hG  = 'high'
-    cD  = 'conditions'
-    wD  = 'weekday'
-    mN  = 'monthname'
+    if SERVE_CLASSES is not None:
+        return SERVE_CLASSES
     
-    lookup_curr_query = "%s%sforecast/q/%s%s" % (WU_URL, API_KEY, given_zip, URL_EXTENSION)
+    from   http.server import BaseHTTPRequestHandler
+    from   urllib.parse import urlsplit, parse_qs
+    import socketserver
     
+    class ServeHandler(BaseHTTPRequestHandler):
+        #   Request handler for --serve:  GET /<action>?location=94541  ->  json
+        #       ie; /currenttemp?location=94541   /pastweekavg?location=CA/San Jose
     
-    #   Pulling forecast data from Weather Underground,... or.... the FUTURE!!
-    try:
-        theFuture = apiPoll(lookup_curr_query)
+        protocol_version = 'HTTP/1.1'
+    
+        def do_GET(self):
+            started = time.time()
         
-        #Failing to get the forecast data should drop us out and tell us
-    except Exception as e:
-        print("Error: %s", e )
-        sys.exit(EXIT_STATUS_ERROR)
-
-    #   If the good day flag was thrown check today's conditions and high temp    
-    if OUTPUT_GOOD_DAY:
-        try:
-            # Checking forecastday 0 as that signifies "today" (1, 2, 3 are the 3day forecast)
-            forecast_temp = int(theFuture[fC][sFc][fCd][0][hG][fH])
-            forecast_cond = theFuture[fC][sFc][fCd][0][cD]
+            url = urlsplit(self.path)
+            action = url.path.strip('/').lower()
+            location = parse_qs(url.query).get('location', [LOCATION_QUERY[len('/q/'):]])[0]
+        
+            #   A long running daemon sees the date roll over, history answers need to follow it
+            #       Worked out per request and handed down, other handler threads may be answering for another date
+            today = date.fromtimestamp(started)
+        
+            if action in ('', 'health'):
+                self.sendJson(200, {'status': 'ok', 'actions': VALID_ACTIONS})
+                return
+        
+            #   Prometheus scrapes the daemon directly
+            if action == 'metrics':
+                self.sendBody(200, metricsPrometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+                return
+        
+            if action not in VALID_ACTIONS:
+                status = 400
+                self.sendJson(status, {'action': action, 'location': location,
+                                       'error': "unknown action '%s', expected one of %s" % (action, ', '.join(VALID_ACTIONS))})
             
-            #   Ensuring both the high temp and the sunny conditions are both met then printing
-            if (forecast_temp == PREF_TEMP) and (forecast_cond == PREF_COND):
-                print("\n   Today will be a good day to get out of the house %s." % USER_NAME)
-                print("The forecast is %s with a high of %0d F" % (forecast_cond, forecast_temp))
-                
             else:
-                print("\n   Today is not a good day to get out %s." % USER_NAME)
-                print("The high will be %s with %s conditions" % (forecast_temp, forecast_cond))
+                try:
+                    result = serveAction(action, location, today)
+                    status = 200
+                    self.sendJson(status, {'action': action, 'location': location, 'result': result,
+                                           'elapsed_ms': round((time.time() - started) * 1000, 3)})
                 
-        except Exception as e:
-            print("Error: %s", e )
-            sys.exit(EXIT_STATUS_ERROR)
+                #   WU refusing us, a connection that never came good or a payload missing what we read
+                except Exception as e:
+                    status = 502
+                    self.sendJson(status, {'action': action, 'location': location, 'error': 'upstream failure: %s' % e})
             
+            metricTime('request', time.time() - started, action=action, status=status)
+            metricEvent('request', action=action, location=location, status=status, ms=round((time.time() - started) * 1000, 3))
     
-            
+        def sendJson(self, status, payload):
+            self.sendBody(status, json.dumps(payload).encode('utf-8'), 'application/json')
         
-    #   If the 3-day forecast flag is thrown return it
-    if OUTPUT_THREE_DAY_FORECAST:
+        def sendBody(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
         
-        try:
-            three_day_dict = dict()
-            print("\n   Three Day forecast for %s" % given_zip)
-            
-            for i in range(1, 4):
-                #   Pushing each day into a seperate dict as storing them via weekday named keys causes sorting
-                three_day_dict.update({'Day%s' % i : theFuture[fC][sFc][fCd][i]})
-                
-        except Exception as e:
-            print("Error: %s", e )
-            sys.exit(EXIT_STATUS_ERROR)
-
-        if OUTPUT_JSON:
-            return three_day_dict
-            
-        else:
-            #   As a json output wasn't asked for, we are simply printing te 3day forecast to stdout
-            for i in range(1, 4):
-                print("\n   The forecast for %s %s %s is %s with a high of %s F" % 
-                (three_day_dict['Day%s' % i]['date'][wD], 
-                 three_day_dict['Day%s' % i]['date'][mN], 
-                 three_day_dict['Day%s' % i]['date']['day'], 
-                 three_day_dict['Day%s' % i][cD], 
-                 three_day_dict['Day%s' % i][hG][fH])
-                )
+        def address_string(self):
+            #   Unix socket clients don't have an address to show
+            if isinstance(self.client_address, tuple) and self.client_address:
+                return str(self.client_address[0])
+            return 'unix'
+    
+        def log_message(self, format, *args):
+            import logging
+            logging.info("%s %s" % (self.address_string(), format % args))
         
         
-                
+    class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        #   Threaded HTTP over a unix socket for --serve unix:/path
+    
+        daemon_threads = True
+        
+        
+    SERVE_CLASSES = (ServeHandler, UnixServer)
+    return SERVE_CLASSES
+    
+    
+#----------------------------------------------------------------------------
+
+def serve(address):
+    #   This def runs the local query daemon until interrupted
+    #       address is 'port', 'host:port' or 'unix:/path/to.sock'
+    
+    #   A daemon answers the same queries over and over, give the in-memory cache more room
+    global MEMORY_CACHE_ENTRIES
+    MEMORY_CACHE_ENTRIES = max(MEMORY_CACHE_ENTRIES, 4096)
+    
+    #   and it's around for its refreshes, they run on threads as soon as an entry is seen stale
+    global REFRESH_DETACH
+    REFRESH_DETACH = False
+    
+    from   http.server import ThreadingHTTPServer
+    ServeHandler, UnixServer = serveClasses()
+    
+    if address.startswith('unix:'):
+        socket_path = address[len('unix:'):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixServer(socket_path, ServeHandler)
+    else:
+        host, sep, port = address.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), ServeHandler)
+        server.daemon_threads = True
+    
+    print("Serving weatherCheck on %s (Ctrl-C to stop)" % address)
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if address.startswith('unix:') and os.path.exists(address[len('unix:'):]):
+            os.remove(address[len('unix:'):])
+            
+    return EXIT_STATUS_OK
+    
+    
+#----------------------------------------------------------------------------
+
+def argLocations(args):
+    #   This def lists the locations --climatology and --bestday work over: --locations, else --zipcode, else San Jose
+    
+    if args.locations:
+        return [location.strip() for location in args.locations.split(',') if location.strip()]
+    if args.zipcode:
+        return [args.zipcode]
+    return [LOCATION_QUERY[len('/q/'):]]
+    
+    
 #--------------------------------  Yay running stuff!  
 # Main
 #-----------------------------------------------------------
@@ -348,6 +3772,27 @@ def main():
     global OUTPUT_GOOD_DAY
     global OUTPUT_THREE_DAY_FORECAST
     global API_KEY
+    global CACHE_ENABLED
+    global CACHE_DIR
+    global HTTP_READ_TIMEOUT
+    global HTTP_CONNECT_TIMEOUT
+    global RESOLVE_STATIONS
+    global STATION_TABLE_FILE
+    global STORE_ENABLED
+    global DAYS_2_GET_HISTORICALS
+    global STALE_ENABLED
+    global QUOTA_PRIORITY
+    global QUOTA_MAX_WAIT
+    global WU_URL
+    global API_CALLS_PER_MIN
+    global API_CALLS_PER_DAY
+    global METRICS_FILE
+    global PROFILE_ENABLED
+    global OUTPUT_JSON
+    global ARCHIVE_ENABLED
+    global ARCHIVE_DIR
+    global ARCHIVE_CODEC
+    global ARCHIVE_FIELDS
     
     
     try:
@@ -384,6 +3829,142 @@ def main():
                         help="Different than \'pastweekavg\', this returns the passed 7 days\' average temps individually",
                         action="store_true", default=False)
                         
+        parser.add_argument("--nocache",
+                        help="Skip the local response cache and always ask Weather Underground",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--cachedir",
+                        help="Directory for the local response cache (defaults to a folder in the system temp dir)",
+                        action="store", default=False)
+                        
+        parser.add_argument("--timeout",
+                        help="Read timeout in seconds for each call to Weather Underground (defaults to %s)" % HTTP_READ_TIMEOUT,
+                        action="store", type=float, default=False)
+                        
+        parser.add_argument("--connecttimeout",
+                        help="Connect timeout in seconds for each call to Weather Underground (defaults to %s)" % HTTP_CONNECT_TIMEOUT,
+                        action="store", type=float, default=False)
+                        
+        parser.add_argument("--batch",
+                        help="File of locations to run in one go, one 'location[,action,...]' per line ('-' reads stdin). Lines without actions use the action flags given",
+                        action="store", default=False)
+                        
+        parser.add_argument("--noresolve",
+                        help="Query locations as given instead of resolving them to their reporting station first",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--stationtable",
+                        help="Offline csv of 'location,station' rows checked before asking WU's geolookup",
+                        action="store", default=False)
+                        
+        parser.add_argument("--nostore",
+                        help="Skip the local daily history store and pull every history day from Weather Underground",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--historydays",
+                        help="Number of past days the history averages cover (defaults to 7)",
+                        action="store", type=int, default=False)
+                        
+        parser.add_argument("--climatology",
+                        help="Day-of-year normals, percentiles, records and latest anomaly from stored history, given as YYYYMMDD-YYYYMMDD",
+                        action="store", default=False)
+                        
+        parser.add_argument("--locations",
+                        help="Comma separated locations for --climatology or --bestday (zipcodes or ST/City), defaults to --zipcode or San Jose",
+                        action="store", default=False)
+                        
+        parser.add_argument("--bestday",
+                        help="File of good day preference profiles, one json object per line ('-' reads stdin), each gets its best day out of every --locations forecast (needs numpy)",
+                        action="store", default=False)
+                        
+        parser.add_argument("--backfill",
+                        help="With --climatology, fetch days missing from the history store first (bound by the API limits)",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--serve",
+                        help="Run as a local query daemon on 'port', 'host:port' or 'unix:/path.sock' (GET /<action>?location=94541)",
+                        action="store", default=False)
+                        
+        parser.add_argument("--nostale",
+                        help="Never answer current/forecast actions from a cached payload past its freshness TTL",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--priority",
+                        help="Queue priority for API calls shared with other weatherCheck runs: interactive, batch or background",
+                        action="store", choices=sorted(QUOTA_PRIORITIES), default=False)
+                        
+        parser.add_argument("--quotamaxwait",
+                        help="Give up (reporting the expected wait) when API quota wouldn't be free for this many seconds, default is to wait",
+                        action="store", type=float, default=None)
+                        
+        parser.add_argument("--quota",
+                        help="Show how much of this API key's minute/day budget is spent across all weatherCheck runs",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--prefetch",
+                        help="Keep a watch-list file warm ('location[,action,...]' per line, all actions by default), runs until stopped",
+                        action="store", default=False)
+                        
+        parser.add_argument("--once",
+                        help="With --prefetch, make a single pass over the watch-list and exit (ie; from cron)",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--wuurl",
+                        help="Base API URL to query instead of api.wunderground.com (ie; http://127.0.0.1:8080/api/ for wuReplay)",
+                        action="store", default=False)
+                        
+        parser.add_argument("--callspermin",
+                        help="Per-minute call limit of your API key's plan (defaults to the free plan's 10)",
+                        action="store", type=int, default=False)
+                        
+        parser.add_argument("--callsperday",
+                        help="Per-day call limit of your API key's plan (defaults to the free plan's 500)",
+                        action="store", type=int, default=False)
+                        
+        parser.add_argument("--json",
+                        help="Write results as newline-delimited json, one record per day/location flushed as soon as it's known",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--archive",
+                        help="Keep a trimmed, compressed copy of every payload pulled from Weather Underground in the payload archive",
+                        action="store_true", default=False)
+                        
+        parser.add_argument("--archivedir",
+                        help="Directory for the payload archive (defaults to an 'archive' folder in the cache dir)",
+                        action="store", default=False)
+                        
+        parser.add_argument("--archivecodec",
+                        help="Compression for new archive blocks (defaults to zlib, lzma is smaller and slower)",
+                        action="store", choices=sorted(ARCHIVE_CODECS), default=False)
+                        
+        parser.add_argument("--archivefields",
+                        help="Json file of {feature: [field paths]} to trim archived payloads to, null keeps a feature's payload whole",
+                        action="store", default=False)
+                        
+        parser.add_argument("--archiveshow",
+                        help="Print the archived payload for 'station/feature/YYYYMMDD', ie; KHWD/history/20170301",
+                        action="store", default=False)
+                        
+        parser.add_argument("--archiveexport",
+                        help="Write the latest archived payload for every station/feature/day to this file ('-' for stdout)",
+                        action="store", default=False)
+                        
+        parser.add_argument("--archiveimport",
+                        help="Seed the archive and history store from an exported archive file ('-' for stdin) instead of spending API calls",
+                        action="store", default=False)
+                        
+        parser.add_argument("--metricslog",
+                        help="Append one json line per API call and action (timings, sizes, cache results) to this file, '-' for stderr",
+                        action="store", default=False)
+                        
+        parser.add_argument("--metricsfile",
+                        help="Write counters and timings to this file in Prometheus text format at exit (ie; for node_exporter)",
+                        action="store", default=False)
+                        
+        parser.add_argument("--profile",
+                        help="Print where the time went (dns, connect, wait, transfer, parse, cache, quota...) at exit",
+                        action="store_true", default=False)
+                        
         parser.add_argument("--apikey",
                         help="Our great friends at Weather Underground require an api key to use their service, use yours, mine defaults just in case",
                         default='5f348904b60ca855/')
@@ -411,6 +3992,194 @@ def main():
                 sys.exit(EXIT_STATUS_ERROR)
         
         
+            #   apikey never needs a zipcode. If we threw apikey we'll store it in the global var
+            if args.apikey:
+                try:
+                    API_KEY = '%s' % (args.apikey + '/')
+                except Exception as e:
+                    print("Error: Weather Underground API key  %s",  e)
+                    sys.exit(EXIT_STATUS_ERROR)
+            
+            #   Cache switches apply to every call below
+            if args.nocache:
+                CACHE_ENABLED = False
+                
+            if args.cachedir:
+                CACHE_DIR = args.cachedir
+            elif CACHE_DIR is None:
+                import tempfile
+                CACHE_DIR = os.path.join(tempfile.gettempdir(), 'weatherCheck_cache')
+                
+            if args.timeout:
+                HTTP_READ_TIMEOUT = args.timeout
+                
+            if args.connecttimeout:
+                HTTP_CONNECT_TIMEOUT = args.connecttimeout
+                
+            if args.noresolve:
+                RESOLVE_STATIONS = False
+                
+            if args.stationtable:
+                STATION_TABLE_FILE = args.stationtable
+                
+            if args.nostore:
+                STORE_ENABLED = False
+                
+            if args.nostale:
+                STALE_ENABLED = False
+                
+            if args.wuurl:
+                WU_URL = args.wuurl if args.wuurl.endswith('/') else args.wuurl + '/'
+                
+            if args.callspermin:
+                API_CALLS_PER_MIN = args.callspermin
+                
+            if args.callsperday:
+                API_CALLS_PER_DAY = args.callsperday
+                
+            if args.metricslog:
+                try:
+                    metricsSetup(args.metricslog)
+                except OSError as e:
+                    print("Error: can't open metrics log %s: %s" % (args.metricslog, e))
+                    sys.exit(EXIT_STATUS_ERROR)
+                    
+            if args.metricsfile:
+                METRICS_FILE = args.metricsfile
+                
+            if args.profile:
+                PROFILE_ENABLED = True
+                
+            if args.json:
+                OUTPUT_JSON = True
+            
+            #   Bulk work steps aside for people waiting on an answer unless told otherwise
+            if args.priority:
+                QUOTA_PRIORITY = QUOTA_PRIORITIES[args.priority]
+            elif args.backfill or args.prefetch:
+                QUOTA_PRIORITY = QUOTA_PRIORITIES['background']
+            elif args.batch:
+                QUOTA_PRIORITY = QUOTA_PRIORITIES['batch']
+                
+            if args.quotamaxwait is not None:
+                QUOTA_MAX_WAIT = args.quotamaxwait
+                
+            if args.quota:
+                quotaStatus()
+                return EXIT_STATUS_OK
+                
+            if args.archive:
+                ARCHIVE_ENABLED = True
+                
+            if args.archivedir:
+                ARCHIVE_DIR = args.archivedir
+                
+            if args.archivecodec:
+                ARCHIVE_CODEC = args.archivecodec
+                
+            if args.archivefields:
+                try:
+                    with open(args.archivefields) as fields_file:
+                        fields = json.load(fields_file)
+                except (OSError, ValueError) as e:
+                    print("Error: can't read archive fields %s: %s" % (args.archivefields, e))
+                    sys.exit(EXIT_STATUS_ERROR)
+                
+                if not isinstance(fields, dict) or not all(paths is None or (isinstance(paths, list) and all(isinstance(path, str) for path in paths))
+                                                           for paths in fields.values()):
+                    print("Error: archive fields should be a json object of {feature: [field paths] or null}, got %s" % args.archivefields)
+                    sys.exit(EXIT_STATUS_ERROR)
+                ARCHIVE_FIELDS = fields
+            
+            #   The archive's bulk and lookup commands run on their own
+            if args.archiveshow:
+                try:
+                    station, feature, day = args.archiveshow.strip('/').rsplit('/', 2)
+                except ValueError:
+                    print("Error: archiveshow expects station/feature/YYYYMMDD, got %s" % args.archiveshow)
+                    sys.exit(EXIT_STATUS_ERROR)
+                
+                record = archiveRead(station, feature, day)
+                if record is None:
+                    print("Error: nothing archived for %s" % args.archiveshow)
+                    sys.exit(EXIT_STATUS_ERROR)
+                print(json.dumps(record, indent=2, sort_keys=True))
+                return EXIT_STATUS_OK
+                
+            if args.archiveexport or args.archiveimport:
+                try:
+                    if args.archiveexport:
+                        exported = archiveExport(args.archiveexport)
+                        print("Exported %s payloads to %s" % (exported, args.archiveexport), file=sys.stderr if args.archiveexport == '-' else sys.stdout)
+                    else:
+                        imported, stored = archiveImport(args.archiveimport)
+                        print("Imported %s payloads (%s history days into the store) from %s" % (imported, stored, args.archiveimport))
+                        
+                except (OSError, ValueError, sqlite3.Error) as e:
+                    print("Error: %s" % e)
+                    sys.exit(EXIT_STATUS_ERROR)
+                return EXIT_STATUS_OK
+                
+            if args.historydays:
+                if args.historydays < 1:
+                    print("Error: historydays must be at least 1, got %s" % args.historydays)
+                    sys.exit(EXIT_STATUS_ERROR)
+                DAYS_2_GET_HISTORICALS = args.historydays
+            
+            #   Prefetch mode keeps a watch-list warm for everyone else
+            if args.prefetch:
+                try:
+                    watch = readBatch(args.prefetch, VALID_ACTIONS)
+                except (OSError, ValueError) as e:
+                    print("Error: %s" % e)
+                    sys.exit(EXIT_STATUS_ERROR)
+                    
+                return prefetch(watch, args.once)
+            
+            #   Daemon mode answers actions over HTTP until stopped
+            if args.serve:
+                return serve(args.serve)
+            
+            #   Climatology runs on stored history for a date range rather than the usual actions
+            if args.climatology:
+                try:
+                    first_day, last_day = [datetime.datetime.strptime(day.strip(), '%Y%m%d').date() for day in args.climatology.split('-')]
+                except ValueError:
+                    print("Error: climatology expects a range as YYYYMMDD-YYYYMMDD, got %s" % args.climatology)
+                    sys.exit(EXIT_STATUS_ERROR)
+                
+                if last_day < first_day:
+                    print("Error: climatology range ends before it starts: %s" % args.climatology)
+                    sys.exit(EXIT_STATUS_ERROR)
+                
+                lookAtClimatology(argLocations(args), first_day, last_day, args.backfill)
+                return EXIT_STATUS_OK
+            
+            #   Best days out for a whole file of preference profiles, over every location's forecast at once
+            if args.bestday:
+                try:
+                    profiles = readProfiles(args.bestday)
+                except (OSError, ValueError) as e:
+                    print("Error: %s" % e)
+                    sys.exit(EXIT_STATUS_ERROR)
+                
+                if not profiles:
+                    print("Error: no profiles in %s" % args.bestday)
+                    sys.exit(EXIT_STATUS_ERROR)
+                
+                lookAtBestDays(profiles, argLocations(args))
+                return EXIT_STATUS_OK
+            
+            #   Batch mode takes its locations from a file/stdin instead of --zipcode and runs them all in this one process
+            if args.batch:
+                try:
+                    default_actions = [action for action in VALID_ACTIONS if getattr(args, action)]
+                    return runBatch(readBatch(args.batch, default_actions))
+                    
+                except (OSError, ValueError) as e:
+                    print("Error: %s" % e)
+                    sys.exit(EXIT_STATUS_ERROR)
+            
             #   Setting up a counter for zipcode errors
             needs_zipcode     = 0
             
@@ -468,37 +4237,22 @@ def main():
                     else:
                         pass
             
-            #   apikey never needs a zipcode. If we threw apikey we'll store it in the global var
-            if args.apikey:
-                try:
-                    API_KEY = '%s' % (args.apikey + '/')
-                except Exception as e:
-                    print("Error: Weather Underground API key  %s",  e)
-                    sys.exit(EXIT_STATUS_ERROR)
-            
             #   Now that we've run through the args we'll see if counters were incremented
             if history_counter >= 1:
                 try:
                     lookAtHistory()
                     
                 except Exception as e:
-                    print("Error: %s",  e)
+                    reportError(e, actions=[action for action in HISTORY_ACTIONS if getattr(args, action)], location=args.zipcode)
                     sys.exit(EXIT_STATUS_ERROR)
                     
-            if current_counter >= 1:
+            #   Current and forecast data come down together in as few chained requests as possible
+            if current_counter >= 1 or forecast_counter >= 1:
                 try:
-                    currentTemp(args.zipcode)
+                    runPlan([action for action in ACTION_FEATURES if getattr(args, action)], args.zipcode)
                     
                 except Exception as e:
-                    print("Error: %s", e)
-                    sys.exit(EXIT_STATUS_ERROR)
-                    
-            if forecast_counter >= 1:
-                try:
-                    forecastWeather(args.zipcode)
-
-                except Exception as e:
-                    print("Error: %s", e)
+                    reportError(e, actions=[action for action in ACTION_FEATURES if getattr(args, action)], location=args.zipcode)
                     sys.exit(EXIT_STATUS_ERROR)
                     
                     
@@ -507,12 +4261,21 @@ def main():
     
     # Catching argument errors:
     except Exception as e:
-        print("Error: %s",  e)
+        reportError(e)
         return EXIT_STATUS_ERROR
         
     return EXIT_STATUS_OK
     
 if __name__ == '__main__':
-    exit_status = main()
+    try:
+        exit_status = main()
+    
+    #   Answers are already out (or we're bailing with sys.exit), stale-while-revalidate refreshes are handed off
+    #       and the metrics get written before we go
+    finally:
+        finishRefreshes(REFRESH_EXIT_WAIT)
+        archiveFlush()
+        metricsFinish()
+        
     sys.exit(exit_status)
     
@@ -0,0 +1,702 @@
+################################################################
+#
+#   ******** wuReplay *********
+#
+#   This is a local stand-in for the (now retired) Weather Underground API so weatherCheck can be run, timed and
+#       broken on purpose without api.wunderground.com. It answers the same URLs weatherCheck builds:
+#           /api/<key>/<feature>[/<feature>...]/q/<location>.json
+#       with recorded payloads when it has them and believable synthetic ones when it doesn't.
+#
+#   Point weatherCheck at it with --wuurl, ie;
+#       python wuReplay.py --port 8080 --latency 80
+#       python weatherCheck.py --wuurl http://127.0.0.1:8080/api/ --zipcode 94541 --currenttemp
+#
+################################################################
+
+import json
+import sys
+import argparse
+import logging
+import os
+import math
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from   collections import Counter, deque
+from   datetime import date, datetime, timedelta
+from   http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from   urllib.parse import unquote, urlsplit
+
+
+#-----------------------------------------------------------------------
+# Globals
+#-----------------------------------------------------------------------
+
+#   Setting up human readable exit codes
+EXIT_STATUS_OK         = 0
+EXIT_STATUS_ERROR      = 1
+
+#   Features we know how to make up, history is 'history_YYYYMMDD' in the URL
+REPLAY_FEATURES        = ['conditions', 'forecast', 'geolookup']
+TIME_FRAME             = 'history_'
+
+#   Recorded payloads, checked before making anything up
+#       REPLAY_RECORDINGS is a directory laid out like the URL path, ie; <dir>/conditions/q/KHWD.json
+#       REPLAY_CACHE_DB is a weatherCheck responses.sqlite3, so anything weatherCheck ever pulled can be replayed
+REPLAY_RECORDINGS      = None
+REPLAY_CACHE_DB        = None
+REPLAY_CACHE_KEYS      = dict()
+REPLAY_DB_LOCK         = threading.Lock()
+
+#   Seconds added to every answer, plus up to REPLAY_JITTER more picked at random
+REPLAY_LATENCY         = 0.0
+REPLAY_JITTER          = 0.0
+
+#   Share of requests answered with a WU error body (with a 200, like WU did) or an HTTP 503
+REPLAY_ERROR_RATE      = 0.0
+REPLAY_ERROR_TYPE      = 'querynotfound'
+REPLAY_FAIL_RATE       = 0.0
+
+#   Calls per minute allowed per API key (0 for no limit). Past it we answer like WU did, with a 'ratelimited'
+#       error body, or with an HTTP 429 and Retry-After when REPLAY_RATE_MODE is 'http'
+REPLAY_RATE_LIMIT      = 0
+REPLAY_RATE_MODE       = 'body'
+REPLAY_RATE_CALLS      = dict()
+
+#   Locations that always come back as WU's 'querynotfound', handy for error paths
+REPLAY_UNKNOWN         = ['00000']
+
+#   Synthetic payloads are a function of (seed, location, day) so every run sees the same weather
+REPLAY_SEED            = 0
+REPLAY_OBSERVATIONS    = 24
+
+#   Tallies of what we've answered, served at /_stats and reset by /_reset
+REPLAY_STATS           = Counter()
+REPLAY_LOCK            = threading.Lock()
+
+#   Conditions WU reported, roughly from fair to foul
+CONDITIONS             = ['Clear', 'Partly Cloudy', 'Scattered Clouds', 'Mostly Cloudy', 'Overcast', 'Haze', 'Fog',
+                          'Light Drizzle', 'Light Rain', 'Rain', 'Heavy Rain', 'Thunderstorm']
+WIND_DIRECTIONS        = ['North', 'NNE', 'NE', 'ENE', 'East', 'ESE', 'SE', 'SSE',
+                          'South', 'SSW', 'SW', 'WSW', 'West', 'WNW', 'NW', 'NNW']
+
+TERMS_OF_SERVICE       = 'http://www.wunderground.com/weather/api/d/terms.html'
+
+
+#-----------------------------------------------------------------------
+# Functions
+#-----------------------------------------------------------------------
+
+def parseQuery(path):
+    #   This def splits a WU API path into (api_key, [features], location)
+    #       /api/5f348904b60ca855//conditions/forecast/q/CA/San%20Jose.json -> ('5f348904b60ca855', ['conditions', 'forecast'], 'CA/San Jose')
+    #       Returns None for anything that isn't shaped like an API call
+
+    path = unquote(urlsplit(path).path)
+    if not path.startswith('/api/') or '/q/' not in path:
+        return None
+
+    head, location = path[len('/api/'):].split('/q/', 1)
+
+    #   weatherCheck's default key ends in a slash, doubled slashes just leave empty segments
+    segments = [segment for segment in head.split('/') if segment]
+    if not segments:
+        return None
+
+    if location.endswith('.json'):
+        location = location[:-len('.json')]
+
+    return segments[0], segments[1:], location.strip('/')
+
+
+#----------------------------------------------------------------
+def seeded(*parts):
+    #   This def hands back a random generator that always produces the same numbers for the same parts
+
+    return random.Random(zlib.crc32(('%s|%s' % (REPLAY_SEED, '|'.join(str(part) for part in parts))).encode('utf-8')))
+
+
+#----------------------------------------------------------------
+def stationFor(location):
+    #   This def makes up a stable reporting station for a location, stations and pws ids are kept as given
+
+    if location.startswith('pws:'):
+        return location
+    if len(location) == 4 and location.isalpha() and location.isupper():
+        return location
+
+    rng = seeded('station', location.upper())
+    return 'K' + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for i in range(3))
+
+
+#----------------------------------------------------------------
+def climate(station, day):
+    #   This def returns the made-up (mean, spread, wetness) for a station on a day
+    #       Each station gets its own base temp and seasonal swing, then the day gets some weather on top
+
+    rng = seeded('climate', station)
+    base = rng.uniform(45, 70)
+    swing = rng.uniform(6, 22)
+    wet = rng.uniform(0.05, 0.35)
+
+    #   Coldest around mid January, warmest around mid July
+    season = -math.cos(2 * math.pi * (day.timetuple().tm_yday - 15) / 365.25)
+
+    rng = seeded('day', station, day.toordinal())
+    mean = base + swing * season + rng.gauss(0, 4)
+    spread = rng.uniform(5, 14)
+    wetness = rng.random() * (1.5 - season) * wet
+
+    return mean, spread, wetness
+
+
+#----------------------------------------------------------------
+def conditionFor(wetness, rng):
+    #   This def picks a condition name, wetter days drift towards the foul end of CONDITIONS
+
+    index = int(min(len(CONDITIONS) - 1, max(0, wetness * 14 + rng.gauss(0, 1.5))))
+    return CONDITIONS[index]
+
+
+#----------------------------------------------------------------
+def dateBlock(moment):
+    #   This def builds the date object WU used inside observations and forecast days
+
+    return {'epoch': str(int(time.mktime(moment.timetuple()))),
+            'pretty': moment.strftime('%I:%M %p PDT on %B %d, %Y'),
+            'day': moment.day, 'month': moment.month, 'year': moment.year,
+            'yday': moment.timetuple().tm_yday - 1,
+            'hour': moment.hour, 'min': moment.strftime('%M'), 'sec': 0, 'isdst': '1',
+            'monthname': moment.strftime('%B'), 'monthname_short': moment.strftime('%b'),
+            'weekday_short': moment.strftime('%a'), 'weekday': moment.strftime('%A'),
+            'ampm': moment.strftime('%p'), 'tz_short': 'PDT', 'tz_long': 'America/Los_Angeles'}
+
+
+#----------------------------------------------------------------
+def toC(fahrenheit):
+    #   This def converts a temperature to Celsius, WU shipped both
+
+    return (fahrenheit - 32) * 5.0 / 9.0
+
+
+#----------------------------------------------------------------
+def syntheticHistory(station, day):
+    #   This def makes up a history payload for one day: hourly observations then the daily summary
+    #       Days that haven't happened yet come back empty like WU's did, today only has the hours so far
+
+    history = {'date': dateBlock(datetime(day.year, day.month, day.day)), 'utcdate': dateBlock(datetime(day.year, day.month, day.day, 7)),
+               'observations': [], 'dailysummary': []}
+
+    today = date.today()
+    if day > today:
+        return history
+
+    mean, spread, wetness = climate(station, day)
+    rng = seeded('hours', station, day.toordinal())
+
+    hours = REPLAY_OBSERVATIONS
+    if day == today:
+        hours = max(1, int(REPLAY_OBSERVATIONS * datetime.now().hour / 24.0))
+
+    total_precip = 0.0
+    for i in range(hours):
+        hour = i * 24.0 / REPLAY_OBSERVATIONS
+        moment = datetime(day.year, day.month, day.day, int(hour), int((hour % 1) * 60))
+
+        #   Warmest mid afternoon, coolest just before dawn
+        temp = mean + spread / 2.0 * -math.cos(2 * math.pi * (hour - 3) / 24.0) + rng.gauss(0, 1)
+        dewpt = temp - rng.uniform(4, 20)
+        wind = max(0.0, rng.gauss(6 + wetness * 10, 3))
+        precip = rng.expovariate(12) if rng.random() < wetness else 0.0
+        total_precip = total_precip + precip
+        conds = conditionFor(wetness + (0.3 if precip else 0), rng)
+
+        history['observations'].append({
+            'date': dateBlock(moment), 'utcdate': dateBlock(moment + timedelta(hours=7)),
+            'tempm': '%.1f' % toC(temp), 'tempi': '%.1f' % temp,
+            'dewptm': '%.1f' % toC(dewpt), 'dewpti': '%.1f' % dewpt,
+            'hum': '%d' % min(100, max(5, 100 - 5 * (temp - dewpt) / 1.8)),
+            'wspdm': '%.1f' % (wind * 1.609), 'wspdi': '%.1f' % wind,
+            'wgustm': '-9999.0', 'wgusti': '-9999.0',
+            'wdird': '%d' % rng.randrange(0, 360, 10), 'wdire': rng.choice(WIND_DIRECTIONS),
+            'vism': '16.1', 'visi': '10.0',
+            'pressurem': '%.1f' % rng.uniform(1005, 1025), 'pressurei': '%.2f' % rng.uniform(29.7, 30.3),
+            'windchillm': '-999', 'windchilli': '-999', 'heatindexm': '-9999', 'heatindexi': '-9999',
+            'precipm': '%.1f' % (precip * 25.4) if precip else '-9999.00', 'precipi': '%.2f' % precip if precip else '-9999.00',
+            'conds': conds, 'icon': conds.lower().replace(' ', ''),
+            'fog': '1' if conds == 'Fog' else '0', 'rain': '1' if precip else '0', 'snow': '0', 'hail': '0',
+            'thunder': '1' if conds == 'Thunderstorm' else '0', 'tornado': '0',
+            'metar': 'METAR %s %02d%02d%02dZ %03d%02dKT 10SM' % (station, day.day, int(hour), 0, rng.randrange(0, 360, 10), int(wind))})
+
+    temps = [float(obs['tempi']) for obs in history['observations']]
+    history['dailysummary'].append({
+        'date': history['date'],
+        'fog': '0', 'rain': '1' if total_precip else '0', 'snow': '0', 'snowfallm': '0.00', 'snowfalli': '0.00',
+        'snowdepthm': '', 'snowdepthi': '', 'hail': '0', 'thunder': '0', 'tornado': '0',
+        'meantempm': '%d' % round(toC(sum(temps) / len(temps))), 'meantempi': '%d' % round(sum(temps) / len(temps)),
+        'meandewptm': '%d' % round(toC(mean - 10)), 'meandewpti': '%d' % round(mean - 10),
+        'meanpressurem': '1015', 'meanpressurei': '29.98',
+        'meanwindspdm': '%d' % round(wetness * 20 + 8), 'meanwindspdi': '%d' % round(wetness * 12 + 5),
+        'meanwdire': '', 'meanwdird': '%d' % rng.randrange(0, 360, 10),
+        'meanvism': '16', 'meanvisi': '10', 'humidity': '', 'maxhumidity': '90', 'minhumidity': '40',
+        'maxtempm': '%d' % round(toC(max(temps))), 'maxtempi': '%d' % round(max(temps)),
+        'mintempm': '%d' % round(toC(min(temps))), 'mintempi': '%d' % round(min(temps)),
+        'maxdewptm': '%d' % round(toC(mean - 5)), 'maxdewpti': '%d' % round(mean - 5),
+        'mindewptm': '%d' % round(toC(mean - 15)), 'mindewpti': '%d' % round(mean - 15),
+        'maxpressurem': '1020', 'maxpressurei': '30.12', 'minpressurem': '1010', 'minpressurei': '29.83',
+        'maxwspdm': '%d' % round(wetness * 40 + 15), 'maxwspdi': '%d' % round(wetness * 25 + 9),
+        'minwspdm': '0', 'minwspdi': '0', 'maxvism': '16', 'maxvisi': '10', 'minvism': '10', 'minvisi': '6',
+        'gdegreedays': '%d' % max(0, round(sum(temps) / len(temps) - 50)),
+        'heatingdegreedays': '%d' % max(0, round(65 - sum(temps) / len(temps))),
+        'coolingdegreedays': '%d' % max(0, round(sum(temps) / len(temps) - 65)),
+        'precipm': '%.2f' % (total_precip * 25.4), 'precipi': '%.2f' % total_precip, 'precipsource': '3Or6HourObs'})
+
+    return history
+
+
+#----------------------------------------------------------------
+def syntheticConditions(station, location):
+    #   This def makes up the current_observation for a station, it follows the same day as its history payload
+
+    now = datetime.now()
+    mean, spread, wetness = climate(station, now.date())
+    rng = seeded('now', station, now.toordinal(), now.hour)
+
+    temp = round(mean + spread / 2.0 * -math.cos(2 * math.pi * (now.hour - 3) / 24.0), 1)
+    wind = round(max(0.0, rng.gauss(6 + wetness * 10, 3)), 1)
+    conds = conditionFor(wetness, rng)
+
+    place = {'full': location, 'city': location.split('/')[-1], 'state': location.split('/')[0] if '/' in location else '',
+             'country': 'US', 'zip': location if location.isdigit() else '00000',
+             'latitude': '%.6f' % seeded('lat', station).uniform(25, 48), 'longitude': '%.6f' % seeded('lon', station).uniform(-124, -70),
+             'elevation': '%.1f' % seeded('elev', station).uniform(0, 1500)}
+
+    return {'image': {'url': 'http://icons.wxug.com/graphics/wu2/logo_130x80.png', 'title': 'Weather Underground', 'link': 'http://www.wunderground.com'},
+            'display_location': place, 'observation_location': dict(place, full=station),
+            'estimated': {}, 'station_id': station,
+            'observation_time': now.strftime('Last Updated on %B %d, %I:%M %p PDT'),
+            'observation_time_rfc822': now.strftime('%a, %d %b %Y %H:%M:%S -0700'),
+            'observation_epoch': str(int(time.time())), 'local_time_rfc822': now.strftime('%a, %d %b %Y %H:%M:%S -0700'),
+            'local_epoch': str(int(time.time())), 'local_tz_short': 'PDT', 'local_tz_long': 'America/Los_Angeles', 'local_tz_offset': '-0700',
+            'weather': conds, 'temperature_string': '%.1f F (%.1f C)' % (temp, toC(temp)),
+            'temp_f': temp, 'temp_c': round(toC(temp), 1),
+            'relative_humidity': '%d%%' % rng.randrange(30, 95),
+            'wind_string': 'From the %s at %.1f MPH' % (rng.choice(WIND_DIRECTIONS), wind),
+            'wind_dir': rng.choice(WIND_DIRECTIONS), 'wind_degrees': rng.randrange(0, 360, 10),
+            'wind_mph': wind, 'wind_gust_mph': 0, 'wind_kph': round(wind * 1.609, 1), 'wind_gust_kph': 0,
+            'pressure_mb': '%d' % rng.randrange(1005, 1025), 'pressure_in': '%.2f' % rng.uniform(29.7, 30.3), 'pressure_trend': '0',
+            'dewpoint_string': '%d F' % (temp - 10), 'dewpoint_f': int(temp - 10), 'dewpoint_c': int(toC(temp - 10)),
+            'heat_index_string': 'NA', 'heat_index_f': 'NA', 'heat_index_c': 'NA',
+            'windchill_string': 'NA', 'windchill_f': 'NA', 'windchill_c': 'NA',
+            'feelslike_string': '%.1f F' % temp, 'feelslike_f': '%.1f' % temp, 'feelslike_c': '%.1f' % toC(temp),
+            'visibility_mi': '10.0', 'visibility_km': '16.1', 'solarradiation': '--', 'UV': '%d' % rng.randrange(0, 10),
+            'precip_1hr_string': '0.00 in ( 0 mm)', 'precip_1hr_in': '0.00', 'precip_1hr_metric': ' 0',
+            'precip_today_string': '0.00 in (0 mm)', 'precip_today_in': '0.00', 'precip_today_metric': '0',
+            'icon': conds.lower().replace(' ', ''), 'icon_url': 'http://icons.wxug.com/i/c/k/%s.gif' % conds.lower().replace(' ', ''),
+            'forecast_url': 'http://www.wunderground.com/US/%s.html' % location,
+            'history_url': 'http://www.wunderground.com/history/airport/%s/%s/DailyHistory.html' % (station, now.strftime('%Y/%m/%d')),
+            'ob_url': 'http://www.wunderground.com/cgi-bin/findweather/getForecast?query=%s' % place['latitude'],
+            'nowcast': ''}
+
+
+#----------------------------------------------------------------
+def syntheticForecast(station):
+    #   This def makes up the 4 day forecast (today first) plus the text periods WU sent along with it
+
+    today = date.today()
+    forecast = {'txt_forecast': {'date': datetime.now().strftime('%I:%M %p PDT'), 'forecastday': []},
+                'simpleforecast': {'forecastday': []}}
+
+    for i in range(4):
+        day = today + timedelta(days=i)
+        mean, spread, wetness = climate(station, day)
+        rng = seeded('forecast', station, day.toordinal())
+        conds = conditionFor(wetness, rng)
+        high = int(round(mean + spread / 2.0))
+        low = int(round(mean - spread / 2.0))
+        pop = int(min(100, wetness * 150))
+        wind = int(round(max(0.0, rng.gauss(6 + wetness * 10, 3))))
+        icon = conds.lower().replace(' ', '')
+
+        for night in (False, True):
+            forecast['txt_forecast']['forecastday'].append({
+                'period': i * 2 + night, 'icon': icon, 'icon_url': 'http://icons.wxug.com/i/c/k/%s.gif' % icon,
+                'title': day.strftime('%A') + (' Night' if night else ''),
+                'fcttext': '%s. %s %sF. Winds %s at %s to %s mph.' % (conds, 'Low' if night else 'High', low if night else high,
+                                                                       rng.choice(WIND_DIRECTIONS), max(0, wind - 5), wind + 5),
+                'fcttext_metric': '%s. %s %dC.' % (conds, 'Low' if night else 'High', toC(low if night else high)),
+                'pop': '%d' % pop})
+
+        forecast['simpleforecast']['forecastday'].append({
+            'date': dateBlock(datetime(day.year, day.month, day.day, 19)), 'period': i + 1,
+            'high': {'fahrenheit': '%d' % high, 'celsius': '%d' % round(toC(high))},
+            'low': {'fahrenheit': '%d' % low, 'celsius': '%d' % round(toC(low))},
+            'conditions': conds, 'icon': icon, 'icon_url': 'http://icons.wxug.com/i/c/k/%s.gif' % icon,
+            'skyicon': '', 'pop': pop,
+            'qpf_allday': {'in': round(wetness * 0.8, 2), 'mm': int(wetness * 20)},
+            'qpf_day': {'in': round(wetness * 0.4, 2), 'mm': int(wetness * 10)},
+            'qpf_night': {'in': round(wetness * 0.4, 2), 'mm': int(wetness * 10)},
+            'snow_allday': {'in': 0.0, 'cm': 0.0}, 'snow_day': {'in': 0.0, 'cm': 0.0}, 'snow_night': {'in': 0.0, 'cm': 0.0},
+            'maxwind': {'mph': wind + 5, 'kph': int((wind + 5) * 1.609), 'dir': rng.choice(WIND_DIRECTIONS), 'degrees': rng.randrange(0, 360, 10)},
+            'avewind': {'mph': wind, 'kph': int(wind * 1.609), 'dir': rng.choice(WIND_DIRECTIONS), 'degrees': rng.randrange(0, 360, 10)},
+            'avehumidity': rng.randrange(40, 95), 'maxhumidity': 0, 'minhumidity': 0})
+
+    return forecast
+
+
+#----------------------------------------------------------------
+def syntheticGeolookup(station, location):
+    #   This def makes up a geolookup answer with the location's station as the nearest airport
+
+    rng = seeded('geo', location)
+
+    return {'type': 'CITY', 'country': 'US', 'country_iso3166': 'US', 'country_name': 'USA',
+            'state': location.split('/')[0] if '/' in location else 'CA', 'city': location.split('/')[-1],
+            'tz_short': 'PDT', 'tz_long': 'America/Los_Angeles',
+            'lat': '%.6f' % seeded('lat', station).uniform(25, 48), 'lon': '%.6f' % seeded('lon', station).uniform(-124, -70),
+            'zip': location if location.isdigit() else '00000', 'magic': '1', 'wmo': '99999',
+            'l': '/q/zmw:%s.1.99999' % (location if location.isdigit() else '00000'),
+            'requesturl': 'US/%s.html' % location,
+            'wuiurl': 'https://www.wunderground.com/US/%s.html' % location,
+            'nearby_weather_stations': {
+                'airport': {'station': [{'city': location.split('/')[-1], 'state': 'CA', 'country': 'US', 'icao': station,
+                                         'lat': '0', 'lon': '0'}]},
+                'pws': {'station': [{'neighborhood': 'Station %s' % i, 'city': location.split('/')[-1], 'state': 'CA', 'country': 'US',
+                                     'id': 'K%s%s' % (station[1:], rng.randrange(10, 99)), 'lat': 0, 'lon': 0,
+                                     'distance_km': i, 'distance_mi': i} for i in range(1, 6)]}}}
+
+
+#----------------------------------------------------------------
+def errorBody(error_type, description):
+    #   This def builds the error payload WU handed back (with a 200) when it wouldn't answer a query
+
+    return {'response': {'version': '0.1', 'termsofService': TERMS_OF_SERVICE, 'features': {},
+                         'error': {'type': error_type, 'description': description}}}
+
+
+#----------------------------------------------------------------
+def recordedPayload(feature, location):
+    #   This def looks for a recorded payload for one feature of a location, returns the decoded dict or None
+
+    key = '%s/q/%s.json' % (feature, location)
+
+    if REPLAY_RECORDINGS:
+        path = os.path.join(REPLAY_RECORDINGS, *key.split('/'))
+        if os.path.exists(path):
+            with open(path) as recording:
+                return json.load(recording)
+
+    if REPLAY_CACHE_DB and key in REPLAY_CACHE_KEYS:
+        with REPLAY_DB_LOCK:
+            conn = sqlite3.connect(REPLAY_CACHE_DB)
+            try:
+                row = conn.execute("SELECT body FROM responses WHERE key = ?", (REPLAY_CACHE_KEYS[key],)).fetchone()
+            finally:
+                conn.close()
+        if row:
+            return json.loads(row[0])
+
+    return None
+
+
+#----------------------------------------------------------------
+def loadCacheKeys(db_path):
+    #   This def indexes a weatherCheck cache db by URL path, ie; 'conditions/q/KHWD.json' -> its full cache key
+    #       Only single-feature entries are indexed, chained payloads are fanned out to those by weatherCheck anyway
+
+    keys = dict()
+    conn = sqlite3.connect(db_path)
+    try:
+        for (key,) in conn.execute("SELECT key FROM responses"):
+            parsed = parseQuery(key.replace('/api/', '/api/recorded/', 1))
+            if parsed and len(parsed[1]) == 1:
+                keys['%s/q/%s.json' % (parsed[1][0], parsed[2])] = key
+    finally:
+        conn.close()
+
+    return keys
+
+
+#----------------------------------------------------------------
+def payloadFor(features, location):
+    #   This def assembles the answer for a (possibly chained) query, one feature at a time
+    #       Recorded payloads win, anything we don't have is made up. Returns (payload, recorded feature count)
+
+    if location in REPLAY_UNKNOWN:
+        return errorBody('querynotfound', 'No cities match your search query'), 0
+
+    station = stationFor(location)
+    payload = {'response': {'version': '0.1', 'termsofService': TERMS_OF_SERVICE, 'features': {}}}
+    recorded = 0
+
+    for feature in features:
+        if feature not in REPLAY_FEATURES and not feature.startswith(TIME_FRAME):
+            return errorBody('unknownfeature', "%s is not a valid feature" % feature), recorded
+
+        found = recordedPayload(feature, location)
+        if found is not None:
+            recorded = recorded + 1
+            payload.update(dict((key, value) for key, value in found.items() if key != 'response'))
+
+        elif feature.startswith(TIME_FRAME):
+            try:
+                day = datetime.strptime(feature[len(TIME_FRAME):], '%Y%m%d').date()
+            except ValueError:
+                return errorBody('invalidquery', "%s is not a valid date" % feature), recorded
+            payload['history'] = syntheticHistory(station, day)
+
+        elif feature == 'conditions':
+            payload['current_observation'] = syntheticConditions(station, location)
+
+        elif feature == 'forecast':
+            payload['forecast'] = syntheticForecast(station)
+
+        elif feature == 'geolookup':
+            payload['location'] = syntheticGeolookup(station, location)
+
+        payload['response']['features'][feature.split('_')[0]] = 1
+
+    return payload, recorded
+
+
+#----------------------------------------------------------------
+def rateLimited(api_key):
+    #   This def books a call against the key's per-minute allowance, returns seconds until it has room again (0 if it has now)
+
+    if not REPLAY_RATE_LIMIT:
+        return 0
+
+    now = time.time()
+    with REPLAY_LOCK:
+        calls = REPLAY_RATE_CALLS.setdefault(api_key, deque())
+        while calls and calls[0] <= now - 60:
+            calls.popleft()
+
+        if len(calls) >= REPLAY_RATE_LIMIT:
+            return calls[0] + 60 - now
+
+        calls.append(now)
+
+    return 0
+
+
+#----------------------------------------------------------------
+def tally(name, amount=1):
+    #   This def bumps one of the REPLAY_STATS counters
+
+    with REPLAY_LOCK:
+        REPLAY_STATS[name] = REPLAY_STATS[name] + amount
+
+
+#----------------------------------------------------------------------------
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    #   Request handler answering WU API paths, plus GET /_stats and /_reset for whoever is driving a benchmark
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/_stats'):
+            with REPLAY_LOCK:
+                stats = dict(REPLAY_STATS)
+            self.sendJson(200, stats)
+            return
+
+        if self.path.startswith('/_reset'):
+            with REPLAY_LOCK:
+                REPLAY_STATS.clear()
+                REPLAY_RATE_CALLS.clear()
+            self.sendJson(200, {'status': 'ok'})
+            return
+
+        parsed = parseQuery(self.path)
+        if parsed is None:
+            self.sendJson(404, errorBody('invalidquery', 'not a Weather Underground API path: %s' % self.path))
+            return
+        api_key, features, location = parsed
+
+        tally('requests')
+        for feature in features:
+            tally('feature:%s' % feature.split('_')[0])
+
+        #   The wait happens before anything else, a slow upstream is slow at refusing you too
+        if REPLAY_LATENCY or REPLAY_JITTER:
+            time.sleep(REPLAY_LATENCY + random.uniform(0, REPLAY_JITTER))
+
+        wait = rateLimited(api_key)
+        if wait:
+            tally('ratelimited')
+            if REPLAY_RATE_MODE == 'http':
+                self.sendJson(429, errorBody('ratelimited', 'rate limit exceeded'), {'Retry-After': '%d' % math.ceil(wait)})
+            else:
+                self.sendJson(200, errorBody('ratelimited', 'You have exceeded your rate limit of %s calls per minute' % REPLAY_RATE_LIMIT))
+            return
+
+        roll = random.random()
+        if roll < REPLAY_FAIL_RATE:
+            tally('failed')
+            self.sendJson(503, {'error': 'Service Unavailable'})
+            return
+
+        if roll < REPLAY_FAIL_RATE + REPLAY_ERROR_RATE:
+            tally('errors')
+            self.sendJson(200, errorBody(REPLAY_ERROR_TYPE, 'injected %s error' % REPLAY_ERROR_TYPE))
+            return
+
+        payload, recorded = payloadFor(features, location)
+        tally('recorded', recorded)
+        if 'error' in payload['response']:
+            tally('errors')
+
+        self.sendJson(200, payload)
+
+    def sendJson(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        tally('bytes', len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("%s %s" % (self.address_string(), format % args))
+
+
+#----------------------------------------------------------------------------
+
+def startServer(host='127.0.0.1', port=0):
+    #   This def starts the stand-in on a background thread (port 0 picks a free one) and returns (server, base API URL)
+    #       For driving weatherCheck from another script, ie; weatherBench. server.shutdown() stops it.
+
+    global REPLAY_CACHE_KEYS
+    if REPLAY_CACHE_DB:
+        REPLAY_CACHE_KEYS = loadCacheKeys(REPLAY_CACHE_DB)
+
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, 'http://%s:%s/api/' % (server.server_address[0], server.server_address[1])
+
+
+#--------------------------------  Yay running stuff!
+# Main
+#-----------------------------------------------------------
+def main():
+
+    global REPLAY_RECORDINGS
+    global REPLAY_CACHE_DB
+    global REPLAY_LATENCY
+    global REPLAY_JITTER
+    global REPLAY_ERROR_RATE
+    global REPLAY_ERROR_TYPE
+    global REPLAY_FAIL_RATE
+    global REPLAY_RATE_LIMIT
+    global REPLAY_RATE_MODE
+    global REPLAY_SEED
+
+    parser = argparse.ArgumentParser(description="Offline stand-in for the Weather Underground API")
+
+    parser.add_argument("--host",
+                    help="Address to listen on (defaults to 127.0.0.1)",
+                    action="store", default='127.0.0.1')
+
+    parser.add_argument("--port",
+                    help="Port to listen on (defaults to 8080)",
+                    action="store", type=int, default=8080)
+
+    parser.add_argument("--recordings",
+                    help="Directory of recorded payloads laid out like the URL path, ie; <dir>/forecast/q/KHWD.json",
+                    action="store", default=False)
+
+    parser.add_argument("--cachedb",
+                    help="Replay payloads out of a weatherCheck cache db (responses.sqlite3)",
+                    action="store", default=False)
+
+    parser.add_argument("--latency",
+                    help="Milliseconds added to every answer",
+                    action="store", type=float, default=0)
+
+    parser.add_argument("--jitter",
+                    help="Up to this many more milliseconds, picked at random per answer",
+                    action="store", type=float, default=0)
+
+    parser.add_argument("--errorrate",
+                    help="Share of requests (0-1) answered with a WU error body",
+                    action="store", type=float, default=0)
+
+    parser.add_argument("--errortype",
+                    help="WU error type used for injected error bodies (defaults to querynotfound)",
+                    action="store", default='querynotfound')
+
+    parser.add_argument("--failrate",
+                    help="Share of requests (0-1) answered with an HTTP 503",
+                    action="store", type=float, default=0)
+
+    parser.add_argument("--ratelimit",
+                    help="Calls per minute allowed per API key, 0 for no limit (WU's free plan was 10)",
+                    action="store", type=int, default=0)
+
+    parser.add_argument("--ratemode",
+                    help="Answer over-limit calls with WU's 'ratelimited' error body or an HTTP 429",
+                    action="store", choices=['body', 'http'], default='body')
+
+    parser.add_argument("--seed",
+                    help="Seed for the synthetic weather, same seed same weather",
+                    action="store", type=int, default=0)
+
+    parser.add_argument("--verbose",
+                    help="Log every request",
+                    action="store_true", default=False)
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    if args.recordings:
+        REPLAY_RECORDINGS = args.recordings
+
+    if args.cachedb:
+        if not os.path.exists(args.cachedb):
+            print("Error: no cache db at %s" % args.cachedb)
+            return EXIT_STATUS_ERROR
+        REPLAY_CACHE_DB = args.cachedb
+
+    REPLAY_LATENCY = args.latency / 1000.0
+    REPLAY_JITTER = args.jitter / 1000.0
+    REPLAY_ERROR_RATE = args.errorrate
+    REPLAY_ERROR_TYPE = args.errortype
+    REPLAY_FAIL_RATE = args.failrate
+    REPLAY_RATE_LIMIT = args.ratelimit
+    REPLAY_RATE_MODE = args.ratemode
+    REPLAY_SEED = args.seed
+
+    try:
+        server, url = startServer(args.host, args.port)
+    except OSError as e:
+        print("Error: can't listen on %s:%s (%s)" % (args.host, args.port, e))
+        return EXIT_STATUS_ERROR
+
+    print("Replaying Weather Underground on %s (Ctrl-C to stop)" % url)
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return EXIT_STATUS_OK
+
+if __name__ == '__main__':
+    sys.exit(main())